@@ -43,6 +43,24 @@ class Plugin(pwem.Plugin):
     def _defineVariables(cls):
         cls._defineVar(AFM_BINARY, "program")
         cls._defineEmVar(AFM_HOME, f"myplugin-{V1}")
+        cls._defineVar(AFM_CACHE_DIR, os.path.join(os.path.expanduser('~'),
+                                                   '.cache', 'scipion-afm'))
+        cls._defineVar(AFM_CACHE_SIZE, 20)
+        cls._defineVar(MOTIONCOR3_BIN, 'MotionCor3')
+
+    @classmethod
+    def getDownsampleCache(cls):
+        """ Cache of downsampled micrographs, see
+        afm.processing.DownsampleCache. """
+        from .processing.downsample import DownsampleCache
+        return DownsampleCache(cls.getVar(AFM_CACHE_DIR),
+                               float(cls.getVar(AFM_CACHE_SIZE)) * 1024 ** 3)
+
+    @classmethod
+    def getMotionCorProgram(cls):
+        """ MotionCor3 executable, from the MOTIONCOR3_BIN variable of the
+        config or the environment. """
+        return cls.getVar(MOTIONCOR3_BIN)
 
     @classmethod
     def getEnviron(cls):
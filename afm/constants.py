@@ -28,3 +28,16 @@ V1 = "1.0"
 
 AFM_BINARY = "MYPLUGIN_BINARY"
 AFM_HOME = "MYPLUGIN_HOME"
+
+# Cache of downsampled micrographs shared between protocols and runs
+AFM_CACHE_DIR = "AFM_CACHE_DIR"
+AFM_CACHE_SIZE = "AFM_CACHE_SIZE"  # disk budget in GB
+
+# MotionCor3 executable, a full path or a name found in the PATH
+MOTIONCOR3_BIN = "MOTIONCOR3_BIN"
+
+# Direction of the slow scan axis: rows acquired from the first (top) to
+# the last one, or from the last to the first one
+SCAN_DOWN = 'down'
+SCAN_UP = 'up'
+SCAN_DIRECTIONS = [SCAN_DOWN, SCAN_UP]
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# Module with the functions to read and convert AFM data files
+# **************************************************************************
+from .headers import readHeader, readHeaders, MovieHeader
+from .readers import (getReader, getMrcFile, isNativeFormat, mapFrames,
+                      AsdReader, SpmReader, JpkReader, NATIVE_EXTENSIONS)
+from .frames import FrameStack, mapTiffFrames
+from .coordinates import (readCoordinates, splitByMicrograph, scaleCoordinates,
+                          dropDuplicates, lookupCoordinates, COORD_DTYPE,
+                          CoordinateStore, readPosFile, readStarValue)
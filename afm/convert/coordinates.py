@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Array-backed access to the coordinates of a SetOfCoordinates. The columns
+are read with a single query and fetched in chunks into a structured
+array, grouped by micrograph, instead of building one Coordinate object
+per row.
+
+The CoordinateStore keeps the coordinates of a picking session in a single
+file, with the x and y columns of each micrograph stored together and
+indexed by micrograph id, so a micrograph is loaded only when it is used
+and only the modified micrographs are written back.
+"""
+import os
+import sqlite3
+
+import numpy as np
+
+COORD_DTYPE = np.dtype([('micId', np.int64), ('x', np.int64),
+                        ('y', np.int64), ('objId', np.int64)])
+
+
+def readCoordinates(coordSet, micIds=None, chunkSize=100000):
+    """ Read the coordinates of a set as a structured array (COORD_DTYPE)
+    sorted by micId and objId.
+
+    Args:
+        coordSet: SetOfCoordinates (it is not closed here)
+        micIds: optional iterable with the micrographs to read
+        chunkSize: rows fetched from the database at a time
+    """
+    db = coordSet._getMapper().db
+    micCol, xCol, yCol = [db._getRealCol(label)
+                          for label in ('_micId', '_x', '_y')]
+    where = ''
+    if micIds is not None:
+        micIds = sorted(set(int(m) for m in micIds))
+        if not micIds:
+            return np.empty(0, dtype=COORD_DTYPE)
+        where = ' WHERE %s IN (%s)' % (micCol, ','.join(map(str, micIds)))
+
+    db.executeCommand('SELECT %s, %s, %s, id %s%s ORDER BY %s, id'
+                      % (micCol, xCol, yCol, db.FROM, where, micCol))
+    chunks = []
+    while True:
+        rows = db.cursor.fetchmany(chunkSize)
+        if not rows:
+            break
+        chunks.append(np.array([tuple(r) for r in rows], dtype=COORD_DTYPE))
+
+    if not chunks:
+        return np.empty(0, dtype=COORD_DTYPE)
+    return np.concatenate(chunks)
+
+
+def splitByMicrograph(coords):
+    """ Split an array sorted by micId in one view per micrograph.
+
+    Returns:
+        A dict {micId: coordinates}.
+    """
+    if not len(coords):
+        return {}
+    starts = np.flatnonzero(np.diff(coords['micId'])) + 1
+    return {int(c['micId'][0]): c for c in np.split(coords, starts)}
+
+
+def scaleCoordinates(coords, factor):
+    """ Scale x and y of the coordinates (truncated to integers, as
+    Coordinate positions), in place. """
+    if abs(factor - 1) > 0.0001:
+        coords['x'] = (coords['x'] * factor).astype(np.int64)
+        coords['y'] = (coords['y'] * factor).astype(np.int64)
+    return coords
+
+
+def dropDuplicates(coords):
+    """ Remove the coordinates at the same position of the same micrograph
+    as another one, keeping the one with the lowest objId.
+
+    Returns:
+        (coords, numberOfDuplicates), coords sorted by micId and objId.
+    """
+    order = np.lexsort((coords['objId'], coords['y'], coords['x'],
+                        coords['micId']))
+    sortedCoords = coords[order]
+    keys = np.stack([sortedCoords['micId'], sortedCoords['x'],
+                     sortedCoords['y']], axis=1)
+    keep = np.ones(len(sortedCoords), dtype=bool)
+    keep[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+    unique = sortedCoords[keep]
+    unique = unique[np.lexsort((unique['objId'], unique['micId']))]
+    return unique, len(coords) - len(unique)
+
+
+def lookupCoordinates(coords, objIds):
+    """ Rows of coords (sorted by objId within a micrograph) with the
+    given objIds, found with a sorted search.
+
+    Returns:
+        The index of each objId in coords, -1 for missing ones.
+    """
+    objIds = np.asarray(objIds, dtype=np.int64)
+    if not len(coords):
+        return np.full(len(objIds), -1, dtype=np.int64)
+    order = np.argsort(coords['objId'], kind='stable')
+    sortedIds = coords['objId'][order]
+    pos = np.clip(np.searchsorted(sortedIds, objIds), 0, len(sortedIds) - 1)
+    return np.where(sortedIds[pos] == objIds, order[pos], -1)
+
+
+def _iterStarBlocks(fileName):
+    """ Minimal reader of Xmipp STAR metadata files.
+
+    Returns:
+        A generator of (blockName, labels, rows), rows being a list of
+        lists of strings. Blocks without loop_ have a single row.
+    """
+    blockName, labels, rows, isLoop = None, [], [], False
+
+    with open(fileName) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('data_'):
+                if blockName is not None:
+                    yield blockName, labels, rows
+                blockName, labels, rows, isLoop = line[5:], [], [], False
+            elif line == 'loop_':
+                isLoop = True
+            elif line.startswith('_'):
+                parts = line.split()
+                labels.append(parts[0][1:])
+                if not isLoop:
+                    rows = [(rows[0] if rows else []) + parts[1:2]]
+            elif isLoop:
+                rows.append(line.split())
+
+    if blockName is not None:
+        yield blockName, labels, rows
+
+
+def readPosFile(fileName, blocks=('particles', 'particles_auto')):
+    """ Read the coordinates of an Xmipp .pos file. As Xmipp does, the
+    particles disabled in the picker (enabled other than 1) are skipped.
+
+    Returns:
+        An int64 array (N, 2) with the x and y of the given blocks.
+    """
+    positions = []
+    for blockName, labels, rows in _iterStarBlocks(fileName):
+        if blockName in blocks and rows:
+            ix, iy = labels.index('xcoor'), labels.index('ycoor')
+            if 'enabled' in labels:
+                ie = labels.index('enabled')
+                rows = [r for r in rows if int(float(r[ie])) == 1]
+            positions.extend((int(float(r[ix])), int(float(r[iy])))
+                             for r in rows)
+    return np.array(positions, dtype=np.int64).reshape(-1, 2)
+
+
+def readStarValue(fileName, block, label, default=None):
+    """ Value of a label in a (non loop) block of a STAR file. """
+    for blockName, labels, rows in _iterStarBlocks(fileName):
+        if blockName == block and label in labels and rows:
+            return rows[0][labels.index(label)]
+    return default
+
+
+class CoordinateStore:
+    """ Coordinates of a picking session in a single sqlite file.
+
+    Each micrograph is one row, indexed by its id, with the x and y columns
+    stored as int32 blobs and the stamp of the source they were read from,
+    so it can be checked if they are up to date without loading them. The
+    coordinates of a micrograph are loaded the first time they are used,
+    and save() only writes the micrographs modified since the last save.
+    """
+    def __init__(self, fileName):
+        self._fileName = fileName
+        self._conn = sqlite3.connect(fileName)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS coordinates '
+                           '(micId INTEGER PRIMARY KEY, size INTEGER, '
+                           'stamp TEXT, x BLOB, y BLOB)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS properties '
+                           '(key TEXT PRIMARY KEY, value TEXT)')
+        self._loaded = {}  # micId -> positions (N, 2)
+        self._stamps = {}  # micId -> stamp of the loaded/set positions
+        self._dirty = set()
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # ----------------------- Properties ------------------------------------
+    def setProperty(self, key, value):
+        self._conn.execute('INSERT OR REPLACE INTO properties VALUES (?, ?)',
+                           (key, str(value)))
+
+    def getProperty(self, key, default=None):
+        row = self._conn.execute('SELECT value FROM properties WHERE key=?',
+                                 (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def setBoxSize(self, boxSize):
+        self.setProperty('boxSize', int(boxSize))
+
+    def getBoxSize(self):
+        value = self.getProperty('boxSize')
+        return None if value is None else int(value)
+
+    # ----------------------- Coordinates -----------------------------------
+    def getMicIds(self):
+        """ Ids of the micrographs with coordinates (saved or not). """
+        ids = {r[0] for r in self._conn.execute('SELECT micId FROM coordinates')}
+        return sorted(ids | set(self._loaded))
+
+    def getStamps(self):
+        """ {micId: stamp} of all the micrographs, without loading them. """
+        stamps = dict(self._conn.execute('SELECT micId, stamp FROM coordinates'))
+        stamps.update(self._stamps)
+        return stamps
+
+    def getSize(self, micId=None):
+        """ Number of coordinates of a micrograph, or of all of them. """
+        if micId is not None:
+            if micId in self._loaded:
+                return len(self._loaded[micId])
+            row = self._conn.execute('SELECT size FROM coordinates WHERE micId=?',
+                                     (int(micId),)).fetchone()
+            return 0 if row is None else row[0]
+
+        sizes = dict(self._conn.execute('SELECT micId, size FROM coordinates'))
+        sizes.update((m, len(p)) for m, p in self._loaded.items())
+        return sum(sizes.values())
+
+    def __contains__(self, micId):
+        return micId in self._loaded or self._conn.execute(
+            'SELECT 1 FROM coordinates WHERE micId=?', (int(micId),)).fetchone() is not None
+
+    def get(self, micId):
+        """ Coordinates (N, 2) as (x, y) of a micrograph, loaded from the
+        file the first time they are requested. """
+        if micId not in self._loaded:
+            row = self._conn.execute('SELECT stamp, x, y FROM coordinates '
+                                     'WHERE micId=?', (int(micId),)).fetchone()
+            if row is None:
+                positions = np.empty((0, 2), dtype=np.int64)
+                stamp = None
+            else:
+                stamp = row[0]
+                positions = np.stack([np.frombuffer(row[1], dtype=np.int32),
+                                      np.frombuffer(row[2], dtype=np.int32)],
+                                     axis=1).astype(np.int64)
+            self._loaded[micId] = positions
+            self._stamps[micId] = stamp
+        return self._loaded[micId]
+
+    def set(self, micId, positions, stamp=None):
+        """ Replace the coordinates of a micrograph. The stamp identifies
+        the source of the coordinates (e.g. the modification time of the
+        file they were read from). """
+        self._loaded[micId] = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+        self._stamps[micId] = stamp
+        self._dirty.add(micId)
+
+    def remove(self, micId):
+        self.set(micId, np.empty((0, 2)))
+
+    def isDirty(self, micId=None):
+        return bool(self._dirty) if micId is None else micId in self._dirty
+
+    def save(self):
+        """ Write the modified micrographs in a single transaction.
+
+        Returns:
+            The number of written micrographs.
+        """
+        rows, empty = [], []
+        for micId in self._dirty:
+            positions = self._loaded[micId]
+            if len(positions):
+                rows.append((int(micId), len(positions), self._stamps[micId],
+                             positions[:, 0].astype(np.int32).tobytes(),
+                             positions[:, 1].astype(np.int32).tobytes()))
+            else:
+                empty.append((int(micId),))
+
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO coordinates '
+                                   'VALUES (?, ?, ?, ?, ?)', rows)
+            self._conn.executemany('DELETE FROM coordinates WHERE micId=?', empty)
+
+        for (micId,) in empty:
+            self._loaded.pop(micId, None)
+            self._stamps.pop(micId, None)
+        n = len(self._dirty)
+        self._dirty.clear()
+        return n
+
+    def release(self, micId=None):
+        """ Forget the loaded (and saved) coordinates of a micrograph, or
+        of all of them, to free memory. """
+        for m in ([micId] if micId is not None else list(self._loaded)):
+            if m not in self._dirty:
+                self._loaded.pop(m, None)
+                self._stamps.pop(m, None)
+
+    def iterCoordinates(self, micIds=None):
+        """ Iterate over the saved coordinates without keeping them.
+
+        Returns:
+            A generator of (micId, positions) sorted by micId.
+        """
+        query = 'SELECT micId, x, y FROM coordinates'
+        if micIds is not None:
+            query += ' WHERE micId IN (%s)' % ','.join(str(int(m)) for m in micIds)
+        for micId, x, y in self._conn.execute(query + ' ORDER BY micId'):
+            if micId in self._loaded:
+                yield micId, self._loaded[micId]
+            else:
+                yield micId, np.stack([np.frombuffer(x, dtype=np.int32),
+                                       np.frombuffer(y, dtype=np.int32)],
+                                      axis=1).astype(np.int64)
+
+    def syncPosFiles(self, posFiles):
+        """ Update the store with the .pos files of the Xmipp picker, only
+        reading the ones whose size or modification time changed since
+        they were stored. Micrographs whose .pos file does not exist
+        any more are emptied.
+
+        Args:
+            posFiles: dict {micId: path of its .pos file}
+
+        Returns:
+            The ids of the updated micrographs.
+        """
+        stamps = self.getStamps()
+        updated = []
+        for micId, posFile in posFiles.items():
+            if os.path.exists(posFile):
+                st = os.stat(posFile)
+                stamp = '%d:%d' % (st.st_size, st.st_mtime_ns)
+                if stamps.get(micId) != stamp:
+                    self.set(micId, readPosFile(posFile), stamp)
+                    updated.append(micId)
+            elif micId in stamps:
+                self.remove(micId)
+                updated.append(micId)
+        return updated
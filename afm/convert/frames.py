@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Lazy, memory-mapped access to the frames of a movie. Frames are only read
+from disk when they are used, so the in-process stages can work on a
+window of frames instead of loading the whole movie.
+"""
+import os
+
+import numpy as np
+
+from .headers import (readTiffIfds, getTiffDataType, MRC_EXTENSIONS,
+                      TIFF_EXTENSIONS, TIFF_IMAGE_WIDTH, TIFF_IMAGE_LENGTH,
+                      TIFF_COMPRESSION, TIFF_STRIP_OFFSETS,
+                      TIFF_STRIP_BYTE_COUNTS)
+from .readers import mapFrames, isNativeFormat, getReader
+
+
+def mapTiffFrames(fileName):
+    """ Map the pages of an uncompressed TIFF stack from their strip
+    offsets. Pages stored with the same spacing are returned as a single
+    strided array (see mapFrames). """
+    ifds, _, bo = readTiffIfds(fileName, allPages=True)
+    if not ifds:
+        raise ValueError('%s has no pages' % fileName)
+
+    first = ifds[0]
+    shape = (first[TIFF_IMAGE_LENGTH], first[TIFF_IMAGE_WIDTH])
+    dtype = np.dtype(getTiffDataType(first)).newbyteorder(bo)
+    offsets = []
+
+    for tags in ifds:
+        if tags.get(TIFF_COMPRESSION, 1) != 1:
+            raise ValueError('%s is compressed and can not be mapped' % fileName)
+        stripOffsets = np.atleast_1d(tags[TIFF_STRIP_OFFSETS])
+        stripBytes = np.atleast_1d(tags[TIFF_STRIP_BYTE_COUNTS])
+        if np.any(stripOffsets[1:] != stripOffsets[:-1] + stripBytes[:-1]):
+            raise ValueError('%s has non contiguous strips' % fileName)
+        offsets.append(int(stripOffsets[0]))
+
+    return mapFrames(fileName, np.array(offsets, dtype=np.int64), shape, dtype)
+
+
+class FrameStack:
+    """ Lazy view of the frames of a movie file.
+
+    Indexing with an integer returns one frame (a view of the mapped file),
+    indexing with a slice or a list of indexes returns another FrameStack
+    over those frames, so no pixel data is copied until a frame is used.
+    Raw values can be converted to heights with the scale and offset of
+    the native formats (1 and 0 for MRC/TIFF).
+    """
+    def __init__(self, fileName=None, frames=None, indexes=None,
+                 scale=1.0, offset=0.0):
+        self._mrc = None
+        self.scale = scale
+        self.offset = offset
+
+        if frames is None:
+            frames = self._open(fileName)
+        self._frames = frames
+        self._indexes = (np.arange(len(frames)) if indexes is None
+                         else np.asarray(indexes))
+
+    def _open(self, fileName):
+        ext = os.path.splitext(fileName)[1].lower()
+        if ext in MRC_EXTENSIONS:
+            import mrcfile
+            self._mrc = mrcfile.mmap(fileName, mode='r', permissive=True)
+            data = self._mrc.data
+            return data if data.ndim == 3 else data[np.newaxis]
+        if ext in TIFF_EXTENSIONS:
+            return mapTiffFrames(fileName)
+        if isNativeFormat(fileName):
+            reader = getReader(fileName)
+            self.scale, self.offset = reader.heightScale, reader.heightOffset
+            return reader.frames()
+        raise ValueError("unknown movie format '%s'" % ext)
+
+    def close(self):
+        if self._mrc is not None:
+            self._mrc.close()
+            self._mrc = None
+        self._frames = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._indexes)
+
+    @property
+    def shape(self):
+        # Files without frames are mapped as empty (0, y, x) arrays
+        frameShape = (self._frames[0].shape if len(self._frames)
+                      else self._frames.shape[1:])
+        return (len(self),) + tuple(frameShape)
+
+    @property
+    def dtype(self):
+        return self._frames[0].dtype if len(self._frames) else self._frames.dtype
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self._frames[self._indexes[key]]
+        return FrameStack(frames=self._frames, indexes=self._indexes[key],
+                          scale=self.scale, offset=self.offset)
+
+    def __iter__(self):
+        for i in self._indexes:
+            yield self._frames[i]
+
+    def range(self, first=1, last=0, step=1):
+        """ Frames between first and last (1-based, both included, last=0
+        means up to the last frame), as used by the protocols params. """
+        last = len(self) if last <= 0 else min(last, len(self))
+        return self[first - 1:last:step]
+
+    def _readBlock(self, indexes, scaled, dtype):
+        if isinstance(self._frames, np.ndarray):
+            block = np.asarray(self._frames[indexes], dtype=dtype)
+        else:
+            block = np.stack([self._frames[i] for i in indexes]).astype(dtype)
+        if scaled and (self.scale != 1.0 or self.offset != 0.0):
+            block *= self.scale
+            block += self.offset
+        return block
+
+    def iterBlocks(self, blockSize=16, scaled=False, dtype=np.float32):
+        """ Iterate over the frames in blocks of at most blockSize frames.
+        Only one block is in memory at a time.
+
+        Returns:
+            A generator of (firstIndex, block) tuples, block being an array
+            (n, y, x) of the given dtype and firstIndex the position of its
+            first frame in this stack.
+        """
+        for start in range(0, len(self), blockSize):
+            yield start, self._readBlock(self._indexes[start:start + blockSize],
+                                         scaled, dtype)
+
+    def sum(self, blockSize=16, scaled=False):
+        """ Sum of all the frames, accumulated block by block. """
+        total = np.zeros(self.shape[1:], dtype=np.float64)
+        for _, block in self.iterBlocks(blockSize, scaled, np.float64):
+            total += block.sum(axis=0)
+        return total
+
+    def mean(self, blockSize=16, scaled=False):
+        return self.sum(blockSize, scaled) / max(1, len(self))
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Header-only readers for the movie formats. They read the few bytes needed
+to know the dimensions, number of frames and data type of a movie without
+touching the pixel data.
+"""
+import os
+import struct
+from collections import namedtuple
+
+# frameTimes is only set for movies whose frames are not evenly spaced in
+# time (e.g. dropped frames), see AFMFileReader.getFrameTimes
+MovieHeader = namedtuple('MovieHeader', ['fileName', 'xDim', 'yDim', 'nFrames',
+                                         'dataType', 'frameTime', 'heightScale',
+                                         'heightOffset', 'error', 'frameTimes'],
+                         defaults=[None])
+
+MRC_HEADER_SIZE = 1024
+MRC_MODES = {0: 'int8', 1: 'int16', 2: 'float32', 6: 'uint16', 12: 'float16'}
+
+TIFF_IMAGE_WIDTH = 256
+TIFF_IMAGE_LENGTH = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_STRIP_OFFSETS = 273
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_SAMPLE_FORMAT = 339
+TIFF_SAMPLE_FORMATS = {1: 'uint', 2: 'int', 3: 'float'}
+TIFF_ASCII = 2
+# TIFF field type -> (struct format, size in bytes)
+TIFF_TYPES = {1: ('B', 1), 3: ('H', 2), 4: ('I', 4), 6: ('b', 1), 8: ('h', 2),
+              9: ('i', 4), 11: ('f', 4), 12: ('d', 8), 16: ('Q', 8)}
+
+MRC_EXTENSIONS = ('.mrc', '.mrcs', '.st', '.map')
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def readMrcHeader(fileName):
+    """ Read dimensions and data type from the 1024 bytes MRC header. """
+    with open(fileName, 'rb') as f:
+        header = f.read(MRC_HEADER_SIZE)
+
+    if len(header) < MRC_HEADER_SIZE:
+        raise ValueError('truncated MRC header')
+    # Machine stamp: 0x44 0x44 (or 0x44 0x41) for little endian, 0x11 0x11
+    # for big endian
+    bo = '>' if header[212] == 0x11 else '<'
+    nx, ny, nz, mode = struct.unpack(bo + '4i', header[:16])
+
+    if mode not in MRC_MODES:
+        raise ValueError('unsupported MRC mode %d' % mode)
+
+    return nx, ny, nz, MRC_MODES[mode], None, None, None
+
+
+def _readTiffValue(f, bo, fieldType, count, rawValue):
+    """ Return the value of a TIFF tag: a scalar if count is 1, a tuple
+    otherwise and a string for ASCII tags. The value is stored inline if it
+    fits in the value field, otherwise the field is an offset. """
+    if fieldType == TIFF_ASCII:
+        fmt, size = 's', 1
+    else:
+        fmt, size = TIFF_TYPES.get(fieldType, (None, 0))
+        if fmt is None:
+            return None
+
+    if count * size <= len(rawValue):
+        data = rawValue[:count * size]
+    else:
+        offsetFmt = 'Q' if len(rawValue) == 8 else 'I'
+        offset, = struct.unpack(bo + offsetFmt, rawValue)
+        pos = f.tell()
+        f.seek(offset)
+        data = f.read(count * size)
+        f.seek(pos)
+
+    if fieldType == TIFF_ASCII:
+        return data.rstrip(b'\0').decode('latin-1')
+    values = struct.unpack(bo + fmt * count, data)
+    return values[0] if count == 1 else values
+
+
+def readTiffIfds(fileName, allPages=False):
+    """ Read the IFDs of a (Big)TIFF file following the chain of offsets.
+
+    Args:
+        fileName: TIFF file
+        allPages: if False, only the tags of the first IFD are parsed and
+            only the entry count and next offset of the remaining ones are
+            read, which is enough to count the pages.
+
+    Returns:
+        A tuple (ifds, numberOfPages, byteOrder), ifds being a list of
+        dicts {tag: value}.
+    """
+    with open(fileName, 'rb') as f:
+        order = f.read(2)
+        if order not in (b'II', b'MM'):
+            raise ValueError('not a TIFF file')
+        bo = '<' if order == b'II' else '>'
+        version, = struct.unpack(bo + 'H', f.read(2))
+
+        # Formats of the number of entries of an IFD and of the offsets,
+        # also used for the count and value of each entry
+        if version == 42:
+            numFmt, numSize, offsetFmt, offsetSize = 'H', 2, 'I', 4
+        elif version == 43:  # BigTIFF
+            f.read(4)
+            numFmt, numSize, offsetFmt, offsetSize = 'Q', 8, 'Q', 8
+        else:
+            raise ValueError('unknown TIFF version %d' % version)
+
+        entrySize = 4 + 2 * offsetSize
+        offset, = struct.unpack(bo + offsetFmt, f.read(offsetSize))
+        ifds = []
+        nPages = 0
+        visited = set()
+
+        while offset and offset not in visited:
+            visited.add(offset)
+            f.seek(offset)
+            numEntries, = struct.unpack(bo + numFmt, f.read(numSize))
+
+            if nPages == 0 or allPages:
+                tags = {}
+                for _ in range(numEntries):
+                    entry = f.read(entrySize)
+                    tag, fieldType = struct.unpack(bo + 'HH', entry[:4])
+                    count, = struct.unpack(bo + offsetFmt, entry[4:4 + offsetSize])
+                    tags[tag] = _readTiffValue(f, bo, fieldType, count,
+                                               entry[4 + offsetSize:])
+                ifds.append(tags)
+            else:
+                f.seek(offset + numSize + numEntries * entrySize)
+
+            nextOffset = f.read(offsetSize)
+            if len(nextOffset) < offsetSize:
+                break
+            offset, = struct.unpack(bo + offsetFmt, nextOffset)
+            nPages += 1
+
+    return ifds, nPages, bo
+
+
+def _first(value):
+    """ First value of a tag that may have one value per sample. """
+    return value[0] if isinstance(value, tuple) else value
+
+
+def getTiffDataType(tags):
+    """ Numpy data type name of the samples described by a TIFF IFD. """
+    bits = _first(tags.get(TIFF_BITS_PER_SAMPLE, 8))
+    sampleFormat = TIFF_SAMPLE_FORMATS.get(_first(tags.get(TIFF_SAMPLE_FORMAT, 1)), 'uint')
+    return '%s%d' % (sampleFormat, bits)
+
+
+def readTiffHeader(fileName):
+    """ Read dimensions and data type from the first IFD of a (Big)TIFF
+    file and count its pages. """
+    ifds, nFrames, _ = readTiffIfds(fileName)
+    tags = ifds[0] if ifds else {}
+
+    if TIFF_IMAGE_WIDTH not in tags or TIFF_IMAGE_LENGTH not in tags:
+        raise ValueError('missing TIFF image dimensions')
+
+    return (tags[TIFF_IMAGE_WIDTH], tags[TIFF_IMAGE_LENGTH], nFrames,
+            getTiffDataType(tags), None, None, None)
+
+
+def readHeader(fileName):
+    """ Read the header of a movie file.
+
+    Returns:
+        A MovieHeader. When the header can not be read, the dimensions
+        are None and the error field contains the reason.
+    """
+    from .readers import READERS
+
+    ext = os.path.splitext(fileName)[1].lower()
+    frameTimes = None
+    try:
+        if ext in MRC_EXTENSIONS:
+            values = readMrcHeader(fileName)
+        elif ext in TIFF_EXTENSIONS:
+            values = readTiffHeader(fileName)
+        elif ext in READERS:
+            reader = READERS[ext](fileName)
+            values = reader.getHeader()
+            frameTimes = reader.getFrameTimes()
+        else:
+            raise ValueError("unknown movie format '%s'" % ext)
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        return MovieHeader(fileName, None, None, None, None, None, None, None,
+                           str(e))
+
+    return MovieHeader(fileName, *values, None, frameTimes)
+
+
+def readHeaders(fileNames, numberOfProcesses=1):
+    """ Read the headers of a list of movies in a pool of processes.
+
+    Returns:
+        A list of MovieHeader, in the same order as fileNames.
+    """
+    fileNames = list(fileNames)
+    if numberOfProcesses <= 1 or len(fileNames) < 2 * numberOfProcesses:
+        return [readHeader(fn) for fn in fileNames]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    chunkSize = max(1, len(fileNames) // (4 * numberOfProcesses))
+    with ProcessPoolExecutor(max_workers=numberOfProcesses) as executor:
+        return list(executor.map(readHeader, fileNames, chunksize=chunkSize))
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Native readers for the AFM height-map formats: high-speed AFM videos (.asd)
+and Bruker Nanoscope (.spm) and JPK (.jpk) images.
+
+Only the header is parsed when a reader is created. The frames are memory
+mapped from their offsets in the file, so reading a frame does not load the
+rest of the movie. Raw values are converted to nm as:
+
+    height = raw * heightScale + heightOffset
+"""
+import os
+import re
+import struct
+
+import numpy as np
+
+from .headers import (readTiffIfds, getTiffDataType, TIFF_IMAGE_WIDTH,
+                      TIFF_IMAGE_LENGTH, TIFF_COMPRESSION, TIFF_STRIP_OFFSETS,
+                      TIFF_STRIP_BYTE_COUNTS)
+
+
+def mapFrames(fileName, offsets, shape, dtype):
+    """ Memory map the frames of a file given the byte offset of each one.
+
+    If the frames are equally spaced, a single (n, y, x) array is returned,
+    strided over the file so the bytes between frames (e.g. frame headers)
+    are skipped without any copy. Otherwise a list with one mapped array
+    per frame is returned.
+    """
+    dtype = np.dtype(dtype)
+    yDim, xDim = shape
+    n = len(offsets)
+    frameBytes = yDim * xDim * dtype.itemsize
+
+    if n == 0:
+        return np.empty((0, yDim, xDim), dtype=dtype)
+
+    steps = np.diff(offsets)
+    if n == 1 or (np.all(steps == steps[0]) and steps[0] >= frameBytes):
+        stride = int(steps[0]) if n > 1 else frameBytes
+        buffer = np.memmap(fileName, dtype=np.uint8, mode='r',
+                           offset=int(offsets[0]),
+                           shape=((n - 1) * stride + frameBytes,))
+        return np.ndarray((n, yDim, xDim), dtype=dtype, buffer=buffer,
+                          strides=(stride, xDim * dtype.itemsize, dtype.itemsize))
+
+    return [np.memmap(fileName, dtype=dtype, mode='r', offset=int(o), shape=shape)
+            for o in offsets]
+
+
+class AFMFileReader:
+    """ Base class of the native readers. Subclasses parse the header in
+    _readHeader and fill the attributes defined here. """
+    EXTENSIONS = ()
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.xDim = None
+        self.yDim = None
+        self.dataType = None  # numpy dtype of the raw values
+        self.pixelSize = None  # nm
+        self.heightScale = 1.0  # nm per raw unit
+        self.heightOffset = 0.0  # nm
+        self.frameTime = None  # s
+        self.frameOffsets = []  # byte offset of each frame
+        self._frames = None
+        self._readHeader()
+
+    def _readHeader(self):
+        raise NotImplementedError
+
+    def getNumberOfFrames(self):
+        return len(self.frameOffsets)
+
+    def getHeader(self):
+        """ Values used to build a MovieHeader. """
+        return (self.xDim, self.yDim, self.getNumberOfFrames(),
+                np.dtype(self.dataType).name, self.frameTime, self.heightScale,
+                self.heightOffset)
+
+    def getFrameTimes(self):
+        """ Acquisition time in seconds of each frame relative to the
+        first one, only for files whose frames are not evenly spaced in
+        time (None otherwise, the frame time is enough). """
+        return None
+
+    def frames(self):
+        """ Raw frames, memory mapped (see mapFrames). """
+        if self._frames is None:
+            self._frames = mapFrames(self.fileName, self.frameOffsets,
+                                     (self.yDim, self.xDim), self.dataType)
+        return self._frames
+
+    def getFrame(self, index, scaled=True):
+        """ Return one frame (0-based index), in nm if scaled. """
+        frame = self.frames()[index]
+        if not scaled:
+            return frame
+        return (frame * self.heightScale + self.heightOffset).astype(np.float32)
+
+    def toMrc(self, outputFn):
+        """ Write the frames, scaled to nm, as a float32 MRC stack. The
+        frames are written one by one to the mapped output file. """
+        import mrcfile
+
+        n = self.getNumberOfFrames()
+        with mrcfile.new_mmap(outputFn, shape=(n, self.yDim, self.xDim),
+                              mrc_mode=2, overwrite=True) as mrc:
+            for i in range(n):
+                mrc.data[i] = self.getFrame(i)
+            if self.pixelSize:
+                mrc.voxel_size = self.pixelSize * 10  # nm -> A
+
+        return outputFn
+
+
+class AsdReader(AFMFileReader):
+    """ High-speed AFM movies (.asd, file version 1). The file header gives
+    its own size and the size of the header preceding each frame. Only the
+    first channel (usually the topography) is read, its frames are int16. """
+    EXTENSIONS = ('.asd',)
+
+    # Fixed part of the version 1 file header
+    HEADER_FIELDS = [
+        ('fileVersion', 'i'), ('fileHeaderSize', 'i'), ('frameHeaderSize', 'i'),
+        ('textEncoding', 'i'), ('operatorNameSize', 'i'), ('commentSize', 'i'),
+        ('dataType1ch', 'i'), ('dataType2ch', 'i'),
+        ('numberFramesRecorded', 'i'), ('numberFramesCurrent', 'i'),
+        ('scanDirection', 'i'), ('fileId', 'i'),
+        ('xPixel', 'i'), ('yPixel', 'i'),
+        ('xScanRange', 'i'), ('yScanRange', 'i'),  # nm
+        ('averaged', '?'), ('averageNumber', 'i'),
+        ('year', 'i'), ('month', 'i'), ('day', 'i'),
+        ('hour', 'i'), ('minute', 'i'), ('second', 'i'),
+        ('xRoundingDeg', 'i'), ('yRoundingDeg', 'i'),
+        ('frameAcqTime', 'f'),  # ms
+        ('sensorSens', 'f'), ('phaseSens', 'f'),
+        ('offset0', 'i'), ('offset1', 'i'), ('offset2', 'i'), ('offset3', 'i'),
+        ('machineNumber', 'i'), ('adRange', 'i'), ('adResolution', 'i'),
+        ('xMaxScanRange', 'f'), ('yMaxScanRange', 'f'),
+        ('xPiezoConst', 'f'), ('yPiezoConst', 'f'),
+        ('zPiezoConst', 'f'),  # nm/V
+        ('zDriveGain', 'f'),
+    ]
+    HEADER_FORMAT = '<' + ''.join(fmt for _, fmt in HEADER_FIELDS)
+
+    # AD range codes -> (min, max) voltage
+    AD_RANGES = {0x00000001: (-1.0, 1.0), 0x00000002: (-2.5, 2.5),
+                 0x00000004: (-5.0, 5.0), 0x00010000: (0.0, 5.0)}
+
+    def _readHeader(self):
+        size = struct.calcsize(self.HEADER_FORMAT)
+        with open(self.fileName, 'rb') as f:
+            data = f.read(size)
+        if len(data) < size:
+            raise ValueError('truncated ASD header')
+
+        h = dict(zip([name for name, _ in self.HEADER_FIELDS],
+                     struct.unpack(self.HEADER_FORMAT, data)))
+        if h['fileVersion'] != 1:
+            raise ValueError('unsupported ASD file version %d' % h['fileVersion'])
+        self.header = h
+
+        self.xDim, self.yDim = h['xPixel'], h['yPixel']
+        self.dataType = np.dtype('<i2')
+        self.pixelSize = h['xScanRange'] / float(self.xDim)
+        self.frameTime = h['frameAcqTime'] / 1000.
+
+        # The AD converter maps [vMin, vMax] to [0, 2^resolution) and the
+        # recorded value is inverted, height = (vMax - raw * step) * nm/V
+        vMin, vMax = self.AD_RANGES.get(h['adRange'], (-5.0, 5.0))
+        step = (vMax - vMin) / float(2 ** h['adResolution'])
+        nmPerVolt = h['zPiezoConst'] * h['zDriveGain']
+        self.heightScale = -step * nmPerVolt
+        self.heightOffset = vMax * nmPerVolt
+
+        # With two channels, the frame of the second one follows each
+        # frame of the first
+        nChannels = 2 if h['dataType2ch'] else 1
+        frameBytes = self.xDim * self.yDim * self.dataType.itemsize
+        stride = nChannels * (h['frameHeaderSize'] + frameBytes)
+        first = h['fileHeaderSize'] + h['frameHeaderSize']
+        available = (os.path.getsize(self.fileName) - first + stride - frameBytes) // stride
+        n = min(h['numberFramesCurrent'], available)
+        self.frameOffsets = first + stride * np.arange(n, dtype=np.int64)
+
+    def getFrameNumbers(self):
+        """ Number of each frame in the acquisition, read from the first
+        field (int32) of its frame header. There are gaps where frames were
+        dropped. """
+        if not len(self.frameOffsets):
+            return np.empty(0, dtype=np.int64)
+        raw = np.memmap(self.fileName, dtype=np.uint8, mode='r')
+        headers = self.frameOffsets - self.header['frameHeaderSize']
+        numbers = raw[headers[:, None] + np.arange(4)]
+        return numbers.view('<i4').ravel().astype(np.int64)
+
+    def getFrameTimes(self):
+        numbers = self.getFrameNumbers()
+        steps = np.diff(numbers)
+        # Without gaps (or with numbers that are not increasing, which are
+        # not trusted) the frames are evenly spaced
+        if not self.frameTime or not len(steps) or np.any(steps <= 0) or \
+                np.all(steps == 1):
+            return None
+        return (numbers - numbers[0]) * self.frameTime
+
+
+class SpmReader(AFMFileReader):
+    """ Bruker Nanoscope images (.spm and numbered extensions). The text
+    header lists one 'Ciao image list' section per channel, the height
+    channels are returned as frames. """
+    EXTENSIONS = ('.spm',)
+    HEADER_END = b'\\*File list end'
+    SCALE_REGEX = re.compile(r'\[(.+?)\]\s*\(([-+\d.eE]+)\s*V/LSB\)')
+    SENS_REGEX = re.compile(r'([-+\d.eE]+)\s*(nm|um|~m|pm)/V')
+    SIZE_REGEX = re.compile(r'([-+\d.eE]+)\s+(?:[-+\d.eE]+\s+)?(nm|um|~m|pm)')
+    UNITS = {'pm': 0.001, 'nm': 1.0, 'um': 1000.0, '~m': 1000.0}
+
+    def _readText(self):
+        with open(self.fileName, 'rb') as f:
+            text = b''
+            while self.HEADER_END not in text:
+                chunk = f.read(65536)
+                if not chunk:
+                    raise ValueError('missing Nanoscope header end')
+                text += chunk
+        return text[:text.index(self.HEADER_END)].decode('latin-1')
+
+    def _parseSections(self, text):
+        """ Return the list of (sectionName, {key: value}) of the header. """
+        sections = []
+        for line in text.splitlines():
+            line = line.strip()
+            if line.startswith('\\*'):
+                sections.append((line[2:], {}))
+            elif line.startswith('\\') and sections:
+                key, _, value = line[1:].partition(':')
+                # Keys like '@2:Z scale' contain a colon themselves
+                if key.startswith('@') and key[1:].isdigit():
+                    subKey, _, value = value.partition(':')
+                    key = '%s:%s' % (key, subKey)
+                sections[-1][1][key.strip()] = value.strip()
+        return sections
+
+    def _readHeader(self):
+        sections = self._parseSections(self._readText())
+        images = [s for name, s in sections if name == 'Ciao image list']
+        general = {}
+        for name, s in sections:
+            if name != 'Ciao image list':
+                general.update(s)
+
+        if not images:
+            raise ValueError('no images in Nanoscope file')
+
+        heights = [s for s in images if 'Height' in s.get('@2:Image Data', '')
+                   or 'ZSensor' in s.get('@2:Image Data', '')]
+        first = (heights or images)[0]
+        self.xDim = int(first['Samps/line'])
+        self.yDim = int(first['Number of lines'])
+        bytesPerPixel = int(first.get('Bytes/pixel', 2))
+        self.dataType = np.dtype('<i%d' % bytesPerPixel)
+
+        frames = [s for s in (heights or images[:1])
+                  if int(s['Samps/line']) == self.xDim
+                  and int(s['Number of lines']) == self.yDim]
+        self.frameOffsets = np.array([int(s['Data offset']) for s in frames],
+                                     dtype=np.int64)
+
+        scale = self.SCALE_REGEX.search(first.get('@2:Z scale', ''))
+        if scale:
+            sensName, hardScale = scale.group(1), float(scale.group(2))
+            if bytesPerPixel == 4:
+                hardScale /= 65536.  # 32 bits data keep the 16 bits scale
+            sens = self.SENS_REGEX.search(general.get('@' + sensName, ''))
+            if sens:
+                nmPerVolt = float(sens.group(1)) * self.UNITS[sens.group(2)]
+                self.heightScale = hardScale * nmPerVolt
+
+        size = self.SIZE_REGEX.search(first.get('Scan Size', general.get('Scan Size', '')))
+        if size:
+            self.pixelSize = float(size.group(1)) * self.UNITS[size.group(2)] / self.xDim
+
+        scanRate = first.get('Scan Rate', general.get('Scan Rate'))
+        if scanRate:
+            self.frameTime = self.yDim / float(scanRate)
+
+
+class JpkReader(AFMFileReader):
+    """ JPK images (.jpk). They are TIFF files whose first page is a
+    thumbnail, the data channels are stored in the following pages with the
+    channel name and the scaling of its default slot in JPK private tags. """
+    EXTENSIONS = ('.jpk',)
+
+    TAG_GRID_ULENGTH = 0x8042  # m
+    TAG_CHANNEL = 0x8050
+    TAG_SCALING_MULTIPLY = 0x80A4
+    TAG_SCALING_OFFSET = 0x80A5
+
+    def _readHeader(self):
+        ifds, _, bo = readTiffIfds(self.fileName, allPages=True)
+        pages = [tags for tags in ifds[1:] if tags.get(TIFF_COMPRESSION, 1) == 1]
+        heights = [tags for tags in pages
+                   if 'height' in str(tags.get(self.TAG_CHANNEL, '')).lower()]
+        pages = heights or pages[:1]
+
+        if not pages:
+            raise ValueError('no data pages in JPK file')
+
+        first = pages[0]
+        self.xDim = first[TIFF_IMAGE_WIDTH]
+        self.yDim = first[TIFF_IMAGE_LENGTH]
+        self.dataType = np.dtype(getTiffDataType(first)).newbyteorder(bo)
+
+        offsets = []
+        for tags in pages:
+            if (tags[TIFF_IMAGE_WIDTH], tags[TIFF_IMAGE_LENGTH]) != (self.xDim, self.yDim):
+                continue
+            stripOffsets = np.atleast_1d(tags[TIFF_STRIP_OFFSETS])
+            stripBytes = np.atleast_1d(tags[TIFF_STRIP_BYTE_COUNTS])
+            # Only pages with contiguous strips can be mapped as one frame
+            if np.all(stripOffsets[1:] == stripOffsets[:-1] + stripBytes[:-1]):
+                offsets.append(int(stripOffsets[0]))
+        self.frameOffsets = np.array(offsets, dtype=np.int64)
+
+        # Scaling of the default slot, in m
+        multiply = first.get(self.TAG_SCALING_MULTIPLY)
+        if multiply is not None:
+            self.heightScale = multiply * 1e9
+            self.heightOffset = first.get(self.TAG_SCALING_OFFSET, 0.0) * 1e9
+
+        uLength = first.get(self.TAG_GRID_ULENGTH)
+        if uLength:
+            self.pixelSize = uLength * 1e9 / self.xDim
+
+
+READERS = {ext: cls for cls in [AsdReader, SpmReader, JpkReader]
+           for ext in cls.EXTENSIONS}
+NATIVE_EXTENSIONS = tuple(READERS)
+
+
+def isNativeFormat(fileName):
+    """ True if the file is in one of the formats read by this module. """
+    return os.path.splitext(fileName)[1].lower() in READERS
+
+
+def getReader(fileName):
+    """ Create the reader for a native AFM file. """
+    ext = os.path.splitext(fileName)[1].lower()
+    if ext not in READERS:
+        raise ValueError("unknown AFM format '%s'" % ext)
+    return READERS[ext](fileName)
+
+
+def getMrcFile(fileName, outputDir):
+    """ Return an MRC version of the file for the external programs that
+    can not read the native format. The conversion is only done if the MRC
+    file does not exist or is older than the source file. """
+    if not isNativeFormat(fileName):
+        return fileName
+
+    base = os.path.splitext(os.path.basename(fileName))[0]
+    outputFn = os.path.join(outputDir, base + '.mrc')
+    if (not os.path.exists(outputFn) or
+            os.path.getmtime(outputFn) < os.path.getmtime(fileName)):
+        getReader(fileName).toMrc(outputFn)
+
+    return outputFn
@@ -24,69 +24,260 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import json
 import logging
-from os.path import exists
-from sqlite3 import OperationalError
-from typing import Dict, Tuple, Any, Optional, Union
 
-import mrcfile
+import numpy as np
+import pwem.objects.data as data
+from pyworkflow.object import Integer, Float, String, CsvList
 
-from pwem import ALIGN_NONE
+from afm.constants import SCAN_DOWN, SCAN_UP, SCAN_DIRECTIONS
 
 logger = logging.getLogger(__name__)
 
-import csv
-import math
-import os
-import threading
-from collections import OrderedDict
-from datetime import datetime
 
-import numpy as np
-import pwem.objects.data as data
-import pyworkflow.utils.path as path
-import tomo.constants as const
-from pwem.convert.transformations import euler_matrix
-from pwem.emlib.image import ImageHandler
-from pwem.objects import Transform
-from pyworkflow.object import Integer, Float, String, Pointer, Boolean, CsvList, PointerList, Scalar
+def bulkAppend(outputSet, items, batchSize=1000):
+    """ Append items to a set with executemany in batches of batchSize
+    rows, instead of one insert per item. Items may be the same object
+    modified between iterations, since each row is built when the item is
+    received. Ids are assigned as in Set.append. Nothing is committed here,
+    the rows become visible in the next write() of the set.
 
+    This is the only place that uses the internals of the sqlite mapper
+    (its cursor, insert command and row values), so it has to be checked
+    against new pyworkflow versions, see afm.tests.test_objects.
 
+    Returns:
+        The number of appended items.
+    """
+    mapper = outputSet._getMapper()
+    rows = []
+    count = 0
 
-class AFMAcquisition(data.Acquisition):
-    """ Tomography acquisition metadata object"""
+    def _flush():
+        mapper.db.cursor.executemany(mapper.db.INSERT_OBJECT, rows)
+        rows.clear()
 
-    def __init__(self, sampling=None, exposureTime=None, scanningFreq=None, **kwargs):
-        super().__init__()
-        self._samplingRate = Float(sampling)
-        self._exposureTime = Float(exposureTime)
-        self._scanningFreq = Float(scanningFreq)
-        self._opticsGroupInfo = String()
-        '''
-        self._voltage = Float(300.0)
-        self._magnification = Float(1)
-        self._sphericalAberration = Float(2.7)
-        self._amplitudeContrast = Float(0.1)
-        self._dosePerFrame = Float(1.0)
-        '''
+    for item in items:
+        if not item.hasObjId():
+            outputSet._idCount += 1
+            item.setObjId(outputSet._idCount)
+        else:
+            outputSet._idCount = max(outputSet._idCount, item.getObjId())
 
-    def setSamplingRate(self, value):
-        self._samplingRate = value
+        if mapper.doCreateTables:
+            mapper.insert(item)  # first item creates the tables
+        else:
+            if mapper.db.INSERT_OBJECT is None:  # reopened set
+                mapper.db.setupCommands(item.getObjDict(includeClass=True))
+            rows.append((item.getObjId(), item.isEnabled(),
+                         item.getObjLabel(), item.getObjComment(),
+                         *mapper._getValuesFromObject(item).values()))
+            if len(rows) >= batchSize:
+                _flush()
+        count += 1
 
-    def getSamplingRate(self):
-        return self._samplingRate
+    if rows:
+        _flush()
+    outputSet._size.set(outputSet._size.get() + count)
 
-    def setExposureTime(self, value):
-        self._exposureTime = value
+    return count
 
-    def getExposureTime(self):
-        return self._exposureTime
 
-    def setScanningFreq(self, value):
-        self._scanningFreq = value
+class ScanTiming:
+    """ Scan parameters of an AFM acquisition, as a small immutable record.
+
+    Args:
+        lineTime: time in seconds to scan one line of the fast axis
+        frameTime: time in seconds between the start of two frames
+        pixelSize: pixel size in Å
+        scanDirection: direction of the slow axis, SCAN_DOWN or SCAN_UP
+        heightScale: height in nm of one unit of the stored values, negative
+            when the raw values are inverted (e.g. .asd files)
+        heightOffset: height in nm of a stored value of 0, the heights are
+            value * heightScale + heightOffset
+    """
+    FIELDS = ('lineTime', 'frameTime', 'pixelSize', 'scanDirection',
+              'heightScale', 'heightOffset')
+    __slots__ = FIELDS + ('_lineTimes',)
+
+    def __init__(self, lineTime=None, frameTime=None, pixelSize=None,
+                 scanDirection=SCAN_DOWN, heightScale=None, heightOffset=0.):
+        for name, value in (('lineTime', lineTime), ('frameTime', frameTime),
+                            ('pixelSize', pixelSize)):
+            if value is not None and not value > 0:
+                raise ValueError("%s should be positive, got %s" % (name, value))
+            object.__setattr__(self, name,
+                               None if value is None else float(value))
+        if heightScale is not None and not (heightScale != 0 and
+                                            np.isfinite(heightScale)):
+            raise ValueError("heightScale should be a non-zero number, got %s"
+                             % heightScale)
+        object.__setattr__(self, 'heightScale',
+                           None if heightScale is None else float(heightScale))
+        heightOffset = 0. if heightOffset is None else float(heightOffset)
+        if not np.isfinite(heightOffset):
+            raise ValueError("heightOffset should be a number, got %s"
+                             % heightOffset)
+        object.__setattr__(self, 'heightOffset', heightOffset)
+        if scanDirection not in SCAN_DIRECTIONS:
+            raise ValueError("Unknown scan direction '%s', it should be one "
+                             "of %s" % (scanDirection, SCAN_DIRECTIONS))
+        object.__setattr__(self, 'scanDirection', scanDirection)
+        object.__setattr__(self, '_lineTimes', {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ScanTiming is immutable, use replace()")
+
+    def __eq__(self, other):
+        return isinstance(other, ScanTiming) and self.values() == other.values()
+
+    def __repr__(self):
+        return 'ScanTiming(%s)' % ', '.join('%s=%r' % item for item in
+                                            zip(self.FIELDS, self.values()))
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.FIELDS)
+
+    def replace(self, **kwargs):
+        """ A new record with some fields changed. """
+        values = dict(zip(self.FIELDS, self.values()))
+        values.update(kwargs)
+        return ScanTiming(**values)
+
+    def encode(self):
+        """ Compact string with all the fields, see decode. """
+        return json.dumps(self.values(), separators=(',', ':'))
+
+    @classmethod
+    def decode(cls, record):
+        return cls(*json.loads(record)) if record else cls()
+
+    def getLineTime(self, nLines):
+        """ Time in seconds to scan one line of a frame with nLines lines.
+        Without the line time (or if it does not fit in the frame time)
+        the frame time is split evenly between the lines. """
+        if self.lineTime and (self.frameTime is None or
+                              self.lineTime * nLines <= self.frameTime):
+            return self.lineTime
+        if self.frameTime is None:
+            return None
+        return self.frameTime / float(nLines)
+
+    def checkLines(self, nLines):
+        """ Error message if the lines of a frame do not fit in the frame
+        time, None otherwise. """
+        if self.lineTime and self.frameTime and \
+                self.lineTime * nLines > self.frameTime * (1 + 1e-6):
+            return ("%d lines of %g s do not fit in a frame time of %g s"
+                    % (nLines, self.lineTime, self.frameTime))
+        return None
+
+    def getLineTimes(self, nLines):
+        """ Acquisition time in seconds of each row of a frame, relative to
+        the start of the frame, in row order (read-only array computed once
+        per number of lines). """
+        lineTimes = self._lineTimes.get(nLines)
+        if lineTimes is None:
+            lineTime = self.getLineTime(nLines)
+            if lineTime is None:
+                raise ValueError("The line time is unknown: neither the line "
+                                 "time nor the frame time are set")
+            order = np.arange(nLines, dtype=np.float64)
+            if self.scanDirection == SCAN_UP:
+                order = order[::-1]
+            lineTimes = order * lineTime
+            lineTimes.flags.writeable = False
+            self._lineTimes[nLines] = lineTimes
+        return lineTimes
+
+    def getTimestamps(self, frameIndex, nLines):
+        """ Acquisition time of each row of a frame (0-based index)
+        relative to the start of the movie. """
+        return frameIndex * (self.frameTime or 0.) + self.getLineTimes(nLines)
+
+
+class AFMAcquisition(data.EMObject):
+    """ AFM acquisition metadata of a set of movies. All the values are
+    stored together in a single packed record (see ScanTiming), once per
+    set. """
+
+    def __init__(self, lineTime=None, frameTime=None, pixelSize=None,
+                 scanDirection=SCAN_DOWN, heightScale=None, heightOffset=0.,
+                 **kwargs):
+        data.EMObject.__init__(self, **kwargs)
+        self._record = String()
+        self._timing = None  # record decoded from _record
+        self.setTiming(ScanTiming(lineTime, frameTime, pixelSize,
+                                  scanDirection, heightScale, heightOffset))
+
+    def getTiming(self):
+        """ Decoded ScanTiming, cached until the record changes (e.g. when
+        the object is filled from the database). """
+        record = self._record.get()
+        if self._timing is None or self._timing[0] != record:
+            self._timing = (record, ScanTiming.decode(record))
+        return self._timing[1]
+
+    def setTiming(self, timing):
+        record = timing.encode()
+        self._record.set(record)
+        self._timing = (record, timing)
+
+    def _update(self, **kwargs):
+        self.setTiming(self.getTiming().replace(**kwargs))
+
+    def setLineTime(self, value):
+        self._update(lineTime=value)
+
+    def getLineTime(self):
+        return self.getTiming().lineTime
+
+    def setFrameTime(self, value):
+        self._update(frameTime=value)
+
+    def getFrameTime(self):
+        return self.getTiming().frameTime
+
+    def setPixelSize(self, value):
+        self._update(pixelSize=value)
+
+    def getPixelSize(self):
+        return self.getTiming().pixelSize
+
+    def setScanDirection(self, value):
+        self._update(scanDirection=value)
+
+    def getScanDirection(self):
+        return self.getTiming().scanDirection
+
+    def setHeightScale(self, value):
+        """ Height in nm of one unit of the stored values. """
+        self._update(heightScale=value)
+
+    def getHeightScale(self):
+        return self.getTiming().heightScale
+
+    def setHeightOffset(self, value):
+        """ Height in nm of a stored value of 0. """
+        self._update(heightOffset=value)
+
+    def getHeightOffset(self):
+        return self.getTiming().heightOffset
 
     def getScanningFreq(self):
-        return self._scanningFreq
+        """ Lines per second of the fast axis, if known. """
+        lineTime = self.getLineTime()
+        return 1. / lineTime if lineTime else None
+
+    def getSamplingRate(self):
+        return self.getPixelSize()
+
+    def getExposureTime(self):
+        return self.getFrameTime()
+
+    def __str__(self):
+        return str(self.getTiming())
 
 
 class AFMmovie(data.Movie):
@@ -94,6 +285,98 @@ class AFMmovie(data.Movie):
 
     def __init__(self, location=None, **kwargs):
         data.Movie.__init__(self, location, **kwargs)
+        # Header information read at import time, to avoid opening the
+        # movie file just to know its dimensions
+        self._xDim = Integer()
+        self._yDim = Integer()
+        self._numberOfFrames = Integer()
+        self._dataType = String()
+        self._frameTime = Float()
+        # .npy file with the time of each frame, only for movies whose
+        # frames are not evenly spaced in time
+        self._timestampsFile = String()
+
+    def setDimensions(self, xDim, yDim, numberOfFrames):
+        self._xDim.set(xDim)
+        self._yDim.set(yDim)
+        self._numberOfFrames.set(numberOfFrames)
+
+    def hasDimensions(self):
+        return self._xDim.hasValue()
+
+    def getDim(self):
+        """ Return (Xdim, Ydim, frames), from the stored header information
+        if available or reading the file otherwise. """
+        if self.hasDimensions():
+            return self._xDim.get(), self._yDim.get(), self._numberOfFrames.get()
+        return data.Movie.getDim(self)
+
+    def getNumberOfFrames(self):
+        first, last, _ = self._framesRange
+        if last <= 0 and self.hasDimensions():
+            return self._numberOfFrames.get() - first + 1
+        return data.Movie.getNumberOfFrames(self)
+
+    def setDataType(self, value):
+        self._dataType.set(value)
+
+    def getDataType(self):
+        return self._dataType.get()
+
+    def setFrameTime(self, value):
+        """ Time in seconds to scan one frame. """
+        self._frameTime.set(value)
+
+    def getFrameTime(self):
+        return self._frameTime.get()
+
+    def setTimestampsFile(self, fileName):
+        self._timestampsFile.set(fileName)
+
+    def getTimestampsFile(self):
+        return self._timestampsFile.get()
+
+    def getFrameTimestamps(self):
+        """ Acquisition time in seconds of each frame relative to the first
+        one: read from the timestamps file when the frames are not evenly
+        spaced (dropped frames, variable frame rate) or from the frame time
+        otherwise. None if the timing is unknown. """
+        if self._timestampsFile.hasValue():
+            return np.load(self._timestampsFile.get(), mmap_mode='r')
+        if not self._frameTime.hasValue():
+            return None
+        return np.arange(self.getDim()[2]) * self._frameTime.get()
+
+    def getFrameRange(self, tStart=None, tEnd=None):
+        """ Frames acquired between two times (in seconds, both included,
+        None for no limit), found by binary search on the frame timestamps.
+
+        Returns:
+            (first, last) 1-based frame numbers, as used by the protocols
+            params and FrameStack.range, or None if no frame is in range.
+        """
+        times = self.getFrameTimestamps()
+        if times is None:
+            raise ValueError("The frame times of %s are unknown"
+                             % self.getFileName())
+        first = 0 if tStart is None else int(np.searchsorted(times, tStart, 'left'))
+        last = len(times) if tEnd is None else int(np.searchsorted(times, tEnd, 'right'))
+        return (first + 1, last) if last > first else None
+
+    def frames(self):
+        """ Lazy, memory-mapped view of the movie frames. Slicing it or
+        iterating over it does not load the whole movie in memory, see
+        afm.convert.frames.FrameStack. """
+        from afm.convert.frames import FrameStack
+        return FrameStack(self.getFileName())
+
+    def getScanTime(self):
+        """ Total time in seconds to scan the whole movie. """
+        if not self._frameTime.hasValue() or not self.hasDimensions():
+            return None
+        if self._timestampsFile.hasValue():
+            return float(self.getFrameTimestamps()[-1]) + self._frameTime.get()
+        return self._frameTime.get() * self._numberOfFrames.get()
 
     def copyInfo(self, other):
         data.Movie.copyInfo(self, other)
@@ -107,16 +390,119 @@ class SetOfAFMmovies(data.SetOfMovies):
         self._afmAcquisition = AFMAcquisition()
 
     def setAFMAcquisition(self, value):
-        self._afmAcquisition = value
+        self._afmAcquisition.copy(value)
 
     def getAFMAcquisition(self):
         return self._afmAcquisition
 
+    def copyInfo(self, other):
+        data.SetOfMovies.copyInfo(self, other)
+        if hasattr(other, 'getAFMAcquisition'):
+            self._afmAcquisition.copy(other.getAFMAcquisition())
+
+    def appendFiles(self, fileNames, fillItem=None, batchSize=1000):
+        """ Bulk append one movie per file name.
+
+        A single item object is reused for all the files and the rows are
+        inserted with executemany in batches of batchSize rows, without the
+        extra update that append() + update() costs per item. Nothing is
+        committed here, the rows become visible in the next write() of the
+        set (e.g. when the output is defined or updated).
+
+        Args:
+            fileNames: iterable with the movie file names
+            fillItem: optional function(item, fileName) called for each
+                movie to set extra attributes before it is stored
+            batchSize: number of rows inserted per executemany call
+
+        Returns:
+            The number of appended movies.
+        """
+        item = self.ITEM_TYPE()
+        samplingRate = self.getSamplingRate()
+        acquisition = self.getAcquisition() if self.hasAcquisition() else None
+
+        def _iterItems():
+            for fileName in fileNames:
+                item.setObjId(None)
+                item.setLocation(fileName)
+                if fillItem is not None:
+                    fillItem(item, fileName)
+                # As in SetOfImages.append, which is not called here
+                if samplingRate or not item.getSamplingRate():
+                    item.setSamplingRate(samplingRate)
+                if acquisition is not None and not item.hasAcquisition():
+                    item.setAcquisition(acquisition)
+                if self._firstDim.isEmpty() and item.hasDimensions():
+                    self._firstDim.set(item.getDim())
+                yield item
+
+        return bulkAppend(self, _iterItems(), batchSize)
+
     def __str__(self):
         """ String representation of a set of coordinates. """
         return "%s (%d items, %s, %0.2f Å/px)" % ('SetOfAFMmovies', self.getSize(), self._dimStr(), self.getSamplingRate())
 
 
+class AFMMicrograph(data.Micrograph):
+    """ Aligned AFM micrograph, with the id of its source movie, its
+    dimensions and the statistics of the alignment shifts, so the next
+    steps do not need to open the file to know them. """
+
+    def __init__(self, location=None, **kwargs):
+        data.Micrograph.__init__(self, location, **kwargs)
+        self._movieId = Integer()
+        self._xDim = Integer()
+        self._yDim = Integer()
+        self._meanShift = Float()
+        self._maxShift = Float()
+        self._totalDrift = Float()
+
+    def setMovieId(self, value):
+        self._movieId.set(value)
+
+    def getMovieId(self):
+        return self._movieId.get()
+
+    def setDimensions(self, xDim, yDim):
+        self._xDim.set(xDim)
+        self._yDim.set(yDim)
+
+    def hasDimensions(self):
+        return self._xDim.hasValue()
+
+    def getDim(self):
+        if self.hasDimensions():
+            return self._xDim.get(), self._yDim.get(), 1
+        return data.Micrograph.getDim(self)
+
+    def setShiftStats(self, meanShift, maxShift, totalDrift):
+        """ Mean and maximum shift between consecutive frames and total
+        drift of the movie, in pixels of the input movie. """
+        self._meanShift.set(meanShift)
+        self._maxShift.set(maxShift)
+        self._totalDrift.set(totalDrift)
+
+    def getShiftStats(self):
+        return (self._meanShift.get(), self._maxShift.get(),
+                self._totalDrift.get())
+
+
+class SetOfAFMMicrographs(data.SetOfMicrographs):
+    ITEM_TYPE = AFMMicrograph
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._failedMovies = CsvList(pType=int)
+
+    def setFailedMovies(self, movieIds):
+        """ Ids of the input movies that could not be aligned. """
+        self._failedMovies.set(movieIds)
+
+    def getFailedMovies(self):
+        return list(self._failedMovies)
+
+
 class AFMImage(data.Movie):
     def __init__(self, location=None, **kwargs):
         data.Movie.__init__(self, location, **kwargs)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Numeric engines used in-process by the protocols, working on numpy arrays
+and lazy FrameStacks instead of calling external programs.
+"""
+from .alignment import DriftAligner, AlignmentResult, fourierBin
+from .distortion import ScanDistortionCorrector
+from .extraction import extractBoxes, balanceChunks, ParticleExtractor
+from .normalization import StackNormalizer, removeDust, getBackgroundMask
+from .scoring import noisyZoneScores, SCORE_BY_VAR, SCORE_BY_GINI
+from .downsample import DownsampleCache
+from .picking import (TemplateMatcher, BlobDetector, makeTemplateBank,
+                      suppressNonMaxima)
+from .leveling import levelPlane, fitPlane, fitPolynomials, StackLeveler
+from .classification import CL2D, Aligner2D, ClassificationResult, transformImages
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+CPU drift correction of AFM movies.
+
+Frames are aligned by FFT cross-correlation against the sum of the other
+aligned frames (leave-one-out reference), with a parabolic sub-pixel fit of
+the correlation peak, iterating until the shifts change less than the
+tolerance. The FFTs are computed in batches over blocks of frames, read
+from the lazy FrameStack, so only one block of frames is in memory.
+
+An optional patch-based stage estimates local shifts on a grid of
+overlapping patches of the globally aligned frames, smooths them along
+time with a quadratic fit and warps each frame with the interpolated
+shift field.
+
+Shifts follow the convention frame(r) = reference(r - shift), and the
+aligned frame is reference(r) = frame(r + shift).
+"""
+from collections import namedtuple
+
+import numpy as np
+import scipy.fft
+from scipy import ndimage
+
+AlignmentResult = namedtuple('AlignmentResult', ['shifts', 'localShifts',
+                                                 'patchCenters', 'average'])
+
+
+def getBinnedShape(shape, binFactor):
+    """ Even dimensions of the frames after Fourier binning. """
+    if binFactor <= 1:
+        return tuple(shape)
+    return tuple(max(2, int(round(d / binFactor / 2.)) * 2) for d in shape)
+
+
+def cropSpectrum(ft, shape, binnedShape):
+    """ Crop the rfft2 of frames of the given shape to the binnedShape, so
+    its inverse transform is the binned frame (with the same mean value). """
+    ny, nx = shape
+    my, mx = binnedShape
+    if (my, mx) == (ny, nx):
+        return ft
+    h = my // 2
+    cropped = np.concatenate([ft[..., :h, :mx // 2 + 1],
+                              ft[..., ny - h:, :mx // 2 + 1]], axis=-2)
+    cropped *= (my * mx) / float(ny * nx)
+    return cropped
+
+
+def fourierBin(image, binFactor, numberOfThreads=1):
+    """ Downsample an image by cropping its Fourier transform. """
+    shape = image.shape[-2:]
+    binnedShape = getBinnedShape(shape, binFactor)
+    if binnedShape == tuple(shape):
+        return np.asarray(image, dtype=np.float32)
+    ft = scipy.fft.rfft2(np.asarray(image, dtype=np.float32),
+                         workers=numberOfThreads)
+    return scipy.fft.irfft2(cropSpectrum(ft, shape, binnedShape),
+                            s=binnedShape, workers=numberOfThreads)
+
+
+class DriftAligner:
+    """ In-process frame alignment engine.
+
+    Args:
+        binFactor: Fourier binning applied before the alignment
+        tolerance: stop iterating when no shift changes more than this (px)
+        maxIterations: maximum number of refinement iterations
+        maxShift: maximum shift between frames (px), a quarter of the frame
+            size if None
+        patches: (rows, columns) of the local alignment grid, or None for
+            rigid alignment only
+        lowPass: sigma (cycles/px) of the Gaussian filter applied to the
+            cross power spectrum
+        blockSize: number of frames transformed together
+        numberOfThreads: threads used by the FFTs
+    """
+    def __init__(self, binFactor=1., tolerance=0.2, maxIterations=5,
+                 maxShift=None, patches=(5, 5), lowPass=0.2, blockSize=16,
+                 numberOfThreads=1):
+        self.binFactor = binFactor
+        self.tolerance = tolerance
+        self.maxIterations = maxIterations
+        self.maxShift = maxShift
+        self.patches = patches
+        self.lowPass = lowPass
+        self.blockSize = blockSize
+        self.numberOfThreads = numberOfThreads
+
+    # ------------------------- FFT helpers ----------------------------------
+    def _rfft2(self, a):
+        return scipy.fft.rfft2(a, workers=self.numberOfThreads)
+
+    def _irfft2(self, a, shape):
+        return scipy.fft.irfft2(a, s=shape, workers=self.numberOfThreads)
+
+    @staticmethod
+    def _frequencies(shape):
+        ky = np.fft.fftfreq(shape[0]).astype(np.float32)[:, None]
+        kx = np.fft.rfftfreq(shape[1]).astype(np.float32)[None, :]
+        return ky, kx
+
+    @staticmethod
+    def _phase(shifts, ky, kx):
+        """ Fourier factors that translate the images by shifts (b, 2). """
+        dy = shifts[:, 0, None, None].astype(np.float32)
+        dx = shifts[:, 1, None, None].astype(np.float32)
+        return np.exp(-2j * np.pi * (ky * dy + kx * dx)).astype(np.complex64)
+
+    def _shiftMask(self, shape, maxShift):
+        """ Positions of the correlation map within maxShift of the origin. """
+        dy = np.minimum(np.arange(shape[0]), shape[0] - np.arange(shape[0]))
+        dx = np.minimum(np.arange(shape[1]), shape[1] - np.arange(shape[1]))
+        return (dy[:, None] <= maxShift) & (dx[None, :] <= maxShift)
+
+    def _findPeaks(self, ftImages, ftRefs, shape, filt, mask):
+        """ Sub-pixel position of the cross-correlation peak of each image
+        against its reference. ftImages and ftRefs are (b, y, x//2+1). """
+        cc = self._irfft2(ftImages * np.conj(ftRefs) * filt, shape)
+        cc = np.where(mask, cc, -np.inf)
+        b = cc.shape[0]
+        flat = cc.reshape(b, -1).argmax(axis=1)
+        iy, ix = np.unravel_index(flat, shape)
+        rows = np.arange(b)
+
+        def _subpixel(vm, v0, vp):
+            den = vm - 2 * v0 + vp
+            valid = np.isfinite(den) & (den < 0)
+            return np.where(valid, 0.5 * (vm - vp) / np.where(valid, den, 1), 0)
+
+        v0 = cc[rows, iy, ix]
+        oy = _subpixel(cc[rows, (iy - 1) % shape[0], ix], v0,
+                       cc[rows, (iy + 1) % shape[0], ix])
+        ox = _subpixel(cc[rows, iy, (ix - 1) % shape[1]], v0,
+                       cc[rows, iy, (ix + 1) % shape[1]])
+        dy = np.where(iy > shape[0] // 2, iy - shape[0], iy) + oy
+        dx = np.where(ix > shape[1] // 2, ix - shape[1], ix) + ox
+        return np.stack([dy, dx], axis=1)
+
+    def _gaussianFilter(self, shape):
+        ky, kx = self._frequencies(shape)
+        return np.exp(-(ky ** 2 + kx ** 2) / (2 * self.lowPass ** 2)).astype(np.float32)
+
+    # ------------------------- Alignment ------------------------------------
+    def _iterSpectra(self, frames, shape, binnedShape):
+        """ Iterate over blocks of binned frame spectra. """
+        for start, block in frames.iterBlocks(self.blockSize):
+            block -= block.mean(axis=(1, 2), keepdims=True)
+            yield start, cropSpectrum(self._rfft2(block), shape, binnedShape)
+
+    def _refine(self, iterBlocks, n, shape, maxShift, initialShifts=None):
+        """ Iterative leave-one-out alignment of a sequence of image blocks.
+
+        Args:
+            iterBlocks: function returning a new iterator of (start, spectra)
+                blocks, spectra being (b, ..., y, x//2+1) with the images to
+                align in the trailing axes (e.g. patches in the middle axis)
+            n: total number of frames
+            shape: real shape of the images
+
+        Returns:
+            The shifts (n, ..., 2) and the spectrum of the aligned sum.
+        """
+        ky, kx = self._frequencies(shape)
+        filt = self._gaussianFilter(shape)
+        mask = self._shiftMask(shape, maxShift)
+        shifts = initialShifts
+        refFt = None
+
+        for it in range(self.maxIterations + 1):
+            newRef = None
+            newShifts = np.zeros_like(shifts) if shifts is not None else None
+
+            for start, ft in iterBlocks():
+                b, inner = ft.shape[0], ft.shape[1:-2]
+                if shifts is None:
+                    shifts = np.zeros((n,) + inner + (2,))
+                    newShifts = np.zeros_like(shifts)
+                flatFt = ft.reshape((-1,) + ft.shape[-2:])
+                blockShifts = shifts[start:start + b].reshape(-1, 2)
+                aligned = flatFt * self._phase(-blockShifts, ky, kx)
+
+                if refFt is None:
+                    blockNew = blockShifts  # first pass, only build the sum
+                else:
+                    refs = refFt.reshape((-1,) + ft.shape[-2:])
+                    refs = np.tile(refs, (b, 1, 1)) - aligned
+                    blockNew = self._findPeaks(flatFt, refs, shape, filt, mask)
+                    aligned = flatFt * self._phase(-blockNew, ky, kx)
+
+                newShifts[start:start + b] = blockNew.reshape((b,) + inner + (2,))
+                blockSum = aligned.reshape(ft.shape).sum(axis=0)
+                newRef = blockSum if newRef is None else newRef + blockSum
+
+            converged = (refFt is not None and
+                         np.abs(newShifts - shifts).max() < self.tolerance)
+            shifts, refFt = newShifts, newRef
+            if converged:
+                break
+
+        return shifts, refFt
+
+    def align(self, frames, outputMovie=None):
+        """ Align the frames of a FrameStack.
+
+        Args:
+            frames: FrameStack (or a slice of it) with the frames to align
+            outputMovie: optional mapped array (n, y, x) where the aligned,
+                binned frames are written
+
+        Returns:
+            An AlignmentResult with the rigid shifts (n, 2) and the local
+            shifts (n, patches, 2) in original pixels, the patch centers
+            (patches, 2) in binned pixels and the average of the aligned
+            frames (binned).
+        """
+        n = len(frames)
+        shape = frames.shape[1:]
+        binnedShape = getBinnedShape(shape, self.binFactor)
+        scale = shape[0] / float(binnedShape[0])
+        maxShift = self.maxShift or min(binnedShape) // 4
+        ky, kx = self._frequencies(binnedShape)
+
+        shifts, refFt = self._refine(
+            lambda: self._iterSpectra(frames, shape, binnedShape),
+            n, binnedShape, maxShift)
+        # Shifts relative to the first frame
+        origin = shifts[0].copy()
+        shifts -= origin
+        refFt *= self._phase(origin[None], ky, kx)[0]
+
+        localShifts, centers = None, None
+        if self.patches and min(self.patches) > 0 and n > 1:
+            localShifts, centers, average = self._alignPatches(
+                frames, shape, binnedShape, shifts, outputMovie)
+            localShifts *= scale
+        else:
+            average = self._irfft2(refFt, binnedShape) / n
+            if outputMovie is not None:
+                for start, ft in self._iterSpectra(frames, shape, binnedShape):
+                    ft *= self._phase(-shifts[start:start + len(ft)], ky, kx)
+                    outputMovie[start:start + len(ft)] = self._irfft2(ft, binnedShape)
+
+        return AlignmentResult(shifts * scale, localShifts, centers,
+                               average.astype(np.float32))
+
+    # ------------------------- Local alignment ------------------------------
+    def _patchGrid(self, binnedShape):
+        """ Corners, size and centers of the overlapping patches (50%). """
+        rows, cols = self.patches
+        my, mx = binnedShape
+        ph = max(8, (2 * my // (rows + 1)) // 2 * 2)
+        pw = max(8, (2 * mx // (cols + 1)) // 2 * 2)
+        ys = [int(round((j + 1) * my / (rows + 1.) - ph / 2.)) for j in range(rows)]
+        xs = [int(round((j + 1) * mx / (cols + 1.) - pw / 2.)) for j in range(cols)]
+        ys = np.clip(ys, 0, my - ph)
+        xs = np.clip(xs, 0, mx - pw)
+        corners = [(y, x) for y in ys for x in xs]
+        centers = np.array([(y + ph / 2., x + pw / 2.) for y, x in corners])
+        return corners, (ph, pw), centers
+
+    def _iterAligned(self, frames, shape, binnedShape, shifts):
+        """ Iterate over blocks of rigidly aligned binned frames. """
+        ky, kx = self._frequencies(binnedShape)
+        for start, ft in self._iterSpectra(frames, shape, binnedShape):
+            ft *= self._phase(-shifts[start:start + len(ft)], ky, kx)
+            yield start, self._irfft2(ft, binnedShape)
+
+    def _alignPatches(self, frames, shape, binnedShape, shifts, outputMovie):
+        n = len(frames)
+        corners, patchShape, centers = self._patchGrid(binnedShape)
+        ph, pw = patchShape
+
+        def _iterPatchSpectra():
+            for start, block in self._iterAligned(frames, shape, binnedShape, shifts):
+                patches = np.stack([block[:, y:y + ph, x:x + pw]
+                                    for y, x in corners], axis=1)
+                patches -= patches.mean(axis=(2, 3), keepdims=True)
+                yield start, self._rfft2(patches)
+
+        localShifts, _ = self._refine(_iterPatchSpectra, n, patchShape,
+                                      max(2, min(patchShape) // 4))
+        localShifts = self._smoothInTime(localShifts)
+
+        # Interpolate the shifts of the patch grid to every pixel
+        rows, cols = self.patches
+        my, mx = binnedShape
+        yy, xx = np.mgrid[0:my, 0:mx].astype(np.float32)
+        cy = np.unique(centers[:, 0])
+        cx = np.unique(centers[:, 1])
+        gridCoords = np.array([np.interp(yy, cy, np.arange(len(cy))),
+                               np.interp(xx, cx, np.arange(len(cx)))])
+        average = np.zeros(binnedShape, dtype=np.float64)
+
+        for start, block in self._iterAligned(frames, shape, binnedShape, shifts):
+            for i, frame in enumerate(block):
+                grid = localShifts[start + i].reshape(rows, cols, 2)
+                fy = ndimage.map_coordinates(grid[..., 0], gridCoords, order=1)
+                fx = ndimage.map_coordinates(grid[..., 1], gridCoords, order=1)
+                warped = ndimage.map_coordinates(frame, [yy + fy, xx + fx],
+                                                 order=1, mode='nearest')
+                average += warped
+                if outputMovie is not None:
+                    outputMovie[start + i] = warped
+
+        return localShifts, centers, average / n
+
+    @staticmethod
+    def _smoothInTime(localShifts):
+        """ Fit a quadratic polynomial in time to the shifts of each patch. """
+        n = localShifts.shape[0]
+        if n < 4:
+            return localShifts
+        t = np.linspace(-1, 1, n)
+        design = np.stack([np.ones(n), t, t ** 2], axis=1)
+        values = localShifts.reshape(n, -1)
+        coefs, _, _, _ = np.linalg.lstsq(design, values, rcond=None)
+        return (design @ coefs).reshape(localShifts.shape)
@@ -0,0 +1,577 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Rotationally invariant 2D classification of particles (CL2D-like).
+
+Each particle is aligned to the class references in two stages: the
+in-plane rotation is found by cross-correlating the polar resampling of
+the Fourier magnitudes (which do not depend on the particle translation)
+along the angle axis, and then the translation by FFT cross-correlation of
+the rotated particle with the reference, for the few best candidate classes
+and the two rotations (a and a + 180) that the magnitudes can not tell
+apart. The particle goes to the class of highest normalized correlation.
+
+The references are updated in mini-batches from running sufficient
+statistics (sum of the aligned particles and count per class), and the
+number of classes grows from the initial ones by splitting the most
+populated classes, perturbing their references in opposite directions.
+The alignment of a mini-batch (the E-step) is distributed in chunks to a
+pool of processes that read the particles from a memory-mapped stack.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.fft
+
+ClassificationResult = namedtuple('ClassificationResult',
+                                  ['references', 'sums', 'counts',
+                                   'assignments', 'angles', 'shifts',
+                                   'scores'])
+
+
+def getCircularMask(boxSize, radius=None):
+    from .picking import getCircularMask as _getMask
+    return _getMask(boxSize, radius)
+
+
+def normalizeStack(stack, mask):
+    """ Zero mean and unit standard deviation inside the mask, zero
+    outside. Returns a new float32 array. """
+    stack = np.array(stack, dtype=np.float32)
+    values = stack[:, mask]
+    values -= values.mean(axis=1, keepdims=True)
+    values /= np.maximum(values.std(axis=1, keepdims=True), 1e-6)
+    stack[:] = 0
+    stack[:, mask] = values
+    return stack
+
+
+def bilinear(stack, srcY, srcX):
+    """ Bilinear interpolation of each image of a stack (n, ny, nx) at
+    its own coordinates srcY, srcX (n, ...), zero outside the images. A
+    gather of the four neighbours, cheaper than a 3D map_coordinates. """
+    n, ny, nx = stack.shape
+    x0 = np.floor(srcX)
+    y0 = np.floor(srcY)
+    fx = (srcX - x0).astype(np.float32)
+    fy = (srcY - y0).astype(np.float32)
+    x0 = x0.astype(np.int64)
+    y0 = y0.astype(np.int64)
+    flat = stack.reshape(n, -1)
+    base = (np.arange(n) * ny * nx).reshape((n,) + (1,) * (srcX.ndim - 1))
+    result = np.zeros(srcX.shape, dtype=np.float32)
+
+    for dy, dx, w in ((0, 0, (1 - fy) * (1 - fx)), (0, 1, (1 - fy) * fx),
+                      (1, 0, fy * (1 - fx)), (1, 1, fy * fx)):
+        xi, yi = x0 + dx, y0 + dy
+        inside = (xi >= 0) & (xi < nx) & (yi >= 0) & (yi < ny)
+        index = base + np.clip(yi, 0, ny - 1) * nx + np.clip(xi, 0, nx - 1)
+        result += np.where(inside, flat.ravel()[index], 0) * w
+    return result
+
+
+def shiftImages(stack, shifts):
+    """ Integer shifts of a stack: the output pixel r of image i is the
+    input pixel r + shifts[i] (as x, y), zero outside. """
+    n, ny, nx = stack.shape
+    result = np.zeros_like(stack)
+    shifts = np.asarray(shifts, dtype=np.int64).reshape(n, 2)
+    values, inverse = np.unique(shifts, axis=0, return_inverse=True)
+    for (dx, dy), rows in zip(values, np.split(np.argsort(inverse, kind='stable'),
+                                               np.cumsum(np.bincount(inverse))[:-1])):
+        result[rows, max(0, -dy):ny - max(0, dy), max(0, -dx):nx - max(0, dx)] = \
+            stack[rows, max(0, dy):ny - max(0, -dy), max(0, dx):nx - max(0, -dx)]
+    return result
+
+
+def transformImages(stack, angles, shifts):
+    """ Rotate and shift a stack of images in a single interpolation.
+
+    The output pixel r of image i is read from the input at
+    c + R(angles[i]) (r - c) + shifts[i], c being the center of the box
+    and R the rotation (degrees) of (x, y) vectors.
+
+    Args:
+        stack: array (n, box, box)
+        angles: (n,) degrees
+        shifts: (n, 2) as (x, y) pixels
+    """
+    stack = np.asarray(stack, dtype=np.float32)
+    n, ny, nx = stack.shape
+    c = np.array([nx // 2, ny // 2], dtype=np.float64)
+    y, x = np.mgrid[:ny, :nx].astype(np.float64)
+    x -= c[0]
+    y -= c[1]
+    a = np.deg2rad(np.asarray(angles, dtype=np.float64))[:, None, None]
+    cos, sin = np.cos(a), np.sin(a)
+    shifts = np.asarray(shifts, dtype=np.float64).reshape(n, 2)
+    srcX = cos * x - sin * y + c[0] + shifts[:, 0, None, None]
+    srcY = sin * x + cos * y + c[1] + shifts[:, 1, None, None]
+    return bilinear(stack, srcY, srcX)
+
+
+def getTransformMatrix(angle, shift):
+    """ 4x4 matrix of the 2D alignment of a particle: it maps the centered
+    coordinates of the particle to the ones of its class average, as the
+    inverse of the transform of transformImages. """
+    a = np.deg2rad(angle)
+    rot = np.array([[np.cos(a), -np.sin(a)], [np.sin(a), np.cos(a)]])
+    matrix = np.eye(4)
+    matrix[:2, :2] = rot.T
+    matrix[:2, 3] = -rot.T @ np.asarray(shift, dtype=np.float64)
+    return matrix
+
+
+class Aligner2D:
+    """ Alignment of particles to class references.
+
+    Args:
+        boxSize: size of the particles
+        angularSampling: degrees between the sampled rotations
+        maxShift: maximum translation (px), a quarter of the box if None
+        candidates: number of best classes (by the rotational correlation)
+            whose translation is searched
+        maskRadius: radius (px) of the circular mask, the box half if None
+        subBatch: particles interpolated at once, to bound the memory
+    """
+    def __init__(self, boxSize, angularSampling=2., maxShift=None,
+                 candidates=3, maskRadius=None, subBatch=128):
+        self.boxSize = boxSize
+        self.maxShift = boxSize // 4 if maxShift is None else maxShift
+        self.candidates = candidates
+        self.subBatch = subBatch
+        self.mask = getCircularMask(boxSize, maskRadius)
+
+        # Polar grid of the centered Fourier magnitudes, over half a turn
+        # since the magnitudes are symmetric
+        nAngles = max(8, int(round(180. / angularSampling)))
+        self.angleStep = 180. / nAngles
+        theta = np.deg2rad(np.arange(nAngles) * self.angleStep)
+        radii = np.arange(2, boxSize // 2 - 1, dtype=np.float64)
+        c = boxSize // 2
+        self._polarX = c + radii[:, None] * np.cos(theta)[None, :]
+        self._polarY = c + radii[:, None] * np.sin(theta)[None, :]
+        self._ringWeights = np.sqrt(radii)[:, None].astype(np.float32)
+
+        # Linear resampling operators: polar grid and rotations by
+        # multiples of angleStep (over a whole turn)
+        self._polarMatrix = self._interpolationMatrix(self._polarY, self._polarX)
+        self._rotMatrices = {}
+
+        # Allowed shifts in the (wrapped) correlation maps
+        d = np.fft.fftfreq(boxSize, 1. / boxSize)
+        self._shiftMask = (d[:, None] ** 2 + d[None, :] ** 2) <= self.maxShift ** 2
+        self._shiftValues = d
+
+    def _interpolationMatrix(self, srcY, srcX):
+        """ Sparse matrix (points, box * box) of the bilinear interpolation
+        of a box at the given source coordinates (zero outside). """
+        from scipy import sparse
+
+        b = self.boxSize
+        srcY, srcX = np.ravel(srcY), np.ravel(srcX)
+        x0, y0 = np.floor(srcX), np.floor(srcY)
+        fx, fy = srcX - x0, srcY - y0
+        rows, cols, values = [], [], []
+        for dy, dx, w in ((0, 0, (1 - fy) * (1 - fx)), (0, 1, (1 - fy) * fx),
+                          (1, 0, fy * (1 - fx)), (1, 1, fy * fx)):
+            xi, yi = x0 + dx, y0 + dy
+            inside = (xi >= 0) & (xi < b) & (yi >= 0) & (yi < b) & (w > 0)
+            rows.append(np.flatnonzero(inside))
+            cols.append((yi * b + xi)[inside].astype(np.int64))
+            values.append(w[inside])
+        return sparse.csr_matrix((np.concatenate(values).astype(np.float32),
+                                  (np.concatenate(rows), np.concatenate(cols))),
+                                 shape=(len(srcX), b * b))
+
+    def _getRotationMatrix(self, angleIndex):
+        """ Interpolation matrix of the rotation by angleIndex * angleStep
+        degrees (see transformImages), built the first time it is used. """
+        if angleIndex not in self._rotMatrices:
+            b = self.boxSize
+            c = b // 2
+            y, x = np.mgrid[:b, :b].astype(np.float64) - c
+            a = np.deg2rad(angleIndex * self.angleStep)
+            self._rotMatrices[angleIndex] = self._interpolationMatrix(
+                np.sin(a) * x + np.cos(a) * y + c,
+                np.cos(a) * x - np.sin(a) * y + c)
+        return self._rotMatrices[angleIndex]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_rotMatrices'] = {}  # rebuilt where needed
+        return state
+
+    def rotate(self, stack, angleIndexes):
+        """ Rotate each image by angleIndexes * angleStep degrees. Images
+        with the same angle are rotated with one sparse product. """
+        n, b = len(stack), self.boxSize
+        flat = stack.reshape(n, -1)
+        result = np.empty((n, b * b), dtype=np.float32)
+        angleIndexes = np.asarray(angleIndexes) % (2 * self._polarX.shape[1])
+        order = np.argsort(angleIndexes, kind='stable')
+        values, starts = np.unique(angleIndexes[order], return_index=True)
+        for a, rows in zip(values, np.split(order, starts[1:])):
+            result[rows] = (self._getRotationMatrix(int(a)) @ flat[rows].T).T
+        return result.reshape(n, b, b)
+
+    def prepare(self, stack):
+        return normalizeStack(stack, self.mask)
+
+    def polarSignatures(self, stack):
+        """ Fourier transform along the angles of the polar resampling of
+        the Fourier magnitudes, normalized, (n, rings, nAngles // 2 + 1). """
+        n = len(stack)
+        mags = np.abs(scipy.fft.fftshift(scipy.fft.fft2(stack), axes=(-2, -1)))
+        polar = (self._polarMatrix @ mags.reshape(n, -1).T.astype(np.float32)
+                 ).T.reshape((n,) + self._polarX.shape)
+        polar *= self._ringWeights
+        polar -= polar.mean(axis=(1, 2), keepdims=True)
+        polar /= np.maximum(np.linalg.norm(polar.reshape(n, -1), axis=1),
+                            1e-12)[:, None, None]
+        return scipy.fft.rfft(polar, axis=-1).astype(np.complex64)
+
+    def rotationalSearch(self, signatures, refSignatures):
+        """ Rotational correlation of every particle with every reference.
+
+        Returns:
+            (corr, angles): arrays (n, K) with the maximum correlation and
+            the index of its angle (in angleStep units, in [0, 180)).
+        """
+        nAngles = self._polarX.shape[1]
+        cross = np.einsum('nrf,krf->nkf', signatures, np.conj(refSignatures))
+        corr = scipy.fft.irfft(cross, n=nAngles, axis=-1)
+        best = corr.argmax(axis=-1)
+        return np.take_along_axis(corr, best[..., None], -1)[..., 0], best
+
+    def align(self, stack, references, refSignatures=None):
+        """ Align prepared particles to the references.
+
+        Returns:
+            (assignments, angles, shifts, scores, aligned): class index,
+            rotation (degrees), shift (n, 2) and normalized correlation of
+            each particle, and the aligned particles (see transformImages).
+        """
+        references = np.asarray(references, dtype=np.float32)
+        if refSignatures is None:
+            refSignatures = self.polarSignatures(references)
+        n, K = len(stack), len(references)
+        nCand = min(self.candidates, K)
+
+        rotCorr, rotAngles = self.rotationalSearch(
+            self.polarSignatures(stack), refSignatures)
+        candClasses = np.argsort(-rotCorr, axis=1)[:, :nCand]
+        candAngles = np.take_along_axis(rotAngles, candClasses, 1)
+        # Magnitudes do not tell a from a + 180
+        nHalf = self._polarX.shape[1]
+        candClasses = np.concatenate([candClasses, candClasses], axis=1)
+        candAngles = np.concatenate([candAngles, candAngles + nHalf], axis=1)
+
+        refFts = np.conj(scipy.fft.rfft2(references * self.mask))
+        refNorms = np.linalg.norm(references[:, self.mask], axis=1)
+        assignments = np.empty(n, dtype=np.int64)
+        angles = np.empty(n)
+        shifts = np.empty((n, 2))
+        scores = np.empty(n)
+        b = self.boxSize
+        nc = candClasses.shape[1]
+        aligned = np.empty((n, b, b), dtype=np.float32)
+
+        for start in range(0, n, self.subBatch):
+            stop = min(n, start + self.subBatch)
+            m = stop - start
+            rotated = self.rotate(np.repeat(stack[start:stop], nc, axis=0),
+                                  candAngles[start:stop].ravel())
+            masked = rotated * self.mask
+            classes = candClasses[start:stop].ravel()
+            corr = scipy.fft.irfft2(scipy.fft.rfft2(masked) * refFts[classes],
+                                    s=(b, b))
+            corr[:, ~self._shiftMask] = -np.inf
+            flat = corr.reshape(len(corr), -1).argmax(axis=1)
+            peak = corr.reshape(len(corr), -1)[np.arange(len(corr)), flat]
+            norms = np.linalg.norm(masked.reshape(len(masked), -1), axis=1)
+            ncc = (peak / np.maximum(norms * refNorms[classes], 1e-12)).reshape(m, nc)
+
+            best = ncc.argmax(axis=1)
+            pick = np.arange(m) * nc + best
+            dy, dx = np.divmod(flat[pick], b)
+            d = np.stack([self._shiftValues[dx], self._shiftValues[dy]], axis=1)
+            a = candAngles[start:stop][np.arange(m), best] * self.angleStep
+            rad = np.deg2rad(a)
+            # Shift in the particle frame, s = R(a) d
+            shifts[start:stop, 0] = np.cos(rad) * d[:, 0] - np.sin(rad) * d[:, 1]
+            shifts[start:stop, 1] = np.sin(rad) * d[:, 0] + np.cos(rad) * d[:, 1]
+            angles[start:stop] = a % 360.
+            assignments[start:stop] = classes[pick]
+            scores[start:stop] = ncc[np.arange(m), best]
+            aligned[start:stop] = shiftImages(rotated[pick], d.astype(np.int64))
+
+        aligned *= self.mask
+        return assignments, angles, shifts, scores, aligned
+
+
+def accumulate(aligned, assignments, numberOfClasses):
+    """ Sum of the aligned particles and number of particles per class. """
+    counts = np.bincount(assignments, minlength=numberOfClasses)
+    sums = np.zeros((numberOfClasses,) + aligned.shape[1:], dtype=np.float64)
+    order = np.argsort(assignments, kind='stable')
+    starts = np.concatenate([[0], np.cumsum(counts)])
+    for k in np.flatnonzero(counts):
+        sums[k] = aligned[order[starts[k]:starts[k + 1]]].sum(axis=0)
+    return sums, counts
+
+
+_workerState = {}
+
+
+def _initWorker(aligner, stackFile):
+    _workerState['aligner'] = aligner
+    _workerState['stack'] = np.load(stackFile, mmap_mode='r')
+
+
+def _alignChunk(indexes, references, refSignatures):
+    """ E-step of a chunk of particles in a worker: only the results and
+    the per-class sums are sent back. """
+    aligner = _workerState['aligner']
+    stack = np.asarray(_workerState['stack'][indexes], dtype=np.float32)
+    assignments, angles, shifts, scores, aligned = aligner.align(
+        stack, references, refSignatures)
+    sums, counts = accumulate(aligned, assignments, len(references))
+    return assignments, angles, shifts, scores, sums, counts
+
+
+class CL2D:
+    """ Mini-batch 2D classification engine.
+
+    Args:
+        numberOfClasses: final number of classes
+        numberOfInitialClasses: classes of the first iterations
+        numberOfIterations: passes over the particles per number of classes
+        batchSize: particles of a mini-batch, the references are updated
+            after each one
+        numberOfWorkers: processes of the E-step, each mini-batch is split
+            in one chunk per worker
+        seed: random seed of the initialization and the splits
+        aligner args: angularSampling, maxShift, candidates, maskRadius
+    """
+    def __init__(self, numberOfClasses, numberOfInitialClasses=4,
+                 numberOfIterations=10, batchSize=5000, numberOfWorkers=1,
+                 seed=0, **alignerArgs):
+        self.numberOfClasses = numberOfClasses
+        self.numberOfInitialClasses = min(numberOfInitialClasses,
+                                          numberOfClasses)
+        self.numberOfIterations = numberOfIterations
+        self.batchSize = batchSize
+        self.numberOfWorkers = numberOfWorkers
+        self.alignerArgs = alignerArgs
+        self.rng = np.random.default_rng(seed)
+        self.log = lambda msg: None
+
+    def _eStep(self, executor, stack, aligner, indexes, references):
+        """ Align the particles at indexes, in chunks in the pool. """
+        refSignatures = aligner.polarSignatures(references)
+        if executor is None:
+            sub = np.asarray(stack[indexes], dtype=np.float32)
+            assignments, angles, shifts, scores, aligned = aligner.align(
+                sub, references, refSignatures)
+            return (assignments, angles, shifts, scores) + \
+                accumulate(aligned, assignments, len(references))
+
+        chunks = np.array_split(indexes, self.numberOfWorkers)
+        results = list(executor.map(_alignChunk, [c for c in chunks if len(c)],
+                                    [references] * len(chunks),
+                                    [refSignatures] * len(chunks)))
+        return (np.concatenate([r[0] for r in results]),
+                np.concatenate([r[1] for r in results]),
+                np.concatenate([r[2] for r in results]),
+                np.concatenate([r[3] for r in results]),
+                sum(r[4] for r in results), sum(r[5] for r in results))
+
+    def _split(self, references, sums, counts, aligner):
+        """ Split the most populated classes, each reference is replaced by
+        two perturbed in opposite directions. """
+        nNew = min(len(references), self.numberOfClasses - len(references))
+        toSplit = np.argsort(-counts, kind='stable')[:nNew]
+        noise = self.rng.normal(0, 0.1, (nNew,) + references.shape[1:]) * aligner.mask
+        newRefs = references[toSplit] - noise
+        references = references.copy()
+        references[toSplit] += noise
+        references = np.concatenate([references, newRefs]).astype(np.float32)
+        # Statistics of the split classes start again
+        counts = np.concatenate([counts, np.zeros(nNew, dtype=counts.dtype)])
+        counts[toSplit] = 0
+        sums = np.concatenate([sums, np.zeros((nNew,) + sums.shape[1:])])
+        sums[toSplit] = 0
+        return references, sums, counts
+
+    def _reseedEmpty(self, references, counts, aligner):
+        """ Replace the references of the empty classes by perturbed
+        copies of the ones of the most populated classes. """
+        empty = np.flatnonzero(counts == 0)
+        largest = np.argsort(-counts, kind='stable')[:len(empty)]
+        for k, source in zip(empty, largest):
+            noise = self.rng.normal(0, 0.1, references.shape[1:]) * aligner.mask
+            references[k] = references[source] + noise
+
+    def _getExecutor(self, aligner, stackFile):
+        if self.numberOfWorkers <= 1:
+            return None
+        return ProcessPoolExecutor(self.numberOfWorkers,
+                                   initializer=_initWorker,
+                                   initargs=(aligner, stackFile))
+
+    def _pass(self, executor, stack, aligner, references, sums, counts,
+              results, baseSums=None, baseCounts=None):
+        """ One pass of mini-batches over all the particles of the stack.
+        sums and counts start again and accumulate this pass, the references
+        of the classes with particles are updated after each mini-batch from
+        them (plus the optional base statistics of particles not in the
+        stack). results are the (assignments, angles, shifts, scores)
+        arrays, filled in place. """
+        n = len(stack)
+        order = self.rng.permutation(n)
+        sums[:] = 0
+        counts[:] = 0
+        for start in range(0, n, self.batchSize):
+            indexes = np.sort(order[start:start + self.batchSize])
+            batchResults = self._eStep(executor, stack, aligner, indexes,
+                                       references)
+            for array, values in zip(results, batchResults[:4]):
+                array[indexes] = values
+            sums += batchResults[4]
+            counts += batchResults[5]
+            updated = counts > 0
+            totalSums, totalCounts = sums[updated], counts[updated]
+            if baseSums is not None:
+                totalSums = totalSums + baseSums[updated]
+                totalCounts = totalCounts + baseCounts[updated]
+            references[updated] = normalizeStack(
+                totalSums / totalCounts[:, None, None], aligner.mask)
+
+    def run(self, stackFile, references=None, sums=None, counts=None):
+        """ Classify the prepared particles stored in a .npy stack (see
+        Aligner2D.prepare). Optional initial references and statistics
+        continue a previous classification.
+
+        Returns:
+            A ClassificationResult, with the assignments of the last pass.
+        """
+        stack = np.load(stackFile, mmap_mode='r')
+        n, boxSize = len(stack), stack.shape[-1]
+        aligner = Aligner2D(boxSize, **self.alignerArgs)
+
+        if references is None:
+            if n == 0:
+                raise ValueError('there are no particles to classify')
+            # A first streaming batch may have less particles than classes
+            init = np.sort(self.rng.choice(n, min(self.numberOfInitialClasses, n),
+                                           replace=False))
+            references = np.asarray(stack[init], dtype=np.float32)
+        references = np.asarray(references, dtype=np.float32)
+        K = len(references)
+        sums = np.zeros((K, boxSize, boxSize)) if sums is None else np.array(sums)
+        counts = np.zeros(K, dtype=np.int64) if counts is None else np.array(counts)
+        results = (np.zeros(n, dtype=np.int64), np.zeros(n), np.zeros((n, 2)),
+                   np.zeros(n))
+
+        executor = self._getExecutor(aligner, stackFile)
+        try:
+            while True:
+                for it in range(self.numberOfIterations):
+                    # Statistics of each pass only include its assignments
+                    self._pass(executor, stack, aligner, references, sums,
+                               counts, results)
+                    self.log("Classes: %d, iteration %d, mean score %0.4f"
+                             % (len(references), it + 1, results[3].mean()))
+                    if it < self.numberOfIterations - 1:
+                        self._reseedEmpty(references, counts, aligner)
+
+                if len(references) >= self.numberOfClasses:
+                    break
+                references, sums, counts = self._split(references, sums,
+                                                       counts, aligner)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        return ClassificationResult(references, sums, counts, *results)
+
+    def update(self, stackFile, previous, maxDrift=None):
+        """ Classify new particles, stored in a .npy stack, with the classes
+        of a previous result, without aligning again its particles. Their
+        statistics are kept as they are and the new particles are added on
+        top, so only the references of the classes that receive new
+        particles change. The cost only depends on the number of new
+        particles.
+
+        Args:
+            stackFile: prepared stack of the new particles
+            previous: ClassificationResult of the classified particles
+            maxDrift: if the mean score of the new particles in the first
+                pass is lower than the one of the previous particles by
+                more than this, the new particles do not fit the current
+                classes and the update stops there (None to never stop)
+
+        Returns:
+            A tuple (result, drift): result is a ClassificationResult with
+            the updated references and statistics and the alignment of the
+            new particles, drift the difference of the mean scores.
+        """
+        stack = np.load(stackFile, mmap_mode='r')
+        n, boxSize = len(stack), stack.shape[-1]
+        aligner = Aligner2D(boxSize, **self.alignerArgs)
+
+        references = np.array(previous.references, dtype=np.float32)
+        baseSums = np.asarray(previous.sums, dtype=np.float64)
+        baseCounts = np.asarray(previous.counts, dtype=np.int64)
+        sums = np.zeros_like(baseSums)
+        counts = np.zeros_like(baseCounts)
+        results = (np.zeros(n, dtype=np.int64), np.zeros(n), np.zeros((n, 2)),
+                   np.zeros(n))
+        previousScore = float(np.mean(previous.scores))
+        drift = 0.
+
+        executor = self._getExecutor(aligner, stackFile)
+        try:
+            for it in range(self.numberOfIterations):
+                self._pass(executor, stack, aligner, references, sums, counts,
+                           results, baseSums, baseCounts)
+                if it == 0:
+                    drift = previousScore - results[3].mean()
+                self.log("New particles: %d, iteration %d, mean score %0.4f "
+                         "(classified %0.4f)" % (n, it + 1, results[3].mean(),
+                                                 previousScore))
+                if it == 0 and maxDrift is not None and drift > maxDrift:
+                    break
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        result = ClassificationResult(references, baseSums + sums,
+                                      baseCounts + counts, *results)
+        return result, drift
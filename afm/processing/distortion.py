@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Correction of the distortions caused by drift during the raster scan.
+
+AFM frames are acquired line by line, so each row of a frame sees the
+sample at a different time and the drift within one frame shears (fast
+axis) and stretches (slow axis) the image. The drift is modelled as a
+smooth function of time, fitted to the rigid shift of each frame at the
+time of its middle line, and every row is resampled with the displacement
+it had at its own acquisition time relative to that middle line. The
+corrected frames keep the rigid shift of the frame, so they can be
+aligned afterwards as usual.
+"""
+import numpy as np
+from scipy import ndimage
+from scipy.interpolate import CubicSpline
+
+
+class ScanDistortionCorrector:
+    """ Row-wise drift correction of raster-scanned frames.
+
+    Args:
+        timing: afm.objects.ScanTiming of the movie, with at least the frame
+            time (see AFMAcquisition.getTiming). The acquisition time of
+            each row comes from it, in the order of its scan direction.
+    """
+    def __init__(self, timing):
+        if not timing.frameTime:
+            raise ValueError("The frame time is needed to correct the scan "
+                             "distortions")
+        self.timing = timing
+        self.frameTime = timing.frameTime
+        self._drift = None
+
+    def fitDrift(self, shifts):
+        """ Fit the drift model to the rigid shifts (n, 2) of the frames,
+        in pixels, which are taken as the drift at the middle of each
+        frame. A cubic spline is used with enough frames, a linear model
+        otherwise. """
+        shifts = np.asarray(shifts, dtype=np.float64)
+        times = np.arange(len(shifts)) * self.frameTime
+
+        if len(shifts) >= 4:
+            self._drift = CubicSpline(times, shifts, axis=0, extrapolate=True)
+        elif len(shifts) >= 2:
+            coefs = np.polyfit(times, shifts, 1)
+            self._drift = lambda t: np.outer(t, coefs[0]) + coefs[1]
+        else:
+            self._drift = lambda t: np.zeros((np.size(t), 2))
+        return self
+
+    def getRowShifts(self, frameIndex, nLines):
+        """ Displacement (nLines, 2) of each row of a frame relative to its
+        middle line. """
+        tMid = frameIndex * self.frameTime
+        lineTimes = self.timing.getTimestamps(frameIndex, nLines)
+        # The middle line is scanned at the middle of the row times in
+        # both scan directions
+        lineTimes = lineTimes - (lineTimes.mean() - tMid)
+        return self._drift(lineTimes) - self._drift(np.array([tMid]))
+
+    def correctFrame(self, frame, rowShifts, output=None):
+        """ Resample a frame with one (dy, dx) displacement per row. """
+        ny, nx = frame.shape
+        yy, xx = np.mgrid[0:ny, 0:nx].astype(np.float32)
+        coords = [yy + rowShifts[:, 0, None], xx + rowShifts[:, 1, None]]
+        return ndimage.map_coordinates(frame, coords, output=output,
+                                       order=1, mode='nearest')
+
+    def correct(self, frames, output, blockSize=16):
+        """ Correct all the frames of a FrameStack into output, an array
+        (or mapped file) of the same shape. fitDrift must be called first. """
+        nLines = frames.shape[1]
+        for start, block in frames.iterBlocks(blockSize):
+            for i, frame in enumerate(block):
+                rowShifts = self.getRowShifts(start + i, nLines)
+                output[start + i] = self.correctFrame(frame, rowShifts)
+        return output
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Content-addressed cache of Fourier-downsampled micrographs.
+
+Downsampled micrographs are stored as MRC files named after the hash of
+the original file content and the downsampling factor, so any protocol
+(picking, extraction) or run that needs the same micrograph with the same
+factor reuses them. When the cache grows over its disk budget the least
+recently used files are removed, with the index entries that map the
+original files to their hashes.
+"""
+import hashlib
+import os
+import tempfile
+
+from .alignment import fourierBin
+
+HASH_CHUNK = 1024 * 1024
+TMP_PREFIX = '.tmp'  # files being written, ignored by the eviction
+
+
+def hashFile(fileName):
+    """ SHA1 of the content of a file. """
+    sha = hashlib.sha1()
+    with open(fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class DownsampleCache:
+    """ Disk cache of downsampled micrographs.
+
+    Args:
+        cacheDir: folder of the cache, created if needed
+        maxBytes: disk budget, older files are evicted when it is exceeded
+    """
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self._indexDir = os.path.join(cacheDir, 'index')
+        os.makedirs(self._indexDir, exist_ok=True)
+
+    def getKey(self, fileName):
+        """ Content hash of a file. It is remembered in an index entry per
+        path, together with the size and modification time of the file, so
+        unchanged files are hashed only once. """
+        st = os.stat(fileName)
+        stamp = '%d:%d' % (st.st_size, st.st_mtime_ns)
+        indexFn = os.path.join(self._indexDir, hashlib.sha1(
+            os.path.realpath(fileName).encode()).hexdigest())
+        try:
+            with open(indexFn) as f:
+                values = f.read().split()
+            if len(values) == 2 and values[0] == stamp:
+                return values[1]
+        except FileNotFoundError:
+            pass
+
+        key = hashFile(fileName)
+
+        def _write(fn):
+            with open(fn, 'w') as f:
+                f.write('%s %s' % (stamp, key))
+
+        self._writeAtomic(indexFn, _write)
+        return key
+
+    def getPath(self, fileName, downFactor):
+        return os.path.join(self.cacheDir, '%s_%0.4f.mrc'
+                            % (self.getKey(fileName), downFactor))
+
+    def _writeAtomic(self, fileName, writeFunc):
+        """ Write to a temporary file that is renamed when complete, so
+        concurrent readers never see a partial file (and the eviction
+        never removes it). """
+        fd, tmpFn = tempfile.mkstemp(dir=os.path.dirname(fileName),
+                                     prefix=TMP_PREFIX,
+                                     suffix=os.path.splitext(fileName)[1])
+        os.close(fd)
+        try:
+            writeFunc(tmpFn)
+            os.replace(tmpFn, fileName)
+        except BaseException:
+            if os.path.exists(tmpFn):
+                os.remove(tmpFn)
+            raise
+
+    def get(self, fileName, downFactor, numberOfThreads=1):
+        """ Return the path of the downsampled micrograph, computing it by
+        Fourier cropping if it is not in the cache. """
+        import mrcfile
+        from afm.convert.frames import FrameStack
+
+        cachedFn = self.getPath(fileName, downFactor)
+        if os.path.exists(cachedFn):
+            os.utime(cachedFn)  # most recently used
+            return cachedFn
+
+        with FrameStack(fileName) as frames:
+            image = fourierBin(frames[0], downFactor, numberOfThreads)
+
+        def _write(fn):
+            with mrcfile.new(fn, overwrite=True) as mrc:
+                mrc.set_data(image.astype('float32'))
+
+        self._writeAtomic(cachedFn, _write)
+        self.evict(keep=cachedFn)
+        return cachedFn
+
+    def load(self, fileName, downFactor, numberOfThreads=1):
+        """ Downsampled micrograph as an array (read from the cache). """
+        import mrcfile
+        with mrcfile.open(self.get(fileName, downFactor, numberOfThreads),
+                          permissive=True) as mrc:
+            return mrc.data.copy()
+
+    def evict(self, keep=None):
+        """ Remove the least recently used micrographs until the cache,
+        index included, fits in its disk budget. The index entries of the
+        removed micrographs are removed too. """
+        entries = []
+        indexSize = 0
+        for folder in (self.cacheDir, self._indexDir):
+            for entry in self._iterFiles(folder):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:  # removed by another process
+                    continue
+                if folder == self._indexDir:
+                    indexSize += st.st_size
+                elif entry.name.endswith('.mrc'):
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(e[1] for e in entries) + indexSize
+        removed = False
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # removed by another process
+                pass
+            total -= size
+            removed = True
+
+        if removed:
+            self._cleanIndex()
+
+    def _cleanIndex(self):
+        """ Remove the index entries of the files without any downsampled
+        micrograph in the cache. """
+        keys = {entry.name.rsplit('_', 1)[0]
+                for entry in self._iterFiles(self.cacheDir)
+                if entry.name.endswith('.mrc')}
+        for entry in self._iterFiles(self._indexDir):
+            try:
+                with open(entry.path) as f:
+                    values = f.read().split()
+                if len(values) != 2 or values[1] not in keys:
+                    os.remove(entry.path)
+            except FileNotFoundError:  # removed by another process
+                pass
+
+    @staticmethod
+    def _iterFiles(folder):
+        """ Complete files of a cache folder, without the temporary ones. """
+        for entry in os.scandir(folder):
+            if not entry.name.startswith(TMP_PREFIX) and entry.is_file():
+                yield entry
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Particle extraction on numpy stacks. All the boxes of a micrograph are cut
+with a single gather of whole boxes from a sliding window view (reading
+only the touched pages when the micrograph is memory mapped), so the
+preprocessing (see normalization) can be applied to the whole
+(N, box, box) stack at once.
+"""
+import heapq
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def getBoxIndexes(positions, boxSize):
+    """ Row and column indexes (N, box, 1) and (N, 1, box) of the boxes
+    centered at positions (N, 2) given as (x, y). """
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+    offsets = np.arange(boxSize) - boxSize // 2
+    rows = positions[:, 1, None, None] + offsets[None, :, None]
+    cols = positions[:, 0, None, None] + offsets[None, None, :]
+    return rows, cols
+
+
+def extractBoxes(image, positions, boxSize, doBorders=False):
+    """ Cut square boxes from an image.
+
+    Args:
+        image: 2D array (it may be a memory-mapped file)
+        positions: (N, 2) array of box centers (x, y) in pixels
+        boxSize: size of the boxes in pixels
+        doBorders: if True, pixels outside the image are filled with the
+            closest pixel of the image, otherwise boxes that do not fit in
+            the image are skipped
+
+    Returns:
+        A tuple (stack, valid): stack is a float32 array (M, box, box) with
+        the extracted boxes and valid a boolean mask (N,) of the positions
+        that were extracted.
+    """
+    ny, nx = image.shape
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+    x0 = positions[:, 0] - boxSize // 2
+    y0 = positions[:, 1] - boxSize // 2
+    inside = ((x0 >= 0) & (x0 + boxSize <= nx) &
+              (y0 >= 0) & (y0 + boxSize <= ny))
+    valid = np.ones(len(positions), dtype=bool) if doBorders else inside
+
+    # The boxes inside the image are gathered as whole blocks from a
+    # window view, the rest pixel by pixel with clipped indexes
+    if inside.any():
+        windows = sliding_window_view(image, (boxSize, boxSize))
+        insideBoxes = windows[y0[inside], x0[inside]]
+        if inside.all():
+            return np.asarray(insideBoxes, dtype=np.float32), valid
+    stack = np.empty((np.count_nonzero(valid), boxSize, boxSize),
+                     dtype=np.float32)
+    if inside.any():
+        stack[inside[valid]] = insideBoxes
+    outside = valid & ~inside
+    if outside.any():
+        rows, cols = getBoxIndexes(positions[outside], boxSize)
+        stack[outside[valid]] = image[np.clip(rows, 0, ny - 1),
+                                      np.clip(cols, 0, nx - 1)]
+    return stack, valid
+
+
+def balanceChunks(weights, numberOfChunks):
+    """ Split items in chunks of similar total weight, assigning the
+    heaviest items first to the lightest chunk (LPT scheduling).
+
+    Returns:
+        A list of lists of item indexes, without empty chunks.
+    """
+    numberOfChunks = max(1, min(numberOfChunks, len(weights)))
+    heap = [(0, i) for i in range(numberOfChunks)]
+    chunks = [[] for _ in range(numberOfChunks)]
+
+    for index in sorted(range(len(weights)), key=lambda i: -weights[i]):
+        total, chunk = heapq.heappop(heap)
+        chunks[chunk].append(index)
+        heapq.heappush(heap, (total + weights[index], chunk))
+
+    return [sorted(c) for c in chunks if c]
+
+
+class ParticleExtractor:
+    """ Extraction and preprocessing of the particles of a micrograph.
+
+    Args:
+        boxSize: size of the particles in the (downsampled) micrograph
+        doBorders: fill pixels outside the micrograph, see extractBoxes
+        downFactor: Fourier downsampling applied to the micrograph
+        dustThreshold: threshold for removeDust, no dust removal if None
+        doInvert: invert the contrast
+        normalizeArgs: (method, backRadius) of StackNormalizer, or None
+        patchSize: patch size (in downsampled pixels) of the noisy-zone
+            scores, see scoring.noisyZoneScores, not computed if None
+        cache: DownsampleCache where the downsampled micrographs are read
+            from (and stored), if None they are downsampled in memory
+    """
+    def __init__(self, boxSize, doBorders=False, downFactor=1.,
+                 dustThreshold=None, doInvert=False, normalizeArgs=None,
+                 patchSize=None, cache=None):
+        self.boxSize = boxSize
+        self.patchSize = patchSize
+        self.doBorders = doBorders
+        self.downFactor = downFactor
+        self.dustThreshold = dustThreshold
+        self.doInvert = doInvert
+        self.normalizeArgs = normalizeArgs
+        self.cache = cache
+
+    def extract(self, fileName, positions):
+        """ Extract and preprocess the particles at positions (N, 2) given
+        as (x, y) in the downsampled micrograph.
+
+        Returns:
+            (stack, valid, scores): stack and valid as extractBoxes and
+            scores an array (M, 2) with the noisy-zone scores of the
+            extracted particles, or None.
+        """
+        from afm.convert.frames import FrameStack
+        from .alignment import fourierBin
+        from .normalization import removeDust, StackNormalizer
+        from .scoring import noisyZoneScores
+
+        scores = None
+        if self.cache is not None and abs(self.downFactor - 1) > 0.0001:
+            fileName = self.cache.get(fileName, self.downFactor)
+        with FrameStack(fileName) as frames:
+            image = frames[0]
+            if self.cache is None and abs(self.downFactor - 1) > 0.0001:
+                image = fourierBin(image, self.downFactor)
+            stack, valid = extractBoxes(image, positions, self.boxSize,
+                                        self.doBorders)
+            if self.patchSize:
+                scores = noisyZoneScores(image, np.asarray(positions)[valid],
+                                         self.patchSize)
+
+        if self.dustThreshold is not None:
+            removeDust(stack, self.dustThreshold)
+        if self.doInvert:
+            stack *= -1
+        if self.normalizeArgs:
+            StackNormalizer(self.boxSize, *self.normalizeArgs)(stack)
+
+        return stack, valid, scores
+
+    def _extractToBuffer(self, bufferFn, offset, fileName, positions):
+        """ Extract into the mapped buffer file (total, box, box) at offset,
+        only the valid mask and scores are sent back to the parent
+        process. """
+        stack, valid, scores = self.extract(fileName, positions)
+        buffer = np.load(bufferFn, mmap_mode='r+')
+        buffer[offset:offset + len(stack)] = stack
+        buffer.flush()
+        del buffer
+        return valid, scores
+
+    def extractMany(self, jobs, numberOfWorkers=1, tmpDir=None):
+        """ Extract the particles of several micrographs in a pool of
+        processes. The workers write the stacks in a buffer file mapped in
+        memory and sized for all the positions, so no pixel data is pickled.
+        The file lives in tmpDir instead of shared memory (/dev/shm is often
+        small, e.g. in containers), and it is only held in memory as far as
+        the page cache allows.
+
+        Args:
+            jobs: list of (fileName, positions)
+            numberOfWorkers: number of processes
+            tmpDir: folder for the buffer file, the system temporary folder
+                if None
+
+        Returns:
+            A generator of (jobIndex, stack, valid, scores), in the order
+            the jobs finish. stack is a view of the buffer only valid until
+            the next item is requested.
+        """
+        counts = [len(positions) for _, positions in jobs]
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(int)
+        total = int(offsets[-1])
+
+        if numberOfWorkers <= 1 or len(jobs) < 2 or total == 0:
+            for i, (fileName, positions) in enumerate(jobs):
+                yield (i,) + self.extract(fileName, positions)
+            return
+
+        fd, bufferFn = tempfile.mkstemp(prefix='extract_', suffix='.npy',
+                                        dir=tmpDir)
+        os.close(fd)
+        buffer = np.lib.format.open_memmap(
+            bufferFn, mode='w+', dtype=np.float32,
+            shape=(total, self.boxSize, self.boxSize))
+        try:
+            with ProcessPoolExecutor(max_workers=numberOfWorkers) as executor:
+                futures = {executor.submit(self._extractToBuffer, bufferFn,
+                                           int(offsets[i]), fileName, positions): i
+                           for i, (fileName, positions) in enumerate(jobs)}
+                for future in as_completed(futures):
+                    i = futures[future]
+                    valid, scores = future.result()
+                    start = offsets[i]
+                    yield (i, buffer[start:start + np.count_nonzero(valid)],
+                           valid, scores)
+        finally:
+            del buffer
+            os.remove(bufferFn)
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Background leveling of AFM height maps. The tilt of the sample is removed
+by subtracting a least-squares plane, fitted to the whole image or only to
+the pixels of a background mask.
+
+Stacks of frames are leveled by StackLeveler: a polynomial background
+(plane, bow...) is fitted to all the frames at once as a batched
+least-squares problem, whose normal equations are built from the moments
+of the frames along rows and columns (two matrix products for the whole
+stack), and then the offset (median) or a low-order polynomial of each
+scan line is removed. The features (pixels much higher than the
+background) are excluded from the fits after the first iteration.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+# Line flattening methods
+LINE_NONE = 'none'
+LINE_MEDIAN = 'median'
+LINE_POLYNOMIAL = 'polynomial'
+
+
+def fitPlane(image, mask=None):
+    """ Least-squares plane z = a + b * x + c * y of an image.
+
+    The normal equations are built from the row and column sums of the
+    (masked) image, so no design matrix of the size of the image is needed
+    and the image is read only once.
+
+    Args:
+        image: 2D array
+        mask: optional boolean array, only its True pixels are fitted
+
+    Returns:
+        The (a, b, c) coefficients, x and y in pixels.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    ny, nx = image.shape
+    x = np.arange(nx, dtype=np.float64)
+    y = np.arange(ny, dtype=np.float64)
+
+    if mask is None:
+        z = image
+        wRows, wCols = np.full(ny, float(nx)), np.full(nx, float(ny))
+        wxy = y.sum() * x.sum()
+    else:
+        w = np.asarray(mask, dtype=np.float32)
+        z = image * w
+        wRows, wCols = w.sum(axis=1, dtype=np.float64), w.sum(axis=0, dtype=np.float64)
+        wxy = y @ (w @ x.astype(np.float32))
+
+    zRows = z.sum(axis=1, dtype=np.float64)
+    zCols = z.sum(axis=0, dtype=np.float64)
+    n = wRows.sum()
+    if n < 3:
+        return np.array([zRows.sum() / max(n, 1), 0., 0.])
+
+    sx, sy = wCols @ x, wRows @ y
+    a = np.array([[n, sx, sy],
+                  [sx, wCols @ x ** 2, wxy],
+                  [sy, wxy, wRows @ y ** 2]])
+    b = np.array([zRows.sum(), zCols @ x, zRows @ y])
+    return np.linalg.lstsq(a, b, rcond=None)[0]
+
+
+def getPlane(coeffs, shape, dtype=np.float32):
+    """ Image of the plane with the given fitPlane coefficients. """
+    a, b, c = coeffs
+    ny, nx = shape
+    rowTerm = (a + b * np.arange(nx)).astype(dtype)
+    colTerm = (c * np.arange(ny)).astype(dtype)
+    return colTerm[:, None] + rowTerm[None, :]
+
+
+def robustStats(image, step=4):
+    """ Median and standard deviation (from the median absolute
+    deviation) of an image, estimated on a grid of one every step pixels
+    in each dimension. """
+    sample = np.asarray(image)[::step, ::step]
+    center = np.median(sample)
+    return center, 1.4826 * np.median(np.abs(sample - center))
+
+
+def levelPlane(image, iterations=2, threshold=2.):
+    """ Subtract the background plane of a height map.
+
+    The first plane is fitted to all the pixels, then it is refitted
+    iterations - 1 times excluding the pixels higher than threshold times
+    the (robust) standard deviation of the leveled image, so particles on
+    the surface do not tilt the plane.
+
+    Returns:
+        (leveled, background): the float32 leveled image and the boolean
+        mask of the pixels used in the last fit.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    mask = None
+    leveled = image
+    for i in range(max(1, iterations)):
+        leveled = image - getPlane(fitPlane(image, mask), image.shape)
+        if i < iterations - 1:
+            center, sigma = robustStats(leveled)
+            mask = leveled < center + threshold * sigma
+    return leveled, np.ones(image.shape, dtype=bool) if mask is None else mask
+
+
+def getPolynomialTerms(order):
+    """ Exponents (i, j) of the terms x^i * y^j of a 2D polynomial. """
+    return [(i, d - i) for d in range(order + 1) for i in range(d, -1, -1)]
+
+
+def getPowers(size, maxPower, dtype=np.float64):
+    """ Powers 0..maxPower (size, maxPower + 1) of the pixel coordinates
+    normalized to [-1, 1], to keep the normal equations well conditioned. """
+    t = np.linspace(-1., 1., size) if size > 1 else np.zeros(1)
+    return (t[:, None] ** np.arange(maxPower + 1)).astype(dtype)
+
+
+def _solve(gram, rhs):
+    """ Solve gram @ c = rhs for batches of small systems, with a tiny
+    ridge so the singular ones (e.g. few unmasked pixels) do not fail. """
+    k = gram.shape[-1]
+    ridge = 1e-9 * np.trace(gram, axis1=-2, axis2=-1)[..., None, None] + 1e-12
+    return np.linalg.solve(gram + ridge * np.eye(k), rhs[..., None])[..., 0]
+
+
+def fitPolynomials(stack, order=1, masks=None):
+    """ Least-squares 2D polynomial of each frame of a stack, solved for
+    all the frames at once.
+
+    The normal equations only need the moments sum(z * x^i * y^j) of each
+    frame, computed for the whole stack with two matrix products. Without
+    masks all the frames share the same normal matrix.
+
+    Args:
+        stack: array (n, y, x)
+        order: order of the polynomial, see getPolynomialTerms
+        masks: optional boolean array (n, y, x), only the True pixels are
+            fitted
+
+    Returns:
+        An array (n, terms) with the coefficients, for coordinates
+        normalized as in getPowers.
+    """
+    stack = np.asarray(stack, dtype=np.float32)
+    n, ny, nx = stack.shape
+    terms = getPolynomialTerms(order)
+    ii, jj = np.array(terms).T
+    px, py = getPowers(nx, 2 * order), getPowers(ny, 2 * order)
+
+    def _moments(images, maxPower):
+        partial = images @ px[:, :maxPower + 1].astype(np.float32)
+        return np.matmul(py[:, :maxPower + 1].T, partial.astype(np.float64))
+
+    if masks is None:
+        rhs = _moments(stack, order)[:, jj, ii]
+        gram = np.outer(py.sum(axis=0), px.sum(axis=0))
+        gram = gram[jj[:, None] + jj[None, :], ii[:, None] + ii[None, :]]
+        return _solve(gram, rhs)
+
+    weights = np.asarray(masks, dtype=np.float32)
+    rhs = _moments(stack * weights, order)[:, jj, ii]
+    gram = _moments(weights, 2 * order)
+    gram = gram[:, jj[:, None] + jj[None, :], ii[:, None] + ii[None, :]]
+    return _solve(gram, rhs)
+
+
+def getPolynomials(coeffs, shape, order=1):
+    """ Images (n, y, x) float32 of the polynomials of fitPolynomials. """
+    coeffs = np.atleast_2d(coeffs)
+    ny, nx = shape
+    matrix = np.zeros((len(coeffs), order + 1, order + 1), dtype=np.float32)
+    for t, (i, j) in enumerate(getPolynomialTerms(order)):
+        matrix[:, j, i] = coeffs[:, t]
+    px = getPowers(nx, order, np.float32)
+    py = getPowers(ny, order, np.float32)
+    return np.matmul(np.matmul(py, matrix), px.T)
+
+
+def getLineMedians(stack, masks=None):
+    """ Median of each line (n, y) of a stack, only of the True pixels of
+    masks if given. Lines without any of them use all their pixels. """
+    stack = np.asarray(stack, dtype=np.float32)
+    medians = np.median(stack, axis=-1)
+    if masks is None:
+        return medians
+
+    values = np.where(masks, stack, np.inf)
+    values.sort(axis=-1)
+    counts = masks.sum(axis=-1)
+    low = np.maximum(counts - 1, 0) // 2
+    high = np.minimum(counts // 2, stack.shape[-1] - 1)
+    masked = 0.5 * (np.take_along_axis(values, low[..., None], -1)[..., 0] +
+                    np.take_along_axis(values, high[..., None], -1)[..., 0])
+    return np.where(counts > 0, masked, medians)
+
+
+def fitLinePolynomials(stack, order=1, masks=None):
+    """ Least-squares polynomial of each line of a stack, for all the lines
+    at once. Lines with fewer masked pixels than coefficients use all their
+    pixels.
+
+    Returns:
+        An array (n, y, order + 1) with the coefficients, for the
+        coordinates of getPowers.
+    """
+    stack = np.asarray(stack, dtype=np.float32)
+    nx = stack.shape[-1]
+    px = getPowers(nx, 2 * order, np.float32)
+    if masks is None:
+        weights = np.ones(stack.shape[:-1] + (1,), dtype=np.float32)
+        gram = np.broadcast_to(px.sum(axis=0), stack.shape[:-1] + (2 * order + 1,))
+    else:
+        weights = np.asarray(masks, dtype=np.float32)
+        few = weights.sum(axis=-1) < order + 1
+        weights[few] = 1
+        gram = weights @ px
+    rhs = (stack * weights) @ px[:, :order + 1]
+    k = np.arange(order + 1)
+    gram = np.asarray(gram, dtype=np.float64)[..., k[:, None] + k[None, :]]
+    return _solve(gram, rhs.astype(np.float64))
+
+
+def getFeatureMasks(stack, threshold=2., step=4):
+    """ Background masks (n, y, x) of a leveled stack: False for the pixels
+    higher than threshold times the robust standard deviation of their
+    frame (see robustStats). """
+    n = len(stack)
+    sample = np.asarray(stack)[:, ::step, ::step].reshape(n, -1)
+    center = np.median(sample, axis=1)
+    sigma = 1.4826 * np.median(np.abs(sample - center[:, None]), axis=1)
+    return stack < (center + threshold * sigma)[:, None, None]
+
+
+_workerLeveler = None
+
+
+def _initWorker(leveler):
+    global _workerLeveler
+    _workerLeveler = leveler
+
+
+def _levelInWorker(inputFn, outputFn, start, stop):
+    return _workerLeveler._levelChunk(inputFn, outputFn, start, stop)
+
+
+class StackLeveler:
+    """ Polynomial background leveling and line flattening of stacks of
+    height maps (movies or micrographs).
+
+    Args:
+        planeOrder: order of the background polynomial (0 offset, 1 plane,
+            2 bow...), no background is removed if negative
+        lineMethod: LINE_NONE, LINE_MEDIAN (offset of each line) or
+            LINE_POLYNOMIAL (polynomial of lineOrder of each line)
+        lineOrder: order of the polynomial of each line
+        iterations: number of fits, the features found in the result of
+            each one are excluded from the next (1 to not mask them)
+        threshold: features are the pixels higher than threshold times the
+            robust standard deviation of the leveled frame
+        chunkSize: frames per chunk in levelFiles
+    """
+    def __init__(self, planeOrder=1, lineMethod=LINE_MEDIAN, lineOrder=1,
+                 iterations=2, threshold=2., chunkSize=16):
+        self.planeOrder = planeOrder
+        self.lineMethod = lineMethod
+        self.lineOrder = lineOrder
+        self.iterations = max(1, iterations)
+        self.threshold = threshold
+        self.chunkSize = chunkSize
+
+    def level(self, stack, masks=None):
+        """ Level a stack (n, y, x), or a single image.
+
+        Returns:
+            (leveled, masks): the float32 leveled stack and the background
+            masks used in the last fit (None if no feature was masked).
+        """
+        stack = np.asarray(stack, dtype=np.float32)
+        if stack.ndim == 2:
+            leveled, masks = self.level(stack[None], masks)
+            return leveled[0], None if masks is None else masks[0]
+
+        leveled = stack
+        for it in range(self.iterations):
+            if it > 0:
+                masks = getFeatureMasks(leveled, self.threshold)
+            leveled = stack
+            if self.planeOrder >= 0:
+                coeffs = fitPolynomials(stack, self.planeOrder, masks)
+                leveled = stack - getPolynomials(coeffs, stack.shape[1:],
+                                                 self.planeOrder)
+            if self.lineMethod == LINE_MEDIAN:
+                leveled = leveled - getLineMedians(leveled, masks)[..., None]
+            elif self.lineMethod == LINE_POLYNOMIAL:
+                coeffs = fitLinePolynomials(leveled, self.lineOrder, masks)
+                px = getPowers(stack.shape[-1], self.lineOrder, np.float32)
+                leveled = leveled - (coeffs.astype(np.float32) @ px.T)
+        return leveled.astype(np.float32, copy=False), masks
+
+    def _levelChunk(self, inputFn, outputFn, start, stop):
+        """ Level frames start:stop of a file into the memory-mapped output
+        stack, only these frames are read. """
+        import mrcfile
+        from afm.convert.frames import FrameStack
+
+        with FrameStack(inputFn) as frames:
+            for _, block in frames[start:stop].iterBlocks(blockSize=stop - start,
+                                                          scaled=True):
+                leveled, _ = self.level(block)
+        with mrcfile.mmap(outputFn, mode='r+') as mrc:
+            data = mrc.data if mrc.data.ndim == 3 else mrc.data[None]
+            data[start:stop] = leveled
+        return stop - start
+
+    def levelFiles(self, jobs, numberOfWorkers=1, voxelSize=None):
+        """ Level the frames of several files into float32 MRC stacks, in
+        chunks of chunkSize frames distributed to a pool of processes. The
+        chunks are read from and written to memory-mapped files, so no
+        pixel data is sent between processes.
+
+        Args:
+            jobs: list of (inputFn, outputFn)
+            numberOfWorkers: number of processes
+            voxelSize: voxel size in Å of the output files
+
+        Returns:
+            A generator of job indexes, each one when all the frames of its
+            file are written. Files without frames are yielded right away
+            and no output file is written for them.
+        """
+        import mrcfile
+        from afm.convert.frames import FrameStack
+
+        chunks = []
+        pending = []
+        for i, (inputFn, outputFn) in enumerate(jobs):
+            with FrameStack(inputFn) as frames:
+                n, ny, nx = frames.shape
+            pending.append(0)
+            if n == 0:
+                yield i
+                continue
+            with mrcfile.new_mmap(outputFn, shape=(n, ny, nx) if n > 1 else (ny, nx),
+                                  mrc_mode=2, overwrite=True) as mrc:
+                if voxelSize:
+                    mrc.voxel_size = voxelSize
+            for start in range(0, n, self.chunkSize):
+                stop = min(n, start + self.chunkSize)
+                chunks.append((i, inputFn, outputFn, start, stop))
+                pending[i] += 1
+
+        if numberOfWorkers <= 1 or len(chunks) < 2:
+            for i, inputFn, outputFn, start, stop in chunks:
+                self._levelChunk(inputFn, outputFn, start, stop)
+                pending[i] -= 1
+                if pending[i] == 0:
+                    yield i
+            return
+
+        with ProcessPoolExecutor(max_workers=numberOfWorkers,
+                                 initializer=_initWorker,
+                                 initargs=(self,)) as executor:
+            futures = {executor.submit(_levelInWorker, *chunk[1:]): chunk[0]
+                       for chunk in chunks}
+            for future in as_completed(futures):
+                future.result()
+                i = futures[future]
+                pending[i] -= 1
+                if pending[i] == 0:
+                    yield i
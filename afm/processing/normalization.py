@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Preprocessing kernels for particle stacks (N, box, box), equivalent to
+the Xmipp dust removal (--bad_pixels outliers) and normalization
+(OldXmipp, NewXmipp and Ramp methods) but applied to all the particles at
+once instead of one image per program call.
+"""
+import numpy as np
+
+OLD_XMIPP = 'OldXmipp'
+NEW_XMIPP = 'NewXmipp'
+RAMP = 'Ramp'
+
+
+def removeDust(stack, threshold, seed=None):
+    """ Replace the pixels further than threshold standard deviations from
+    the mean of their image by random values from a Gaussian with the mean
+    and standard deviation of the image. The stack is modified in place. """
+    mean = stack.mean(axis=(1, 2), keepdims=True)
+    std = stack.std(axis=(1, 2), keepdims=True)
+    outliers = np.abs(stack - mean) > threshold * std
+    n = np.count_nonzero(outliers)
+    if n:
+        # Only draw as many random values as outliers
+        idx = np.nonzero(outliers)[0]
+        rng = np.random.default_rng(seed)
+        noise = rng.standard_normal(n).astype(stack.dtype)
+        stack[outliers] = noise * std[idx, 0, 0] + mean[idx, 0, 0]
+    return stack
+
+
+def getBackgroundMask(boxSize, radius=None):
+    """ Pixels of a box outside the circle of the given radius (centered
+    at boxSize // 2). A radius <= 0 or None means half the box size, as the
+    background radius of the extraction protocol. """
+    if radius is None or radius <= 0:
+        radius = boxSize // 2
+    y, x = np.mgrid[0:boxSize, 0:boxSize] - boxSize // 2
+    return x ** 2 + y ** 2 > radius ** 2
+
+
+class StackNormalizer:
+    """ Normalization of particle stacks with a precomputed background mask
+    and, for the Ramp method, the precomputed pseudo-inverse of the plane
+    fit, so the planes of all the particles are solved with one matrix
+    product.
+
+    Args:
+        boxSize: size of the particles
+        method: OldXmipp (mean 0 and std 1 of the whole image), NewXmipp
+            (mean 0 and std 1 of the background) or Ramp (subtract the plane
+            fitted to the background, then NewXmipp)
+        backRadius: radius of the background circle, half the box if <= 0
+    """
+    def __init__(self, boxSize, method=RAMP, backRadius=None):
+        if method not in (OLD_XMIPP, NEW_XMIPP, RAMP):
+            raise ValueError("unknown normalization method '%s'" % method)
+        self.boxSize = boxSize
+        self.method = method
+        self.mask = getBackgroundMask(boxSize, backRadius)
+        if not self.mask.any():
+            raise ValueError('the background circle leaves no background '
+                             'pixels in a %d px box' % boxSize)
+
+        if method == RAMP:
+            y, x = np.nonzero(self.mask)
+            design = np.stack([x, y, np.ones_like(x)], axis=1).astype(np.float64)
+            self._pinv = np.linalg.pinv(design).astype(np.float32)  # (3, nBg)
+            yy, xx = np.mgrid[0:boxSize, 0:boxSize].astype(np.float32)
+            self._planes = np.stack([xx, yy, np.ones_like(xx)])  # (3, box, box)
+            self._backgroundPlanes = self._planes[:, self.mask]  # (3, nBg)
+
+    def __call__(self, stack):
+        """ Normalize a float stack (N, box, box) in place. """
+        if self.method == OLD_XMIPP:
+            stack -= stack.mean(axis=(1, 2), keepdims=True)
+            stack /= np.maximum(stack.std(axis=(1, 2), keepdims=True), 1e-12)
+            return stack
+
+        background = stack[:, self.mask]  # (N, nBg)
+        if self.method == RAMP:
+            coefs = background @ self._pinv.T  # (N, 3)
+            stack -= np.tensordot(coefs, self._planes, axes=1).astype(stack.dtype)
+            background -= coefs @ self._backgroundPlanes
+
+        mean = background.mean(axis=1)
+        std = np.maximum(background.std(axis=1), 1e-12)
+        stack -= mean[:, None, None]
+        stack /= std[:, None, None]
+        return stack
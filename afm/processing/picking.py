@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Particle picking for AFM height maps.
+
+Each micrograph is compared with a bank of rotated copies of the templates
+by normalized cross-correlation (NCC). The correlation with all the
+templates of the bank is computed with batched FFTs against the single
+transform of the micrograph, and the local normalization with the
+transforms of the (circular) template mask, so the cost per template is
+one inverse FFT. Peaks of the maximum NCC map are selected by greedy
+non-maximum suppression over a KD-tree of the candidates.
+
+The blob detector is a fast first pass for isolated molecules on a flat
+support: the leveled height map is thresholded and its connected
+components, filtered by area, height and eccentricity, are the particles.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import scipy.fft
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+
+def getCircularMask(boxSize, radius=None):
+    """ Boolean disk of the given radius (half the box if None). """
+    radius = boxSize / 2. if radius is None else radius
+    c = (boxSize - 1) / 2.
+    y, x = np.ogrid[:boxSize, :boxSize]
+    return (x - c) ** 2 + (y - c) ** 2 <= radius ** 2
+
+
+def makeTemplateBank(templates, angularStep=10., mask=None):
+    """ Rotated copies of the templates, with zero mean and unit norm inside
+    the mask and zero outside, so the correlation with them is the NCC
+    numerator.
+
+    Args:
+        templates: array (n, box, box) (or a single template)
+        angularStep: degrees between rotations, no rotations if <= 0
+        mask: boolean (box, box) mask, the inscribed disk if None
+
+    Returns:
+        A tuple (bank, angles): bank is a float32 array (n * rotations,
+        box, box) and angles the rotation in degrees of each template.
+    """
+    templates = np.asarray(templates, dtype=np.float32)
+    if templates.ndim == 2:
+        templates = templates[np.newaxis]
+    boxSize = templates.shape[-1]
+    mask = getCircularMask(boxSize) if mask is None else mask
+    angles = (np.arange(0, 360, angularStep) if angularStep > 0
+              else np.zeros(1))
+
+    bank = np.empty((len(templates) * len(angles), boxSize, boxSize),
+                    dtype=np.float32)
+    for i, template in enumerate(templates):
+        for j, angle in enumerate(angles):
+            bank[i * len(angles) + j] = (template if angle == 0 else
+                                         ndimage.rotate(template, angle,
+                                                        reshape=False,
+                                                        order=1, mode='nearest'))
+
+    values = bank[:, mask]
+    values -= values.mean(axis=1, keepdims=True)
+    values /= np.maximum(np.linalg.norm(values, axis=1, keepdims=True), 1e-12)
+    bank[:] = 0
+    bank[:, mask] = values
+
+    return bank, np.tile(angles, len(templates)).astype(np.float32)
+
+
+def suppressNonMaxima(positions, scores, minDistance, maxPeaks=None):
+    """ Greedy non-maximum suppression: keep the best scored position and
+    discard its neighbours closer than minDistance, then the next one...
+
+    Returns:
+        The indexes of the kept positions, sorted by decreasing score.
+    """
+    order = np.argsort(-scores, kind='stable')
+    if minDistance <= 0 or len(order) < 2:
+        return order[:maxPeaks]
+
+    tree = cKDTree(positions)
+    neighbours = tree.query_ball_point(positions, r=minDistance)
+    suppressed = np.zeros(len(positions), dtype=bool)
+    keep = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        if maxPeaks and len(keep) >= maxPeaks:
+            break
+        suppressed[neighbours[i]] = True
+
+    return np.array(keep, dtype=np.int64)
+
+
+_workerPicker = None
+
+
+def _initWorker(picker):
+    global _workerPicker
+    _workerPicker = picker
+
+
+def _pickInWorker(fileName):
+    return _workerPicker.pick(fileName)
+
+
+class Picker:
+    """ Base class of the pickers, that load the (downsampled) micrographs
+    and pick them one by one or in a pool of processes. Subclasses
+    implement pickImage.
+
+    Args:
+        downFactor: Fourier downsampling applied to the micrographs
+        cache: DownsampleCache used for the downsampled micrographs
+    """
+    def __init__(self, downFactor=1., cache=None):
+        self.downFactor = downFactor
+        self.cache = cache
+
+    def _loadImage(self, fileName):
+        from afm.convert.frames import FrameStack
+
+        downsample = abs(self.downFactor - 1) > 0.0001
+        if downsample and self.cache is not None:
+            return self.cache.load(fileName, self.downFactor)
+        with FrameStack(fileName) as frames:
+            image = np.array(frames[0], dtype=np.float32)
+        if downsample:
+            from .alignment import fourierBin
+            image = fourierBin(image, self.downFactor)
+        return image
+
+    def pickImage(self, image):
+        """ Return a tuple whose first item are the picked positions (N, 2)
+        as (x, y). """
+        raise NotImplementedError
+
+    def pick(self, fileName):
+        """ Pick the particles of a micrograph file, positions are given in
+        pixels of the downsampled micrograph. """
+        return self.pickImage(self._loadImage(fileName))
+
+    def pickMany(self, fileNames, numberOfWorkers=1):
+        """ Pick several micrographs in a pool of processes.
+
+        Returns:
+            A generator of (index, *pickImage results), in the order the
+            micrographs finish.
+        """
+        if numberOfWorkers <= 1 or len(fileNames) < 2:
+            for i, fileName in enumerate(fileNames):
+                yield (i,) + self.pick(fileName)
+            return
+
+        # The picker is sent once to each worker, so its precomputed data
+        # (e.g. the transforms of a template bank) is reused by all the
+        # micrographs picked by a worker
+        with ProcessPoolExecutor(max_workers=numberOfWorkers,
+                                 initializer=_initWorker,
+                                 initargs=(self,)) as executor:
+            futures = {executor.submit(_pickInWorker, fileName): i
+                       for i, fileName in enumerate(fileNames)}
+            for future in as_completed(futures):
+                yield (futures[future],) + future.result()
+
+
+class TemplateMatcher(Picker):
+    """ NCC template picker.
+
+    Args:
+        bank: templates prepared with makeTemplateBank
+        threshold: minimum NCC of a picked particle
+        minDistance: minimum distance (px) between picked particles, the
+            template radius if None
+        maxPeaks: maximum number of particles per micrograph (None for all)
+        downFactor: Fourier downsampling applied to the micrographs, the
+            templates must be at the downsampled sampling
+        cache: DownsampleCache used for the downsampled micrographs
+        batchSize: number of templates correlated at once
+        numberOfThreads: threads used by the FFTs
+    """
+    def __init__(self, bank, threshold=0.3, minDistance=None, maxPeaks=None,
+                 downFactor=1., cache=None, batchSize=8, numberOfThreads=1):
+        Picker.__init__(self, downFactor, cache)
+        self.bank = np.asarray(bank, dtype=np.float32)
+        self.boxSize = self.bank.shape[-1]
+        self.mask = np.any(self.bank != 0, axis=0)
+        self.threshold = threshold
+        self.minDistance = (self.boxSize / 2. if minDistance is None
+                            else minDistance)
+        self.maxPeaks = maxPeaks
+        self.batchSize = batchSize
+        self.numberOfThreads = numberOfThreads
+        self._bankFt = None  # (shape, transforms of the padded bank)
+
+    def _rfft2(self, a, shape=None):
+        return scipy.fft.rfft2(a, s=shape, workers=self.numberOfThreads)
+
+    def _irfft2(self, a, shape):
+        return scipy.fft.irfft2(a, s=shape, workers=self.numberOfThreads)
+
+    def _getBankFt(self, shape):
+        """ Conjugated transforms of the bank zero-padded to shape, kept
+        while the micrographs have the same dimensions. """
+        if self._bankFt is None or self._bankFt[0] != shape:
+            ft = self._rfft2(self.bank, shape).astype(np.complex64)
+            self._bankFt = shape, np.conj(ft, out=ft)
+        return self._bankFt[1]
+
+    def correlate(self, image):
+        """ Maximum NCC over the bank for every position where the template
+        fits in the image.
+
+        Returns:
+            (ncc, best): arrays (ny - box + 1, nx - box + 1) with the maximum
+            NCC of the box whose top left corner is at each pixel and the
+            index of the template that gives it.
+        """
+        image = np.asarray(image, dtype=np.float32)
+        shape = image.shape
+        b = self.boxSize
+        valid = (slice(0, shape[0] - b + 1), slice(0, shape[1] - b + 1))
+
+        imageFt = self._rfft2(image)
+        maskFt = np.conj(self._rfft2(self.mask.astype(np.float32), shape))
+        n = float(np.count_nonzero(self.mask))
+        localSum = self._irfft2(imageFt * maskFt, shape)[valid]
+        localSum2 = self._irfft2(self._rfft2(image * image) * maskFt, shape)[valid]
+        norm = np.sqrt(np.maximum(localSum2 - localSum ** 2 / n, 1e-6))
+
+        bankFt = self._getBankFt(shape)
+        ncc = np.full(norm.shape, -np.inf, dtype=np.float32)
+        best = np.zeros(norm.shape, dtype=np.int32)
+        for start in range(0, len(bankFt), self.batchSize):
+            corr = self._irfft2(imageFt[np.newaxis] *
+                                bankFt[start:start + self.batchSize], shape)
+            corr = corr[(slice(None),) + valid]
+            batchBest = corr.argmax(axis=0)
+            batchMax = np.take_along_axis(corr, batchBest[np.newaxis], 0)[0]
+            better = batchMax > ncc
+            ncc[better] = batchMax[better]
+            best[better] = batchBest[better] + start
+        ncc /= norm
+        return ncc, best
+
+    def pickImage(self, image):
+        """ Pick the particles of an image.
+
+        Returns:
+            (positions, scores, templates): box centers (N, 2) as (x, y),
+            their NCC and the index in the bank of the best template.
+        """
+        ncc, best = self.correlate(image)
+        peaks = (ncc >= self.threshold) & (ncc == ndimage.maximum_filter(ncc, 3))
+        y, x = np.nonzero(peaks)
+        scores = ncc[y, x]
+        positions = np.stack([x, y], axis=1) + self.boxSize // 2
+        keep = suppressNonMaxima(positions, scores, self.minDistance,
+                                 self.maxPeaks)
+        return positions[keep], scores[keep], best[y[keep], x[keep]]
+
+
+# Picked blobs: centroid (in pixels), area (px), height statistics over
+# the leveled background and eccentricity of the fitted ellipse
+BLOB_DTYPE = np.dtype([('x', np.float32), ('y', np.float32),
+                       ('area', np.int64), ('maxHeight', np.float32),
+                       ('meanHeight', np.float32), ('volume', np.float32),
+                       ('eccentricity', np.float32)])
+
+
+class BlobDetector(Picker):
+    """ Height-threshold picker.
+
+    Args:
+        threshold: height over the background of the particle pixels, if
+            None it is sigmas times the (robust) standard deviation of the
+            background
+        sigmas: automatic threshold in standard deviations
+        minArea, maxArea: area range (px) of the particles
+        minHeight, maxHeight: range of the maximum height of the particles
+        maxEccentricity: maximum eccentricity (0 for a circle, 1 for a line)
+        doLevel: subtract the background plane before the thresholding
+        downFactor, cache: see Picker
+    """
+    def __init__(self, threshold=None, sigmas=3., minArea=1, maxArea=None,
+                 minHeight=None, maxHeight=None, maxEccentricity=1.,
+                 doLevel=True, downFactor=1., cache=None):
+        Picker.__init__(self, downFactor, cache)
+        self.threshold = threshold
+        self.sigmas = sigmas
+        self.minArea = minArea
+        self.maxArea = maxArea
+        self.minHeight = minHeight
+        self.maxHeight = maxHeight
+        self.maxEccentricity = maxEccentricity
+        self.doLevel = doLevel
+
+    def detect(self, image):
+        """ Connected components over the threshold and their statistics.
+
+        Returns:
+            A BLOB_DTYPE array with one row per component.
+        """
+        from .leveling import levelPlane, robustStats
+
+        if self.doLevel:
+            image, _ = levelPlane(image)
+        else:
+            image = np.asarray(image, dtype=np.float32)
+        background, sigma = robustStats(image)
+        threshold = (self.sigmas * sigma if self.threshold is None
+                     else self.threshold)
+
+        labels, n = ndimage.label(image > background + threshold)
+        blobs = np.zeros(n, dtype=BLOB_DTYPE)
+        if n == 0:
+            return blobs
+
+        # Moments of all the components with one pass over their pixels
+        flat = np.flatnonzero(labels)
+        index = labels.ravel()[flat]
+        rows, cols = np.divmod(flat, image.shape[1])
+        heights = image.ravel()[flat] - background
+
+        def _sums(weights=None):
+            return np.bincount(index, weights, minlength=n + 1)[1:]
+
+        area = _sums()
+        mx, my = _sums(cols) / area, _sums(rows) / area
+        vxx = _sums(cols * cols.astype(np.float64)) / area - mx ** 2
+        vyy = _sums(rows * rows.astype(np.float64)) / area - my ** 2
+        vxy = _sums(cols * rows.astype(np.float64)) / area - mx * my
+        half = np.sqrt(((vxx - vyy) / 2) ** 2 + vxy ** 2)
+        major, minor = (vxx + vyy) / 2 + half, (vxx + vyy) / 2 - half
+
+        blobs['x'], blobs['y'] = mx, my
+        blobs['area'] = area
+        blobs['volume'] = _sums(heights)
+        blobs['meanHeight'] = blobs['volume'] / area
+        maxHeight = np.full(n, -np.inf, dtype=np.float32)
+        np.maximum.at(maxHeight, index - 1, heights)
+        blobs['maxHeight'] = maxHeight
+        blobs['eccentricity'] = np.sqrt(1 - np.divide(
+            np.maximum(minor, 0), major, out=np.ones_like(major),
+            where=major > 0))
+        return blobs
+
+    def pickImage(self, image):
+        """ Pick the blobs of an image that pass the filters.
+
+        Returns:
+            (positions, blobs): the rounded centroids (N, 2) as (x, y) and
+            the BLOB_DTYPE rows of the picked blobs.
+        """
+        blobs = self.detect(image)
+        keep = (blobs['area'] >= self.minArea) & \
+               (blobs['eccentricity'] <= self.maxEccentricity)
+        if self.maxArea:
+            keep &= blobs['area'] <= self.maxArea
+        if self.minHeight is not None:
+            keep &= blobs['maxHeight'] >= self.minHeight
+        if self.maxHeight is not None:
+            keep &= blobs['maxHeight'] <= self.maxHeight
+        blobs = blobs[keep]
+        positions = np.stack([np.round(blobs['x']), np.round(blobs['y'])],
+                             axis=1).astype(np.int64)
+        return positions, blobs
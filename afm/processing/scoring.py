@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Noisy-zone scores of particles, as computed by the Xmipp
+coordinates_noisy_zones_filter: the variance of the micrograph patch around
+each particle (relative to the variance of the whole micrograph) and the
+Gini coefficient of the patch values.
+
+Local sums come from summed-area tables, so the variance of a particle
+costs the same for any patch size. The Gini coefficient needs sorting the
+values, so it is computed on a fixed number of pixels sampled from each
+patch.
+"""
+import numpy as np
+
+# Particle attributes expected by the next protocols (Xmipp labels
+# MDL_SCORE_BY_VAR and MDL_SCORE_BY_GINI)
+SCORE_BY_VAR = '_xmipp_scoreByVariance'
+SCORE_BY_GINI = '_xmipp_scoreByGiniCoeff'
+
+
+def summedAreaTables(image):
+    """ Summed-area tables of the values and squared values of an image,
+    with a leading row and column of zeros. """
+    image = np.asarray(image, dtype=np.float64)
+    sat = np.zeros((image.shape[0] + 1, image.shape[1] + 1))
+    sat2 = np.zeros_like(sat)
+    np.cumsum(np.cumsum(image, axis=0), axis=1, out=sat[1:, 1:])
+    np.cumsum(np.cumsum(image ** 2, axis=0), axis=1, out=sat2[1:, 1:])
+    return sat, sat2
+
+
+def _patchBounds(positions, patchSize, shape):
+    """ Corners of the patches centered at positions (x, y), clipped to
+    the image. """
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+    half = patchSize // 2
+    y0 = np.clip(positions[:, 1] - half, 0, shape[0])
+    y1 = np.clip(positions[:, 1] - half + patchSize, 0, shape[0])
+    x0 = np.clip(positions[:, 0] - half, 0, shape[1])
+    x1 = np.clip(positions[:, 0] - half + patchSize, 0, shape[1])
+    return y0, y1, x0, x1
+
+
+def localVariance(sat, sat2, positions, patchSize):
+    """ Variance of the patches around positions from the summed-area
+    tables (see summedAreaTables). """
+    shape = (sat.shape[0] - 1, sat.shape[1] - 1)
+    y0, y1, x0, x1 = _patchBounds(positions, patchSize, shape)
+    n = np.maximum((y1 - y0) * (x1 - x0), 1)
+
+    def _sum(t):
+        return t[y1, x1] - t[y0, x1] - t[y1, x0] + t[y0, x0]
+
+    mean = _sum(sat) / n
+    return np.maximum(_sum(sat2) / n - mean ** 2, 0)
+
+
+def giniCoefficients(image, positions, patchSize, samples=256, seed=0):
+    """ Gini coefficient of the values of the patches around positions,
+    estimated from the same random sample of pixel offsets in every patch.
+    Values are shifted to be non-negative within each patch. """
+    rng = np.random.default_rng(seed)
+    y0, y1, x0, x1 = _patchBounds(positions, patchSize, image.shape)
+    fy = rng.random(samples)
+    fx = rng.random(samples)
+    rows = y0[:, None] + (fy[None, :] * np.maximum(y1 - y0, 1)[:, None]).astype(np.int64)
+    cols = x0[:, None] + (fx[None, :] * np.maximum(x1 - x0, 1)[:, None]).astype(np.int64)
+    rows = np.clip(rows, 0, image.shape[0] - 1)
+    cols = np.clip(cols, 0, image.shape[1] - 1)
+
+    values = np.sort(np.asarray(image[rows, cols], dtype=np.float64), axis=1)
+    values -= values[:, :1]
+    total = values.sum(axis=1)
+    ranks = np.arange(1, samples + 1)
+    gini = (2 * (values * ranks).sum(axis=1) /
+            (samples * np.maximum(total, 1e-12)) - (samples + 1.) / samples)
+    return np.where(total > 0, gini, 0)
+
+
+def noisyZoneScores(image, positions, patchSize, samples=256):
+    """ Variance score (local variance over the micrograph variance) and
+    Gini coefficient of the patches around positions.
+
+    Returns:
+        An array (N, 2) with the two scores of each position.
+    """
+    sat, sat2 = summedAreaTables(image)
+    n = image.shape[0] * image.shape[1]
+    micVariance = max(sat2[-1, -1] / n - (sat[-1, -1] / n) ** 2, 1e-12)
+    varScore = localVariance(sat, sat2, positions, patchSize) / micVariance
+    gini = giniCoefficients(image, positions, patchSize, samples)
+    return np.stack([varScore, gini], axis=1)
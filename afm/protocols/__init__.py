@@ -9,3 +9,6 @@ from .protocol_cl2d import ProtCL2DAFM
 from .protocol_extract_particles import ProtExtractAFMParticles
 from .protocol_manual_picking import ProtManualPickingAFM
 from .protocol_automatic_picking import ProtAutomaticPickingAFM
+from .protocol_template_picking import ProtTemplatePickingAFM
+from .protocol_blob_picking import ProtBlobPickingAFM
+from .protocol_leveling import ProtLevelAFM
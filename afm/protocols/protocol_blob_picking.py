@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+import os
+
+import numpy as np
+
+import pyworkflow.utils as pwutils
+from pyworkflow.constants import BETA
+from pyworkflow.object import Float, Integer
+from pyworkflow.protocol.constants import LEVEL_ADVANCED, STEPS_SERIAL
+import pyworkflow.protocol.params as params
+from pwem.protocols import ProtParticlePickingAuto
+from pwem.objects import Coordinate
+
+# Attributes of the output coordinates with the statistics of each blob
+BLOB_ATTRIBUTES = [('area', '_blobArea', Integer),
+                   ('maxHeight', '_blobMaxHeight', Float),
+                   ('meanHeight', '_blobMeanHeight', Float),
+                   ('volume', '_blobVolume', Float),
+                   ('eccentricity', '_blobEccentricity', Float)]
+
+
+class ProtBlobPickingAFM(ProtParticlePickingAuto):
+    """ Fast picking of isolated molecules on a flat support. The height
+    map is leveled and thresholded, and the connected components that pass
+    the area, height and eccentricity filters are picked at their
+    centroids. The area, heights, volume and eccentricity of every
+    particle are stored with its coordinate. """
+    _label = 'blob picking'
+    _devStatus = BETA
+    # The micrographs of a step are picked in a pool of numberOfThreads
+    # processes, steps running in parallel would multiply the processes
+    stepsExecutionMode = STEPS_SERIAL
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        ProtParticlePickingAuto._defineParams(self, form)
+        form.addParam('downFactor', params.FloatParam, default=1.0,
+                      label='Downsampling factor',
+                      help='The micrographs are downsampled by this factor '
+                           'before the picking. The downsampled micrographs '
+                           'are kept in the plugin cache, so they are reused '
+                           'by other picking and extraction runs.')
+
+        form.addParam('doLevel', params.BooleanParam, default=True,
+                      label='Level the background plane',
+                      help='Subtract the least-squares plane of the '
+                           'background before the thresholding. Disable it '
+                           'if the micrographs are already leveled.')
+
+        form.addParam('threshold', params.FloatParam, default=-1,
+                      label='Height threshold',
+                      help='Height over the background of the particle '
+                           'pixels, in the units of the micrographs. Use -1 '
+                           'to set it from the background noise, see the '
+                           'number of standard deviations below.')
+
+        form.addParam('sigmas', params.FloatParam, default=3.0,
+                      condition='threshold <= 0', expertLevel=LEVEL_ADVANCED,
+                      label='Threshold in standard deviations',
+                      help='Automatic threshold, in (robust) standard '
+                           'deviations of the background.')
+
+        line = form.addLine('Particle area (px)',
+                            help='Range of the area of the particles, in '
+                                 'pixels of the input micrographs. Use -1 '
+                                 'as maximum for no limit.')
+        line.addParam('minArea', params.IntParam, default=10, label='Min')
+        line.addParam('maxArea', params.IntParam, default=-1, label='Max')
+
+        line = form.addLine('Particle height',
+                            help='Range of the maximum height of the '
+                                 'particles over the background, in the '
+                                 'units of the micrographs. Use -1 for no '
+                                 'limit.')
+        line.addParam('minHeight', params.FloatParam, default=-1, label='Min')
+        line.addParam('maxHeight', params.FloatParam, default=-1, label='Max')
+
+        form.addParam('maxEccentricity', params.FloatParam, default=0.9,
+                      label='Maximum eccentricity',
+                      help='Eccentricity of the ellipse with the same second '
+                           'moments as the particle, 0 for a circle and 1 '
+                           'for a line. Elongated blobs, like steps or '
+                           'fibers, are discarded.')
+
+        form.addParam('boxSize', params.IntParam, default=-1,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Box size (px)',
+                      help='Box size of the output coordinates. Use -1 to '
+                           'set it to twice the diameter of the median '
+                           'particle of the first picked micrographs.')
+
+        self._defineStreamingParams(form)
+        # Micrographs of a step are picked in parallel with the threads
+        form.getParam('streamingBatchSize').setDefault(0)
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- STEPS functions -----------------------------
+    def _pickMicrographList(self, micList, *args):
+        """ Pick a batch of micrographs in a pool of processes, see
+        afm.processing.BlobDetector. The blobs of each micrograph are
+        written to a .npy file. """
+        detector = self._getDetector()
+
+        for i, _, blobs in detector.pickMany([mic.getFileName() for mic in micList],
+                                             self.numberOfThreads.get()):
+            np.save(self._getMicBlobsFile(micList[i]), blobs)
+            self.info("Picked %d particles from %s"
+                      % (len(blobs), micList[i].getMicName()))
+
+    def _pickMicrograph(self, mic, *args):
+        self._pickMicrographList([mic], *args)
+
+    def readCoordsFromMics(self, outputDir, micDoneList, outputCoords):
+        """ Append the picked blobs, scaled to the pixels of the input
+        micrographs, in bulk. """
+        from afm.objects import bulkAppend
+
+        blobsList = [(mic, self._loadBlobs(mic)) for mic in micDoneList
+                     if os.path.exists(self._getMicBlobsFile(mic))]
+        if outputCoords.getBoxSize() is None:
+            outputCoords.setBoxSize(self._getBoxSize(
+                np.concatenate([b['area'] for _, b in blobsList] or [[]])))
+
+        def _iterCoords():
+            coord = Coordinate()
+            values = {}
+            for field, attrName, AttrClass in BLOB_ATTRIBUTES:
+                values[field] = AttrClass()
+                setattr(coord, attrName, values[field])
+
+            for mic, blobs in blobsList:
+                coord.setMicrograph(mic)
+                for row in blobs:
+                    coord.setObjId(None)
+                    coord.setPosition(int(round(row['x'])), int(round(row['y'])))
+                    for field, value in values.items():
+                        value.set(row[field].item())
+                    yield coord
+
+        bulkAppend(outputCoords, _iterCoords())
+
+    # --------------------------- UTILS functions -----------------------------
+    def _getDetector(self):
+        from afm import Plugin
+        from afm.processing import BlobDetector
+
+        downFactor = self.downFactor.get()
+        cache = Plugin.getDownsampleCache() if abs(downFactor - 1) > 0.0001 else None
+
+        def _positive(value, scale=1.):
+            return value * scale if value > 0 else None
+
+        return BlobDetector(threshold=_positive(self.threshold.get()),
+                            sigmas=self.sigmas.get(),
+                            minArea=max(1, self.minArea.get() / downFactor ** 2),
+                            maxArea=_positive(self.maxArea.get(), 1. / downFactor ** 2),
+                            minHeight=_positive(self.minHeight.get()),
+                            maxHeight=_positive(self.maxHeight.get()),
+                            maxEccentricity=self.maxEccentricity.get(),
+                            doLevel=self.doLevel.get(),
+                            downFactor=downFactor, cache=cache)
+
+    def _loadBlobs(self, mic):
+        """ Blobs picked in a micrograph, with the positions, areas and
+        volumes in pixels of the input micrographs. """
+        downFactor = self.downFactor.get()
+        blobs = np.load(self._getMicBlobsFile(mic))
+        scaled = blobs.copy()
+        scaled['x'] = blobs['x'] * downFactor
+        scaled['y'] = blobs['y'] * downFactor
+        scaled['area'] = np.round(blobs['area'] * downFactor ** 2)
+        scaled['volume'] = blobs['volume'] * downFactor ** 2
+        return scaled
+
+    def _getBoxSize(self, areas):
+        """ Box size given by the user or twice the diameter of the median
+        particle (areas in pixels of the input micrographs). """
+        if self.boxSize.get() > 0:
+            return self.boxSize.get()
+        if not len(areas):
+            return 2 * int(np.ceil(np.sqrt(4 * max(1, self.minArea.get()) / np.pi)))
+        return 2 * int(np.ceil(np.sqrt(4 * np.median(areas) / np.pi)))
+
+    def _getMicBlobsFile(self, mic):
+        micBase = pwutils.removeBaseExt(mic.getFileName())
+        return self._getExtraPath(micBase + '_blobs.npy')
+
+    def getCoordsDir(self):
+        return self._getExtraPath()
+
+    # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = []
+        if self.downFactor.get() < 1:
+            errors.append('The downsampling factor can not be smaller than 1.')
+        if 0 < self.maxArea.get() < self.minArea.get():
+            errors.append('The maximum area is smaller than the minimum.')
+        if not 0 <= self.maxEccentricity.get() <= 1:
+            errors.append('The eccentricity must be between 0 and 1.')
+        return errors
+
+    def _methods(self):
+        methods = []
+        return methods
@@ -30,30 +30,365 @@
 Describe your python module here:
 This module will provide the traditional Hello world example
 """
+import os
+from collections import OrderedDict
+from glob import glob
+
+import numpy as np
 
 from pyworkflow.constants import BETA
-from xmipp3.protocols.protocol_cl2d import XmippProtCL2D
+from pyworkflow.protocol.constants import LEVEL_ADVANCED, STATUS_NEW
+import pyworkflow.protocol.params as params
+from pwem.protocols import ProtClassify2D
+from pwem.objects import Transform, SetOfParticles
 
 
-class ProtCL2DAFM(XmippProtCL2D):
+class ProtCL2DAFM(ProtClassify2D):
     """
-    This protocol imports AFM movies
+    Rotationally invariant 2D classification of AFM particles, computed
+    in-process (see afm.processing.classification). Particles are aligned
+    to the class averages by polar-Fourier rotational and FFT translational
+    cross-correlation, the averages are updated in mini-batches and the
+    number of classes grows from the initial ones by splitting the most
+    populated classes.
     """
     _label = 'cl2d AFM'
-    _outputClassName = 'AFMImages'
     _devStatus = BETA
 
-    def __init__(self, **args):
-        XmippProtCL2D.__init__(self, **args)
+    # --------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputParticles', params.PointerParam,
+                      pointerClass='SetOfParticles',
+                      label='Input particles', important=True,
+                      help='Particles to classify, all of the same size.')
+        form.addParam('numberOfClasses', params.IntParam, default=64,
+                      label='Number of classes',
+                      validators=[params.Positive])
+        form.addParam('numberOfInitialClasses', params.IntParam, default=4,
+                      label='Number of initial classes',
+                      help='The classification starts with this number of '
+                           'classes, and the most populated ones are split '
+                           'until the final number of classes is reached.')
+        form.addParam('numberOfIterations', params.IntParam, default=10,
+                      label='Number of iterations',
+                      help='Passes over all the particles for each number '
+                           'of classes.')
+        form.addParam('doStreaming', params.BooleanParam, default=False,
+                      label='Classify in batches?',
+                      help='If Yes, the particles are classified in batches '
+                           'while the input set is open. The first batch is '
+                           'classified from scratch and the next ones are '
+                           'aligned to the current classes, updating only the '
+                           'classes that receive new particles, so the cost '
+                           'of a batch does not grow with the particles '
+                           'already classified.')
+        form.addParam('streamingBatchSize', params.IntParam, default=2000,
+                      condition='doStreaming',
+                      label='Particles per batch',
+                      help='Wait for this number of new particles before '
+                           'classifying them (the last batch may be smaller).')
+        form.addParam('maxDrift', params.FloatParam, default=0.05,
+                      condition='doStreaming',
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Maximum score drift',
+                      help='If the mean correlation of a new batch with its '
+                           'classes is lower than the one of the classified '
+                           'particles by more than this, the new particles '
+                           'do not fit the current classes and all the '
+                           'particles are classified again from the initial '
+                           'classes.')
+
+        form.addSection(label='Alignment')
+        form.addParam('angularSampling', params.FloatParam, default=3.0,
+                      label='Angular sampling (deg)',
+                      help='Degrees between the tested in-plane rotations.')
+        form.addParam('maxShift', params.IntParam, default=-1,
+                      label='Maximum shift (px)',
+                      help='Maximum translation of the particles. Use -1 '
+                           'for a quarter of the box size.')
+        form.addParam('maskRadius', params.IntParam, default=-1,
+                      label='Mask radius (px)',
+                      help='Radius of the circular mask applied to the '
+                           'particles and averages. Use -1 for half the '
+                           'box size.')
+        form.addParam('candidates', params.IntParam, default=3,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Candidate classes',
+                      help='Number of classes, the best ones according to '
+                           'the rotational correlation, whose translation '
+                           'is searched for each particle.')
+        form.addParam('batchSize', params.IntParam, default=5000,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Mini-batch size',
+                      help='The class averages are updated after aligning '
+                           'this number of particles. Each mini-batch is '
+                           'split between the threads.')
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions -----------------------
+    def _insertAllSteps(self):
+        if self.doStreaming:
+            batchStepId = self._insertNewBatchStep()
+            self._insertFunctionStep(self.createOutputStep,
+                                     prerequisites=[batchStepId] if batchStepId else [],
+                                     wait=True)
+        else:
+            self._insertFunctionStep(self.convertInputStep)
+            self._insertFunctionStep(self.classifyStep)
+            self._insertFunctionStep(self.createOutputStep)
+
+    def _insertNewBatchStep(self):
+        """ Insert a step to classify the input particles that are not in
+        any batch yet, if there are enough of them or the input is closed.
+        Particles are expected to arrive with increasing ids, as streaming
+        sets are appended.
+
+        Returns:
+            The id of the new step or None.
+        """
+        inputSet = SetOfParticles(filename=self.inputParticles.get().getFileName())
+        inputSet.loadAllProperties()
+        self._inputClosed = inputSet.isStreamClosed()
+        batchFiles = self._getBatchFiles()
+        lastId = int(np.load(batchFiles[-1])['ids'][-1]) if batchFiles else 0
+        newParticles = [(p.getObjId(), p.getIndex(), p.getFileName())
+                        for p in inputSet.iterItems(orderBy='id',
+                                                    where='id > %d' % lastId)]
+        inputSet.close()
+        self._pendingParticles = len(newParticles)
+
+        minSize = self.streamingBatchSize.get()
+        if not batchFiles:
+            # The first batch initializes the classes, one particle each
+            minSize = max(minSize, self.numberOfInitialClasses.get())
+        if not newParticles or (not self._inputClosed and
+                                len(newParticles) < minSize):
+            return None
+
+        ids, indexes, fileNames = zip(*newParticles)
+        batch = len(batchFiles)
+        np.savez(self._getBatchFile(batch), ids=np.array(ids, dtype=np.int64),
+                 indexes=np.array(indexes, dtype=np.int64),
+                 fileNames=np.array(fileNames))
+        self._pendingParticles = 0
+        prerequisites = [s.getIndex() for s in self._steps
+                         if s.funcName == 'classifyBatchStep'][-1:]
+        return self._insertFunctionStep(self.classifyBatchStep, batch,
+                                        prerequisites=prerequisites)
+
+    def _stepsCheck(self):
+        if not self.doStreaming or getattr(self, 'finished', False):
+            return
+        outputStep = self._getFirstJoinStep()
+        batchStepId = self._insertNewBatchStep()
+        if batchStepId is not None:
+            if outputStep is not None:
+                outputStep.addPrerequisites(batchStepId)
+            self.updateSteps()
+        elif self._inputClosed and self._pendingParticles == 0:
+            # All the particles are in a batch, unlock the output step
+            self.finished = True
+            if outputStep is not None and outputStep.isWaiting():
+                outputStep.setStatus(STATUS_NEW)
+
+    def _getFirstJoinStep(self):
+        for step in self._steps:
+            if step.funcName == 'createOutputStep':
+                return step
+        return None
+
+    # --------------------------- STEPS functions ------------------------------
+    def convertInputStep(self):
+        """ Copy the particles, masked and normalized, to a single .npy
+        stack that the classification workers memory-map. """
+        ids, locations = [], []
+        for particle in self.inputParticles.get().iterItems(orderBy='id'):
+            ids.append(particle.getObjId())
+            locations.append(particle.getLocation())
+        self._writeStack(locations, self._getStackFile())
+        np.save(self._getIdsFile(), np.array(ids, dtype=np.int64))
+
+    def classifyStep(self):
+        result = self._getEngine().run(self._getStackFile())
+        self._saveResult(result, np.load(self._getIdsFile()))
+
+    def classifyBatchStep(self, batch):
+        """ Classify a batch of particles: from scratch for the first one
+        and against the current classes for the next ones, unless they do
+        not fit them (see maxDrift). """
+        from afm.processing.classification import ClassificationResult
+
+        batchIds = np.load(self._getBatchFile(batch))['ids']
+        stackFile = self._getBatchStack(batch)
+        engine = self._getEngine()
+
+        if batch == 0:
+            self._saveResult(engine.run(stackFile), batchIds)
+            return
+
+        result = np.load(self._getResultFile())
+        previous = ClassificationResult(**{k: result[k] for k in result.files})
+        previousIds = np.load(self._getIdsFile())
+        update, drift = engine.update(stackFile, previous,
+                                      maxDrift=self.maxDrift.get())
+
+        if drift > self.maxDrift.get():
+            self.info("Batch %d: score drift %0.4f, classifying all the "
+                      "particles again" % (batch, drift))
+            stacks = [np.load(self._getBatchStack(b), mmap_mode='r')
+                      for b in range(batch + 1)]
+            allStack = np.lib.format.open_memmap(
+                self._getStackFile(), mode='w+', dtype=np.float32,
+                shape=(sum(map(len, stacks)),) + stacks[0].shape[1:])
+            np.concatenate(stacks, out=allStack)
+            allStack.flush()
+            del allStack, stacks
+            result = engine.run(self._getStackFile())
+        else:
+            result = update._replace(**{
+                k: np.concatenate([getattr(previous, k), getattr(update, k)])
+                for k in ('assignments', 'angles', 'shifts', 'scores')})
+        self._saveResult(result, np.concatenate([previousIds, batchIds]))
+
+    def createOutputStep(self):
+        from afm.processing.classification import getTransformMatrix
+
+        result = np.load(self._getResultFile())
+        rows = {objId: i for i, objId in enumerate(np.load(self._getIdsFile()).tolist())}
+        assignments, angles, shifts = (result['assignments'], result['angles'],
+                                       result['shifts'])
+
+        def _updateParticle(item, row):
+            i = rows.get(item.getObjId())
+            if i is None:  # not classified, left out of the classes
+                item.setClassId(0)
+                return
+            item.setClassId(int(assignments[i]) + 1)
+            item.setTransform(Transform(getTransformMatrix(angles[i], shifts[i])))
+
+        def _updateClass(item):
+            item.setAlignment2D()
+            item.getRepresentative().setLocation(item.getObjId(),
+                                                 self._getAveragesFile())
+
+        classes2D = self._createSetOfClasses2D(self.inputParticles)
+        classes2D.classifyItems(updateItemCallback=_updateParticle,
+                                updateClassCallback=_updateClass)
+        self._defineOutputs(outputClasses=classes2D)
+        self._defineSourceRelation(self.inputParticles, classes2D)
+
+    # --------------------------- UTILS functions ------------------------------
+    def _getEngine(self):
+        from afm.processing.classification import CL2D
+
+        engine = CL2D(self.numberOfClasses.get(),
+                      numberOfInitialClasses=self.numberOfInitialClasses.get(),
+                      numberOfIterations=self.numberOfIterations.get(),
+                      batchSize=self.batchSize.get(),
+                      numberOfWorkers=self.numberOfThreads.get(),
+                      angularSampling=self.angularSampling.get(),
+                      maxShift=self.maxShift.get() if self.maxShift.get() > 0 else None,
+                      candidates=self.candidates.get(),
+                      maskRadius=self._getMaskRadius())
+        engine.log = self.info
+        return engine
+
+    def _writeStack(self, locations, stackFile):
+        """ Write the particles at locations [(index, fileName)], masked and
+        normalized, to a .npy stack that the classification workers can
+        memory-map. """
+        from afm.convert.frames import FrameStack
+        from afm.processing.classification import Aligner2D
+
+        boxSize = self.inputParticles.get().getXDim()
+        byFile = OrderedDict()  # fileName -> [(row, index)]
+        for row, (index, fileName) in enumerate(locations):
+            byFile.setdefault(fileName, []).append((row, max(index, 1) - 1))
+
+        aligner = Aligner2D(boxSize, maskRadius=self._getMaskRadius())
+        stack = np.lib.format.open_memmap(stackFile, mode='w+',
+                                          dtype=np.float32,
+                                          shape=(len(locations), boxSize, boxSize))
+        for fileName, rowsIndexes in byFile.items():
+            rows, indexes = map(np.array, zip(*rowsIndexes))
+            with FrameStack(fileName) as frames:
+                for start, block in frames[indexes].iterBlocks(blockSize=1000):
+                    stack[rows[start:start + len(block)]] = aligner.prepare(block)
+        stack.flush()
+        del stack
+
+    def _getBatchStack(self, batch):
+        """ Prepared stack of a batch, written from its particle locations
+        if it does not exist (e.g. the tmp folder was cleaned). """
+        stackFile = self._getTmpPath('particles_%03d.npy' % batch)
+        if not os.path.exists(stackFile):
+            batchData = np.load(self._getBatchFile(batch))
+            self._writeStack(list(zip(batchData['indexes'].tolist(),
+                                      batchData['fileNames'].tolist())),
+                             stackFile)
+        return stackFile
+
+    def _saveResult(self, result, ids):
+        np.savez(self._getResultFile(), **result._asdict())
+        np.save(self._getIdsFile(), np.asarray(ids, dtype=np.int64))
+        self._writeAverages(result.references)
+
+    def _writeAverages(self, references):
+        import mrcfile
+        with mrcfile.new(self._getAveragesFile(), overwrite=True) as mrc:
+            mrc.set_data(np.asarray(references, dtype=np.float32))
+            mrc.voxel_size = self.inputParticles.get().getSamplingRate()
+
+    def _getMaskRadius(self):
+        return self.maskRadius.get() if self.maskRadius.get() > 0 else None
+
+    def _getBatchFile(self, batch):
+        return self._getExtraPath('batch_%03d.npz' % batch)
+
+    def _getBatchFiles(self):
+        return sorted(glob(self._getExtraPath('batch_*.npz')))
+
+    def _getStackFile(self):
+        return self._getTmpPath('particles.npy')
+
+    def _getIdsFile(self):
+        return self._getExtraPath('particle_ids.npy')
+
+    def _getResultFile(self):
+        return self._getExtraPath('classification.npz')
+
+    def _getAveragesFile(self):
+        return self._getExtraPath('classes.mrcs')
 
     # --------------------------- INFO functions -----------------------------------
     def _validate(self):
         errors = []
+        if self.numberOfInitialClasses.get() > self.numberOfClasses.get():
+            errors.append('The number of initial classes can not be larger '
+                          'than the number of classes.')
+        particles = self.inputParticles.get()
+        # A streaming input may still be empty, the first batch waits for
+        # enough particles
+        streaming = self.doStreaming and particles is not None and \
+            particles.isStreamOpen()
+        if (particles is not None and not streaming and
+                particles.getSize() < self.numberOfClasses.get()):
+            errors.append('There are less particles than classes.')
         return errors
 
     def _summary(self):
         """ Summarize what the protocol has done"""
         summary = []
+        if os.path.exists(self._getResultFile()):
+            result = np.load(self._getResultFile())
+            summary.append("%d classes, mean correlation %0.3f"
+                           % (len(result['counts']), result['scores'].mean()))
+            if self.doStreaming:
+                summary.append("%d particles classified in %d batches"
+                               % (len(result['scores']),
+                                  len(self._getBatchFiles())))
         return summary
 
     def _methods(self):
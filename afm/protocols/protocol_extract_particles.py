@@ -24,13 +24,27 @@
 # *
 # **************************************************************************
 
-import pwem.emlib.metadata as md
+import os
+from collections import OrderedDict
+
+import numpy as np
+
 import pyworkflow.utils as pwutils
-from pyworkflow.object import Integer
-from pyworkflow.protocol.constants import LEVEL_ADVANCED)
+from pyworkflow.object import Integer, Float
+from pyworkflow.protocol.constants import LEVEL_ADVANCED
 import pyworkflow.protocol.params as params
 from pwem.protocols import ProtExtractParticles
-from pwem.objects import Particle
+from pwem.protocols.protocol_particles import OTHER
+from pwem.objects import Particle, Coordinate, SetOfCoordinates
+
+
+# Default particle box size, relative to the picking box size
+FACTOR_BOXSIZE = 1.5
+
+# Extracted particles of a micrograph, in stack order, with their
+# noisy-zone scores
+PARTS_DTYPE = np.dtype([('objId', np.int64), ('x', np.int64), ('y', np.int64),
+                        ('varScore', np.float64), ('giniScore', np.float64)])
 
 
 class ProtExtractAFMParticles(ProtExtractParticles):
@@ -38,18 +52,13 @@ class ProtExtractAFMParticles(ProtExtractParticles):
     _label = 'extract particles'
 
     #--------------------------- DEFINE param functions ------------------------
-    def _defineParams(self, form):
-
-        form.addSection(label=pwutils.Message.LABEL_INPUT)
-        form.addParam('inputMicrographs', params.PointerParam, pointerClass='SetOfMicrographs',
-                      important=True,
-                      label='Micrographs',
-                      help='Select a set of previously imported movies.')
-
-        form.addParam('inputMovies', params.PointerParam, pointerClass='SetOfMovies',
-                      important=True,
-                      label='AFM Movies',
-                      help='Select a set of previously imported movies.')
+    def _definePreprocessParams(self, form):
+        form.addParam('downFactor', params.FloatParam, default=1.0,
+                      label='Downsampling factor',
+                      help='Select a value greater than 1.0 to reduce the size '
+                           'of micrographs before extracting the particles. '
+                           'If 1.0 is used, no downsample is applied. '
+                           'Non-integer downsample factors are possible. ')
 
         form.addParam('boxSize', params.IntParam,
                       label='Particle box size (px)', allowsPointers=True, default=-1,
@@ -123,150 +132,85 @@ class ProtExtractAFMParticles(ProtExtractParticles):
                            'compute the Gini coeff. A twice of the particle '
                            'size is recommended. Set at -1 applies 1.5*BoxSize.')
 
-        form.addParallelSection(threads=4, mpi=1)
-
-    #--------------------------- INSERT steps functions ------------------------
-    def _insertAllSteps(self):
-
-        for coor in self.inputMicrographs.get.iterItems():
-            self._insertFunctionStep(self.extractParticlesStep, mic)
-
-    def extractParticlesStep(self):
-        pass
-
-
-
-    def _getExtractArgs(self):
-        """ Should be implemented in sub-classes to define the argument
-        list that should be passed to the picking step function.
-        """
-        return [self.doInvert.get(),
-                self._getNormalizeArgs(),
-                self.doBorders.get()]
-
-
-    def _getNormalizeArgs(self):
-        if not self.doNormalize:
-            return ''
-
-        normType = self.getEnumText("normType")
-        args = "--method %s " % normType
-
-        if normType != "OldXmipp":
-            bgRadius = self.backRadius.get()
-            if bgRadius <= 0:
-                bgRadius = int(self._getExtractBoxSize() / 2)
-            args += " --background circle %d" % bgRadius
-
-        return args
+        form.addParam('particlesPerChunk', params.IntParam, default=20000,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Particles per step',
+                      help='Micrographs are extracted in steps of about this '
+                           'number of particles, balanced by the number of '
+                           'coordinates of each micrograph. The micrographs '
+                           'of a step are processed in parallel with the '
+                           'given threads.')
 
-    def _getExtractBoxSize(self):
-        if self.boxSize.get() == -1:
-            boxSize = int(self.getBoxSize())
-        else:
-            boxSize = int(self.boxSize.get())
+        form.addParallelSection(threads=4, mpi=0)
 
-        downFactor =  self._getDownFactor()
-        if downFactor > 1:
-            newBoxSize = self.getEven(boxSize/downFactor)
-        else:
-            newBoxSize = boxSize
-
-        return int(newBoxSize)
+    #--------------------------- INSERT steps functions ------------------------
+    def _insertInitialSteps(self):
+        self._setupBasicProperties()
+        return []
+
+    def _insertNewMicsSteps(self, inputMics):
+        """ Insert one extraction step per chunk of micrographs. The chunks
+        are balanced by the number of coordinates of their micrographs, so
+        there are few steps and each one takes a similar time. """
+        from afm.processing import balanceChunks
+
+        micList = [mic for mic in inputMics
+                   if mic.getMicName() not in self.micDict]
+        if not micList:
+            return []
+
+        weights = [len(self.coordDict.get(mic.getObjId(), [])) for mic in micList]
+        numberOfChunks = int(np.ceil(sum(weights) /
+                                     float(self.particlesPerChunk.get())))
+        deps = []
+        for chunk in balanceChunks(weights, numberOfChunks):
+            deps.append(self._insertExtractMicrographListStep(
+                [micList[i] for i in chunk], self.initialIds,
+                *self._getExtractArgs()))
 
-    def getEven(self, boxSize):
-        return Integer(int(int(boxSize)/2+0.75)*2)
+        for mic in micList:
+            self.micDict[mic.getMicName()] = mic
 
-    def getBoxSize(self):
-        # This function is needed by the wizard and for auto-boxSize selection
-        return self.getEven(self.getCoords().getBoxSize()*FACTOR_BOXSIZE)
+        return deps
 
-    '''
     #--------------------------- STEPS functions -------------------------------
-    def _extractMicrograph(self, mic, doInvert, normalizeArgs, doBorders):
-        """ Extract particles from one micrograph """
-        fnLast = mic.getFileName()
-        baseMicName = pwutils.removeBaseExt(fnLast)
-        outputRoot = str(self._getExtraPath(baseMicName))
-        fnPosFile = self._getMicPos(mic)
-        boxSize = self._getExtractBoxSize()
-        downFactor = self._getDownFactor()
-        patchSize = self.patchSize.get() if self.patchSize.get() > 0 \
-                    else int(boxSize*1.5*downFactor)
-
-        particlesMd = 'particles@%s' % fnPosFile
-        # If it has coordinates extract the particles
-        if exists(fnPosFile):
-            # Create a list with micrographs operations (programs in xmipp) and
-            # the required command line parameters (except input/ouput files)
-            micOps = []
-
-            try:
-                # Compute the variance and Gini coeff. of the part. and mic., resp.
-                args  =  '--pos %s' % fnPosFile
-                args += ' --mic %s' % fnLast
-                args += ' --patchSize %d' % patchSize
-                self.runJob('xmipp_coordinates_noisy_zones_filter', args)
-            except:
-                print("'xmipp_coordinates_noisy_zones_filter' have failed for "
-                      "%s micrograph. We continue..." % mic.getMicName())
-
-            def getMicTmp(suffix):
-                return self._getTmpPath(baseMicName + suffix)
-
-            # Check if it is required to downsample our micrographs
-            if self.notOne(downFactor):
-                fnDownsampled = getMicTmp("_downsampled.xmp")
-                args = "-i %s -o %s --step %f --method fourier"
-                self.runJob('xmipp_transform_downsample',
-                            args % (fnLast, fnDownsampled, downFactor))
-                fnLast = fnDownsampled
-
-            if self.doRemoveDust:
-                fnNoDust = getMicTmp("_noDust.xmp")
-                args = " -i %s -o %s --bad_pixels outliers %f"
-                self.runJob('xmipp_transform_filter',
-                            args % (fnLast, fnNoDust, self.thresholdDust))
-                fnLast = fnNoDust
-
-            fnCTF = None
-
-            args = " -i %s --pos %s" % (fnLast, particlesMd)
-            args += " -o %s.mrcs --Xdim %d" % (outputRoot, boxSize)
-
-            if doInvert:
-                args += " --invert"
-
-            if fnCTF:
-                args += " --ctfparam " + fnCTF
-
-            if doBorders:
-                args += " --fillBorders"
-
-            self.runJob("xmipp_micrograph_scissor", args)
-
-            # Normalize
-            if normalizeArgs:
-                self.runJob('xmipp_transform_normalize',
-                            '-i %s.mrcs %s' % (outputRoot, normalizeArgs))
-        else:
-            self.warning("The micrograph %s hasn't coordinate file! "
-                         % baseMicName)
-            self.warning("Maybe you picked over a subset of micrographs")
-
-        # Let's clean the temporary mrc micrographs
-        if not pwutils.envVarOn("SCIPION_DEBUG_NOCLEAN"):
-            pwutils.cleanPattern(self._getTmpPath(baseMicName) + '*')
-
-
+    def _extractMicrograph(self, mic, *args):
+        self._extractMicrographList([mic], *args)
+
+    def _extractMicrographList(self, micList, doInvert, normalizeArgs,
+                               doBorders):
+        """ Extract the particles of a chunk of micrographs in-process with
+        a pool of processes, see afm.processing.ParticleExtractor. One
+        .mrcs stack is written per micrograph. """
+        import mrcfile
+
+        extractor = self._getExtractor(doInvert, normalizeArgs, doBorders)
+        coordsList = [self._getMicCoords(mic) for mic in micList]
+        jobs = [(mic.getFileName(), np.stack([c['x'], c['y']], axis=1))
+                for mic, c in zip(micList, coordsList)]
+
+        for i, stack, valid, scores in extractor.extractMany(
+                jobs, self.numberOfThreads.get(), tmpDir=self._getTmpPath()):
+            mic = micList[i]
+            if not len(stack):
+                self.warning("No particles extracted from micrograph %s"
+                             % mic.getMicName())
+            with mrcfile.new(self._getMicStack(mic), overwrite=True) as mrc:
+                mrc.set_data(stack)
+
+            coords = coordsList[i][valid]
+            parts = np.zeros(len(coords), dtype=PARTS_DTYPE)
+            for name in ('objId', 'x', 'y'):
+                parts[name] = coords[name]
+            parts['varScore'], parts['giniScore'] = scores.T
+            np.save(self._getMicParts(mic), parts)
 
     #--------------------------- INFO functions --------------------------------
     def _validate(self):
         errors = []
-        if self.doResize:
-            downFactor = self._getDownFactor()
-            if downFactor < 1:
-                errors.append('The new particles size should be smaller than the current one')
+        if self.downFactor < 1:
+            errors.append('The downsampling factor should not be smaller '
+                          'than 1.')
 
         if self.boxSize.get() == -1:
             self.boxSize.set(self.getBoxSize())
@@ -281,24 +225,6 @@ class ProtExtractAFMParticles(ProtExtractParticles):
                 errors.append("Background radius for normalization should be "
                               "equal or less than half of the box size.")
 
-        # doFlip can only be selected if CTF information
-        # is available on picked micrographs
-        if self.doFlip and not self._useCTF():
-            errors.append('Phase flipping cannot be performed unless '
-                          'CTF information is provided.')
-
-        # We cannot check this if the protocol is in streaming.
-
-        #self._setupCtfProperties() # setup self.micKey among others
-        # if self._useCTF() and self.micKey is None:
-        #     errors.append('Some problem occurs matching micrographs and CTF.\n'
-        #                   'There were micrographs for which CTF was not found '
-        #                   'either using micName or micId.\n')
-
-        # Clear the CTFs if micrograph source is "same as picking" to avoid unconsistencies
-        if not self._micsOther():
-            self.inputMicrographs.set(None)
-
         return errors
 
     def _summary(self):
@@ -308,7 +234,6 @@ class ProtExtractAFMParticles(ProtExtractParticles):
         summary.append("Particle box size: %d" % self.boxSize)
 
         if not hasattr(self, 'outputParticles'):
-
             summary.append("Output images not ready yet.")
         else:
             summary.append("Particles extracted: %d" %
@@ -317,9 +242,104 @@ class ProtExtractAFMParticles(ProtExtractParticles):
         return summary
 
     # --------------------------- UTILS functions ------------------------------
-    def _convertCoordinates(self, mic, coordList):
-        writeMicCoordinates(mic, coordList, self._getMicPos(mic),
-                            getPosFunc=self._getPos)
+    def _getExtractArgs(self):
+        """ Should be implemented in sub-classes to define the argument
+        list that should be passed to the picking step function.
+        """
+        return [self.doInvert.get(),
+                self._getNormalizeArgs(),
+                self.doBorders.get()]
+
+    def _getNormalizeArgs(self):
+        """ Normalization method and background radius, or None if the
+        particles are not normalized. """
+        if not self.doNormalize:
+            return None
+
+        normType = self.getEnumText("normType")
+        bgRadius = None
+
+        if normType != "OldXmipp":
+            bgRadius = self.backRadius.get()
+            if bgRadius <= 0:
+                bgRadius = int(self._getExtractBoxSize() / 2)
+
+        return [normType, bgRadius]
+
+    def _loadInputCoords(self, micDict):
+        """ Load the coordinates of the new micrographs as one structured
+        array (micId, x, y, objId) per micrograph in self.coordDict, already
+        scaled to the extraction pixel size and without duplicates. """
+        from afm.convert import (readCoordinates, splitByMicrograph,
+                                 scaleCoordinates, dropDuplicates)
+
+        coordsFn = self.getCoords().getFileName()
+        self.debug("Loading input db: %s" % coordsFn)
+        coordSet = SetOfCoordinates(filename=coordsFn)
+        coordSet.loadAllProperties()
+
+        micIds = {mic.getObjId(): micKey for micKey, mic in micDict.items()}
+        coords = readCoordinates(coordSet, micIds=micIds)
+        self.coordsClosed = coordSet.isStreamClosed()
+        coordSet.close()
+
+        # As the positions of the extracted particles, duplicates are
+        # checked after scaling (and truncating) the coordinates
+        scaleCoordinates(coords, self.getBoxScale())
+        coords, duplicates = dropDuplicates(coords)
+        if duplicates:
+            self.warning("Ignoring %d duplicated coordinates" % duplicates)
+
+        micList = OrderedDict()
+        for micId, micCoords in splitByMicrograph(coords).items():
+            self.coordDict[micId] = micCoords
+            micList[micIds[micId]] = micDict[micIds[micId]]
+        self.debug("Coords are closed? %s" % self.coordsClosed)
+
+        return micList
+
+    def _getMicCoords(self, mic):
+        """ Coordinates of the micrograph as an array (micId, x, y, objId)
+        in the extraction pixel size. """
+        from afm.convert import COORD_DTYPE
+        return self.coordDict.get(mic.getObjId(),
+                                  np.empty(0, dtype=COORD_DTYPE))
+
+    def _getExtractor(self, doInvert, normalizeArgs, doBorders):
+        from afm import Plugin
+        from afm.processing import ParticleExtractor
+
+        dustThreshold = self.thresholdDust.get() if self.doRemoveDust else None
+        # Downsampled micrographs are shared with picking and other runs
+        cache = Plugin.getDownsampleCache() if self._doDownsample() else None
+        return ParticleExtractor(self._getExtractBoxSize(), doBorders=doBorders,
+                                 downFactor=self._getDownFactor(),
+                                 dustThreshold=dustThreshold,
+                                 doInvert=doInvert,
+                                 normalizeArgs=normalizeArgs,
+                                 patchSize=self._getPatchSize(),
+                                 cache=cache)
+
+    def _getPatchSize(self):
+        """ Patch size of the variance and Gini scores, in the pixels of
+        the downsampled micrograph. """
+        if self.patchSize.get() > 0:
+            return max(2, int(self.patchSize.get() / self._getDownFactor()))
+        return int(self._getExtractBoxSize() * 1.5)
+
+    def _getExtractBoxSize(self):
+        if self.boxSize.get() == -1:
+            boxSize = int(self.getBoxSize())
+        else:
+            boxSize = int(self.boxSize.get())
+
+        downFactor =  self._getDownFactor()
+        if downFactor > 1:
+            newBoxSize = self.getEven(boxSize/downFactor)
+        else:
+            newBoxSize = boxSize
+
+        return int(newBoxSize)
 
     def _micsOther(self):
         """ Return True if other micrographs are used for extract. """
@@ -345,38 +365,17 @@ class ProtExtractAFMParticles(ProtExtractParticles):
         return newSampling
 
     def _getDownFactor(self):
-        downFactor = 1
-        if self.doResize:
-            if self.resizeOption == self.RESIZE_FACTOR:
-                downFactor = self.downFactor.get()
-            elif self.resizeOption == self.RESIZE_SAMPLINGRATE:
-                downFactor = self.resizeSamplingRate.get()/self.getCoordSampling()
-            elif self.resizeOption == self.RESIZE_DIMENSIONS:
-                downFactor = self.boxSize.get()/self.resizeDim.get()
-
-        return float(downFactor)
-
-
+        return float(self.downFactor.get())
 
     def _setupBasicProperties(self):
         # Set sampling rate (before and after doDownsample) and inputMics
         # according to micsSource type
         inputCoords = self.getCoords()
-        mics = inputCoords.getMicrographs()
         self.samplingInput = inputCoords.getMicrographs().getSamplingRate()
         self.samplingMics = self.getInputMicrographs().getSamplingRate()
         self.samplingFactor = float(self.samplingMics / self.samplingInput)
 
-        scale = self.getBoxScale()
-        self.debug("Scale: %f" % scale)
-        if self.notOne(scale):
-            # If we need to scale the box, then we need to scale the coordinates
-            getPos = lambda coord: (int(coord.getX() * scale),
-                                    int(coord.getY() * scale))
-        else:
-            getPos = lambda coord: coord.getPosition()
-        # Store the function to be used for scaling coordinates
-        self._getPos = getPos
+        self.debug("Scale: %f" % self.getBoxScale())
 
     def getInputMicrographs(self):
         """ Return the micrographs associated to the SetOfCoordinates or
@@ -386,21 +385,6 @@ class ProtExtractAFMParticles(ProtExtractParticles):
         else:
             return self.inputMicrographs.get()
 
-    def _storeMethodsInfo(self, fnImages):
-        """ Store some information when the protocol finishes. """
-        mdImgs = md.MetaData(fnImages)
-        total = mdImgs.size()
-        mdImgs.removeDisabled()
-        zScoreMax = mdImgs.getValue(md.MDL_ZSCORE, mdImgs.lastObject())
-        numEnabled = mdImgs.size()
-        numRejected = total - numEnabled
-        msg = ""
-
-        if self.doFlip:
-            msg += "\nPhase flipping was performed."
-
-        self.methodsVar.set(msg)
-
     def getCoords(self):
         return self.inputCoordinates.get()
 
@@ -435,74 +419,69 @@ class ProtExtractAFMParticles(ProtExtractParticles):
         # This function is needed by the wizard and for auto-boxSize selection
         return self.getEven(self.getCoords().getBoxSize()*FACTOR_BOXSIZE)
 
-    def _getOutputImgMd(self):
-        return self._getPath('images.xmd')
-
-    def createParticles(self, item, row):
-        from ..convert import rowToParticle
-
-        particle = rowToParticle(row, readCtf=self._useCTF())
-        coord = particle.getCoordinate()
-        item.setY(coord.getY())
-        item.setX(coord.getX())
-        particle.setCoordinate(item)
-        self.imgSet.append(particle)
-        item._appendItem = False
-
     def readPartsFromMics(self, micList, outputParts):
         """ Read the particles extract for the given list of micrographs
-        and update the outputParts set with new items.
+        and update the outputParts set with new items, inserted in bulk.
+        The extracted coordinate ids are matched with a sorted search in
+        the coordinates of each micrograph, already scaled.
         """
-        p = Particle()
-        for mic in micList:
-            # We need to make this dict because there is no ID in the .xmd file
-            coordDict = {}
-            for coord in self.coordDict[mic.getObjId()]:
-                pos = self._getPos(coord)
-                if pos in coordDict:
-                    print("WARNING: Ignoring duplicated coordinate: %s, id=%s" %
-                          (coord.getObjId(), pos))
-                coordDict[pos] = coord
-
-            added = set() # Keep track of added coords to avoid duplicates
-            fnMicXmd = self._getMicXmd(mic)
-            if exists(fnMicXmd):
-                for row in md.iterRows(fnMicXmd):
-                    pos = (row.getValue(md.MDL_XCOOR), row.getValue(md.MDL_YCOOR))
-                    coord = coordDict.get(pos, None)
-                    if coord is not None and coord.getObjId() not in added:
-                        # scale the coordinates according to particles dimension.
-                        coord.scale(self.getBoxScale())
-                        p.copyObjId(coord)
-                        p.setLocation(xmippToLocation(row.getValue(md.MDL_IMAGE)))
+        from afm.objects import bulkAppend
+        from afm.convert import lookupCoordinates
+        from afm.processing.scoring import SCORE_BY_VAR, SCORE_BY_GINI
+
+        sampling = outputParts.getSamplingRate()
+
+        def _iterParticles():
+            p = Particle()
+            coord = Coordinate()
+            # Scores of the variance and Gini coeff. of the mic zone
+            varScore, giniScore = Float(), Float()
+            setattr(p, SCORE_BY_VAR, varScore)
+            setattr(p, SCORE_BY_GINI, giniScore)
+            firstDim = outputParts.isEmpty()
+            for mic in micList:
+                micId = mic.getObjId()
+                coords = self._getMicCoords(mic)
+                fnParts = self._getMicParts(mic)
+                fnStack = self._getMicStack(mic)
+
+                if os.path.exists(fnParts):
+                    parts = np.load(fnParts)
+                    rows = coords[lookupCoordinates(coords, parts['objId'])]
+                    scores = zip(parts['varScore'].tolist(),
+                                 parts['giniScore'].tolist())
+                    coord.setMicName(mic.getMicName())
+                    p.setCTF(mic.getCTF())
+                    for index, ((_, x, y, objId), (var, gini)) in enumerate(
+                            zip(rows.tolist(), scores)):
+                        varScore.set(var)
+                        giniScore.set(gini)
+                        coord.setObjId(objId)
+                        coord.setPosition(x, y)
+                        coord.setMicId(micId)
+                        p.setObjId(objId)
+                        p.setLocation(index + 1, fnStack)
+                        p.setSamplingRate(sampling)
                         p.setCoordinate(coord)
-                        p.setMicId(mic.getObjId())
-                        p.setCTF(mic.getCTF())
-                        # adding the variance and Gini coeff. value of the mic zone
-                        setXmippAttributes(p, row, md.MDL_SCORE_BY_VAR)
-                        setXmippAttributes(p, row, md.MDL_SCORE_BY_GINI)
-                        setXmippAttributes(p, row, md.MDL_LOCAL_AVERAGE)
-                        if row.containsLabel(md.MDL_ZSCORE_DEEPLEARNING1):
-                            setXmippAttributes(p, row, md.MDL_ZSCORE_DEEPLEARNING1)
-
-                        # disabled particles (in metadata) should not add to the
-                        # final set
-                        if row.getValue(md.MDL_ENABLED) > 0:
-                            outputParts.append(p)
-                            added.add(coord.getObjId())
-
-            # Release the list of coordinates for this micrograph since it
-            # will not be longer needed
-            del self.coordDict[mic.getObjId()]
-
-    def _getMicPos(self, mic):
-        """ Return the corresponding .pos file for a given micrograph. """
+                        p.setMicId(micId)
+                        if firstDim:
+                            outputParts._setFirstDim(p)
+                            firstDim = False
+                        yield p
+
+                # Release the coordinates for this micrograph since they
+                # will not be longer needed
+                self.coordDict.pop(micId, None)
+
+        bulkAppend(outputParts, _iterParticles())
+
+    def _getMicStack(self, mic):
+        """ Return the .mrcs stack with the particles of a micrograph. """
         micBase = pwutils.removeBaseExt(mic.getFileName())
-        return self._getExtraPath(micBase + ".pos")
+        return self._getExtraPath(micBase + ".mrcs")
 
-    def _getMicXmd(self, mic):
-        """ Return the corresponding .xmd with extracted particles
-        for this micrograph. """
+    def _getMicParts(self, mic):
+        """ Return the file with the coordinates (objId, x, y) of the
+        particles extracted from a micrograph, in the stack order. """
         micBase = pwutils.removeBaseExt(mic.getFileName())
-        return self._getExtraPath(micBase + ".xmd")
-    '''
+        return self._getExtraPath(micBase + "_parts.npy")
@@ -31,13 +31,21 @@ Describe your python module here:
 This module will provide the traditional Hello world example
 """
 import os
-import re
+import time
+from collections import Counter
+from datetime import datetime, timedelta
 
+import numpy as np
+
+from pyworkflow import HELP_DURATION_FORMAT
 from pyworkflow.constants import BETA
 import pyworkflow.protocol.params as params
+from pyworkflow.object import Integer
 
 from pwem.protocols import EMProtocol
-from afm.objects import SetOfAFMmovies, AFMmovie, AFMAcquisition
+from afm.constants import SCAN_DIRECTIONS
+from afm.objects import SetOfAFMmovies, AFMAcquisition
+from afm.utils import iterFiles, FileManifest, FileEntry
 
 
 class ProtImportAFMmovies(EMProtocol):
@@ -48,13 +56,22 @@ class ProtImportAFMmovies(EMProtocol):
     _outputClassName = 'SetOfAFMmovies'
     _devStatus = BETA
 
+    OUTPUT_NAME = 'outputSetOfTiltSeries'
+
     def __init__(self, **args):
         EMProtocol.__init__(self, **args)
+        self._mismatchedMovies = Integer(0)
 
     def _defineParams(self, form):
         form.addSection(label='Input')
         form.addParam('inputFile', params.FileParam,
-                      label='Files to import')
+                      label='Files to import',
+                      help='Glob pattern of the files to import, e.g. '
+                           '/data/session/*.tif. Use ** to also search in '
+                           'nested folders, e.g. /data/session/**/*.tif\n'
+                           'Besides MRC and TIFF stacks, high-speed AFM '
+                           '(.asd), Bruker (.spm) and JPK (.jpk) files are '
+                           'read directly, without converting them.')
 
         form.addParam('samplingRate', params.FloatParam,
                       label='Pixel size [Å/pix]',
@@ -66,87 +83,353 @@ class ProtImportAFMmovies(EMProtocol):
 
         form.addParam('scanningFreq', params.FloatParam,
                       label='Scanning Frequency [s⁻1]',
-                      default=1.0)
+                      default=1.0,
+                      help='Lines per second of the fast scan axis. Use 0 '
+                           'if unknown, the scanning time per image is then '
+                           'split evenly between its lines.')
+
+        form.addParam('scanDirection', params.EnumParam,
+                      choices=['top to bottom', 'bottom to top'],
+                      default=0,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label='Slow scan direction',
+                      help='Order in which the lines of an image are '
+                           'acquired, used for the acquisition time of '
+                           'each line.')
+
+        form.addSection(label='Streaming')
+        form.addParam('dataStreaming', params.BooleanParam, default=False,
+                      label="Process data in streaming?",
+                      help="Select this option if you want import data as it is "
+                           "acquired and process on the fly by next protocols. "
+                           "In this case the protocol will keep running to check "
+                           "new files and will update the output set, which can "
+                           "be used right away by next steps.")
+
+        form.addParam('timeout', params.StringParam, default="12h",
+                      condition='dataStreaming',
+                      label="Timeout",
+                      help="Duration after which, if no new file is detected, "
+                           "the protocol will end and the output set will be "
+                           "closed. You can also stop the import from the "
+                           "right click menu of the protocol.\n%s"
+                           % HELP_DURATION_FORMAT)
 
+        form.addParam('pollingInterval', params.IntParam, default=10,
+                      condition='dataStreaming',
+                      label="Polling interval (s)",
+                      help="Seconds to wait between two scans of the input "
+                           "folder. A file is only imported once its size has "
+                           "not changed between two consecutive scans.")
+
+        form.addParam('commitInterval', params.IntParam, default=30,
+                      condition='dataStreaming',
+                      label="Commit interval (s)",
+                      help="The new movies are appended in batches to the "
+                           "output set, and the set is committed at most "
+                           "once per this number of seconds.")
+
+        form.addParallelSection(threads=4, mpi=0)
 
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
         # Insert processing steps
-        self._insertFunctionStep(self.importStep)
+        if self.dataStreaming:
+            self._insertFunctionStep(self.importStreamStep)
+        else:
+            self._insertFunctionStep(self.importStep)
 
-    def findFiles(self, inputRegEx, searchPath=None):
+    def findFiles(self, pattern, onlyChanged=False, manifest=None):
         """
-        This function searches files that matche with a specific regular expresion in a
-        searching folder
+        This function searches the files that match a glob pattern. The
+        pattern may contain '**' to search in nested folders.
 
         Args:
-            inputRegEx: Regular expression to find the files
-            searchPath: This is the searching folder, current workind dir as default
+            pattern: Glob pattern of the files to find
+            onlyChanged: If True, only the files that are new or have been
+                modified since the last search are returned, according to
+                the manifest. The size and mtime of each file come from the
+                folder listing, so nothing else is read for the unchanged
+                ones.
+            manifest: FileManifest where the files found are registered, by
+                default the one stored in the extra folder. It is not saved
+                here: the caller saves it once the files are committed to
+                the output, so an interrupted run never skips files that
+                did not reach it.
 
         Returns:
-            A list with the files that verify the regular expression.
-
-        Raises:
-             TypeError: If the input is not a string
+            A sorted list with the files that match the pattern (empty
+            if there are none).
         """
-        import glob
-        inputRegEx_str = str(inputRegEx)
-        print('aa')
-        partes_patron = inputRegEx_str.split(os.sep) # Separamos por el separador del sistema operativo
-        print(partes_patron)
-        ruta_base = os.sep.join(partes_patron[:-1]) # Unimos todas las partes menos la última para la ruta
-        patron_archivo = partes_patron[-1]
-
-        # Si la ruta base está vacía, se asume el directorio actual
-        if not ruta_base:
-            print('A filename was introduced not a path with a pattern')
-            ruta_base = "."
-
-        # Usamos glob para obtener todos los archivos que coinciden con el patrón de archivo en la ruta base.
-        archivos_en_ruta = glob.glob(os.path.join(ruta_base, patron_archivo))
-
-        print('archivos en ruta')
-        print(archivos_en_ruta)
-        archivos_coincidentes = []
-        if archivos_en_ruta:
-            archivos_coincidentes = archivos_en_ruta
-            return archivos_coincidentes, ruta_base
+        entries = iterFiles(pattern, numberOfThreads=self.numberOfThreads.get())
+        if manifest is None:
+            manifest = FileManifest(self._getManifestFile())
+
+        if onlyChanged:
+            entries = manifest.iterChanged(entries)
         else:
-            return None
+            entries = list(entries)
+            for entry in entries:
+                manifest.add(entry)
 
-    def importStep(self):
+        return [entry.path for entry in entries]
 
+    def importStep(self):
         filesPath = self.inputFile.get()
-        print(filesPath)
+        self.info("Using pattern: '%s'" % filesPath)
+
+        outputSetOfAFMmovies = (getattr(self, self.OUTPUT_NAME, None)
+                                if self.isContinued() else None)
+        manifest = FileManifest(self._getManifestFile())
+        if outputSetOfAFMmovies is None:
+            outputSetOfAFMmovies = self._createOutputSet()
+            listOfFiles = self.findFiles(filesPath, manifest=manifest)
+        else:
+            # Re-import: only the files that are not in the output yet
+            outputSetOfAFMmovies.loadAllProperties()
+            outputSetOfAFMmovies.enableAppend()
+            self._syncManifest(manifest, outputSetOfAFMmovies)
+            imported = set(manifest)
+            listOfFiles = self.findFiles(filesPath, onlyChanged=True,
+                                         manifest=manifest)
+            changed = sum(1 for fn in listOfFiles if fn in imported)
+            if changed:
+                self.warning("%d files changed since they were imported, "
+                             "they are not imported again" % changed)
+            listOfFiles = [fn for fn in listOfFiles if fn not in imported]
+        self.info("Found %d files" % len(listOfFiles))
+
+        for fileName in self._appendMovies(outputSetOfAFMmovies, listOfFiles):
+            manifest.discard(fileName)
+
+        if self.hasAttribute(self.OUTPUT_NAME):
+            self._updateOutputSet(self.OUTPUT_NAME, outputSetOfAFMmovies,
+                                  state=outputSetOfAFMmovies.STREAM_CLOSED)
+        else:
+            self._defineOutputs(**{self.OUTPUT_NAME: outputSetOfAFMmovies})
+        manifest.save()
+
+    def importStreamStep(self):
+        """ Poll the input folder while the acquisition is running. A new
+        file is accepted once its size and modification time are the same
+        in two consecutive scans. The accepted movies are appended to an open
+        output set that is committed every commitInterval seconds, and the set
+        is closed after the timeout without new files or when the import is
+        stopped.
+        """
+        pattern = self.inputFile.get()
+        self.info("Using pattern: '%s'" % pattern)
+
+        manifest = FileManifest(self._getManifestFile())
+        outputSet = getattr(self, self.OUTPUT_NAME, None) if self.isContinued() else None
+        if outputSet is None:
+            outputSet = self._createOutputSet()
+        else:
+            outputSet.loadAllProperties()
+            outputSet.enableAppend()
+            self._syncManifest(manifest, outputSet)
+            if os.path.exists(self._getStopStreamingFilename()):
+                os.remove(self._getStopStreamingFilename())
+
+        timeout = timedelta(seconds=self.timeout.toSeconds())
+        commitInterval = timedelta(seconds=self.commitInterval.get())
+        pendingFiles = {}  # path -> (size, mtime) seen in the previous scan
+        failedFiles = {}  # path -> (size, mtime) of unreadable headers
+        newFiles = {}
+        lastChange = lastCommit = datetime.now()
+        finished = False
 
-        listOfFiles, basePath = self.findFiles(filesPath)
+        while not finished:
+            someNew = False
+            # The files already imported are not even stat'ed again
+            for entry in iterFiles(pattern, numberOfThreads=self.numberOfThreads.get(),
+                                   exclude=manifest):
+                stamp = (entry.size, entry.mtime)
+                if entry.path in newFiles or failedFiles.get(entry.path) == stamp:
+                    continue  # waiting for the commit, or not readable
+                someNew = True
+                if entry.size == 0 or pendingFiles.get(entry.path) != stamp:
+                    pendingFiles[entry.path] = stamp  # still being written
+                    continue
+                del pendingFiles[entry.path]
+                newFiles[entry.path] = entry
 
-        print(listOfFiles)
+            now = datetime.now()
+            if someNew:
+                lastChange = now
+            # The stop file is honored even while new files keep arriving,
+            # the files still being written are left for a continued run
+            finished = (os.path.exists(self._getStopStreamingFilename()) or
+                        now - lastChange > timeout)
+
+            if newFiles and (finished or now - lastCommit >= commitInterval):
+                self.info("Appending %d new movies" % len(newFiles))
+                failed = self._appendMovies(outputSet, list(newFiles))
+                for fileName, entry in newFiles.items():
+                    if fileName in failed:
+                        failedFiles[fileName] = (entry.size, entry.mtime)
+                    else:
+                        manifest.add(entry)
+                # The manifest only lists committed movies
+                self._updateOutputSet(self.OUTPUT_NAME, outputSet,
+                                      state=outputSet.STREAM_OPEN)
+                manifest.save()
+                newFiles = {}
+                lastCommit = now
+
+            if not finished:
+                time.sleep(self.pollingInterval.get())
+
+        self._updateOutputSet(self.OUTPUT_NAME, outputSet,
+                              state=outputSet.STREAM_CLOSED)
+        manifest.save()
+
+    # --------------------------- UTILS functions ------------------------------
+    def _getManifestFile(self):
+        return self._getExtraPath('files_manifest.json')
+
+    def _getStopStreamingFilename(self):
+        return self._getExtraPath("STOP_STREAMING.TXT")
+
+    def _syncManifest(self, manifest, outputSet):
+        """ Register in the manifest the movies of the output that are not
+        in it, committed right before the run was interrupted and the
+        manifest saved, so they are not imported twice. """
+        for fileName in outputSet.getUniqueValues('_filename'):
+            if fileName not in manifest and os.path.exists(fileName):
+                st = os.stat(fileName)
+                manifest.add(FileEntry(fileName, st.st_size, st.st_mtime))
+
+    def _createOutputSet(self):
         sampling = self.samplingRate.get()
-        scanningTime = self.scanningTime.get()
         scanningFreq = self.scanningFreq.get()
 
         outputSetOfAFMmovies = SetOfAFMmovies.create(self._getPath(), template='setOfAFMmovies%s.sqlite')
 
-        acqInfo = AFMAcquisition(sampling=sampling, scanningTime=scanningTime, scanningFreq=scanningFreq)
+        acqInfo = AFMAcquisition(lineTime=1. / scanningFreq if scanningFreq else None,
+                                 frameTime=self.scanningTime.get(),
+                                 pixelSize=sampling,
+                                 scanDirection=SCAN_DIRECTIONS[self.scanDirection.get()])
 
         outputSetOfAFMmovies.setSamplingRate(sampling)
         outputSetOfAFMmovies.setAFMAcquisition(acqInfo)
-        for f in listOfFiles:
-            movie = AFMmovie(location=f)
-            outputSetOfAFMmovies.append(movie)
-            outputSetOfAFMmovies.update(movie)
 
-        self._defineOutputs(outputSetOfTiltSeries=outputSetOfAFMmovies)
+        return outputSetOfAFMmovies
+
+    def _appendMovies(self, outputSet, fileNames):
+        """ Read the movie headers in a pool of processes and append the
+        movies to the output set with their dimensions, number of frames,
+        data type and frame time. Movies whose dimensions differ from the
+        ones of the set are reported.
+
+        Returns:
+            The files whose header could not be read, which are not
+            appended (they are retried in a continued run).
+        """
+        from afm.convert import readHeaders
+
+        headers = {h.fileName: h for h in
+                   readHeaders(fileNames, self.numberOfThreads.get())}
+        frameTime = self.scanningTime.get()
+
+        failed = [h.fileName for h in headers.values() if h.error is not None]
+        for fileName in failed:
+            self.warning("Could not read the header of %s, it is not "
+                         "imported: %s" % (fileName, headers.pop(fileName).error))
+
+        if outputSet.getDim() is None:
+            dims = Counter((h.xDim, h.yDim) for h in headers.values())
+            refDim = dims.most_common(1)[0][0] if dims else None
+        else:
+            refDim = outputSet.getDim()[:2]
+
+        for h in headers.values():
+            if (h.xDim, h.yDim) != refDim:
+                self.warning("Movie %s has dimensions %d x %d, different from "
+                             "the %d x %d of the set"
+                             % (h.fileName, h.xDim, h.yDim, *refDim))
+                self._mismatchedMovies.increment()
+
+        acquisition = outputSet.getAFMAcquisition()
+        timingError = refDim and acquisition.getTiming().checkLines(refDim[1])
+        if timingError:
+            self.warning("Scan timing: %s, the frame time is split evenly "
+                         "between the lines" % timingError)
+        heightScales = {(h.heightScale, h.heightOffset or 0.)
+                        for h in headers.values() if h.heightScale is not None}
+        if heightScales:
+            if acquisition.getHeightScale() is None:
+                scale, offset = heightScales.pop()
+                acquisition.setHeightScale(scale)
+                acquisition.setHeightOffset(offset)
+            used = (acquisition.getHeightScale(),
+                    acquisition.getHeightOffset())
+            if heightScales - {used}:
+                self.warning("The movies have different height scales, "
+                             "using %f nm per unit + %f nm" % used)
+
+        # Movies with dropped frames keep the time of each frame in a
+        # sidecar file, the others only need the frame time
+        timestampsDir = self._getExtraPath('timestamps')
+        movieNumbers = iter(range(outputSet.getSize() + 1, outputSet.getSize()
+                                  + len(headers) + 1))
+
+        def _fillMovie(movie, fileName):
+            h = headers[fileName]
+            movie.setDimensions(h.xDim, h.yDim, h.nFrames)
+            movie.setDataType(h.dataType)
+            movie.setFrameTime(h.frameTime or frameTime)
+            movie.setTimestampsFile(None)
+            number = next(movieNumbers)
+            if h.frameTimes is not None:
+                timestampsFn = os.path.join(timestampsDir, 'movie_%06d.npy' % number)
+                os.makedirs(timestampsDir, exist_ok=True)
+                np.save(timestampsFn, np.asarray(h.frameTimes, dtype=np.float64))
+                movie.setTimestampsFile(timestampsFn)
+
+        if refDim is not None and outputSet.getDim() is None:
+            # Do not let the first appended movie define the set dimensions
+            refFrames = next(h.nFrames for h in headers.values()
+                             if (h.xDim, h.yDim) == refDim)
+            outputSet.setDim((*refDim, refFrames))
+
+        outputSet.appendFiles([fn for fn in fileNames if fn in headers],
+                              fillItem=_fillMovie)
+        self._store(self._mismatchedMovies)
+        return failed
+
+    def getActions(self):
+        """ Allow to stop the import from the protocol context menu. """
+        if self.dataStreaming and self.isRunning():
+            return [('STOP STREAMING', self.stopImport)]
+        return []
+
+    def stopImport(self, e=None):
+        """ Create the stop file, the streaming loop will close the
+        output set in its next iteration. """
+        with open(self._getStopStreamingFilename(), 'w') as f:
+            f.write('stop import')
 
     # --------------------------- INFO functions -----------------------------------
     def _validate(self):
         errors = []
+        pattern = self.inputFile.get()
+        if not pattern:
+            errors.append('A pattern of files to import is required.')
+        elif not self.dataStreaming and next(iterFiles(pattern), None) is None:
+            errors.append('There are no files matching the pattern %s' % pattern)
+        if not self.scanningTime.get() or self.scanningTime.get() <= 0:
+            errors.append('The scanning time per image should be positive.')
+        if self.scanningFreq.get() is not None and self.scanningFreq.get() < 0:
+            errors.append('The scanning frequency can not be negative.')
         return errors
 
     def _summary(self):
         """ Summarize what the protocol has done"""
         summary = []
+        if self._mismatchedMovies.get():
+            summary.append("%d movies have different dimensions than the "
+                           "rest of the set" % self._mismatchedMovies.get())
         return summary
 
     def _methods(self):
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import time
+
+import pyworkflow.utils as pwutils
+from pyworkflow.constants import BETA
+from pyworkflow.protocol.constants import LEVEL_ADVANCED
+import pyworkflow.protocol.params as params
+from pwem.protocols import EMProtocol
+
+# Line flattening choices, in the order of the lineMethod param
+LINE_METHODS = ['none', 'median', 'polynomial']
+# Seconds between checks for new items of a streaming input
+POLLING_INTERVAL = 10
+
+
+class ProtLevelAFM(EMProtocol):
+    """ Removal of the tilt, bow and line-to-line offsets of AFM height
+    maps. A polynomial background is fitted to every frame and the offset
+    (or a low-order polynomial) of each scan line is removed, excluding the
+    features on the surface from the fits. Movies and micrographs are
+    processed in chunks of frames in a pool of processes, and the output
+    set grows as the files are finished. A streaming input is followed
+    until it is closed. """
+    _label = 'level and flatten'
+    _devStatus = BETA
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputSet', params.PointerParam,
+                      pointerClass='SetOfAFMmovies,SetOfMicrographs',
+                      important=True,
+                      label='Input movies or micrographs')
+
+        group = form.addGroup('Background')
+        group.addParam('planeOrder', params.IntParam, default=1,
+                       label='Polynomial order',
+                       help='Order of the polynomial background fitted to '
+                            'each frame: 0 removes an offset, 1 a plane '
+                            '(tilt), 2 also the bow of the scanner. Use -1 '
+                            'to not fit any background.')
+
+        group = form.addGroup('Line flattening')
+        group.addParam('lineMethod', params.EnumParam, default=1,
+                       choices=LINE_METHODS,
+                       display=params.EnumParam.DISPLAY_HLIST,
+                       label='Flattening',
+                       help='Correction of each scan line: its median '
+                            '(offset between lines) or a polynomial '
+                            'fitted to it.')
+        group.addParam('lineOrder', params.IntParam, default=1,
+                       condition='lineMethod == 2',
+                       label='Line polynomial order')
+
+        group = form.addGroup('Features')
+        group.addParam('doMaskFeatures', params.BooleanParam, default=True,
+                       label='Exclude features from the fits?',
+                       help='If Yes, the fits are repeated excluding the '
+                            'pixels much higher than the background, so '
+                            'molecules do not bias the background and line '
+                            'offsets.')
+        group.addParam('threshold', params.FloatParam, default=2.0,
+                       condition='doMaskFeatures',
+                       label='Feature threshold (sigmas)',
+                       help='Pixels higher than this number of robust '
+                            'standard deviations of the leveled frame are '
+                            'features.')
+        group.addParam('iterations', params.IntParam, default=2,
+                       condition='doMaskFeatures',
+                       expertLevel=LEVEL_ADVANCED,
+                       label='Iterations',
+                       help='Number of fits, the features found in each one '
+                            'are excluded from the next.')
+
+        form.addParam('chunkSize', params.IntParam, default=16,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Frames per chunk',
+                      help='Frames processed together by each process.')
+        form.addParam('commitInterval', params.IntParam, default=30,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Output commit interval (s)',
+                      help='Finished files are added to the output set, '
+                           'which is committed at most once per this '
+                           'number of seconds.')
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep(self.levelStep)
+
+    # --------------------------- STEPS functions -----------------------------
+    def levelStep(self):
+        """ Level the input files in rounds: each one takes the items of the
+        input that are not leveled yet, so a streaming input is followed
+        until it is closed, and a continued run skips the items already in
+        the output. """
+        from afm.processing.leveling import StackLeveler
+
+        leveler = StackLeveler(planeOrder=self.planeOrder.get(),
+                               lineMethod=LINE_METHODS[self.lineMethod.get()],
+                               lineOrder=self.lineOrder.get(),
+                               iterations=(self.iterations.get()
+                                           if self.doMaskFeatures else 1),
+                               threshold=self.threshold.get(),
+                               chunkSize=self.chunkSize.get())
+
+        outputSet = (getattr(self, self._getOutputName(), None)
+                     if self.isContinued() else None)
+        if outputSet is None:
+            outputSet = self._createOutputSet()
+            done = set()
+        else:
+            outputSet.loadAllProperties()
+            outputSet.enableAppend()
+            done = {item.getObjId() for item in outputSet.iterItems()}
+
+        lastId = 0
+        lastCommit = time.time()
+        while True:
+            inputSet = self._loadInputSet()
+            inputClosed = inputSet.isStreamClosed()
+            # Streaming sets are appended with increasing ids
+            items = [item.clone() for item in
+                     inputSet.iterItems(orderBy='id', where='id > %d' % lastId)
+                     if item.getObjId() not in done]
+            voxelSize = inputSet.getSamplingRate()
+            inputSet.close()
+
+            if items:
+                lastId = items[-1].getObjId()
+                jobs = [(item.getFileName(), self._getOutputFile(item))
+                        for item in items]
+                for i in leveler.levelFiles(jobs, self.numberOfThreads.get(),
+                                            voxelSize=voxelSize):
+                    item = items[i]
+                    done.add(item.getObjId())
+                    if not os.path.exists(jobs[i][1]):
+                        self.warning("%s has no frames, it is left out of the "
+                                     "output" % jobs[i][0])
+                        continue
+                    item.setLocation(jobs[i][1])
+                    if hasattr(item, 'setDataType'):
+                        item.setDataType('float32')
+                    outputSet.append(item)
+                    if time.time() - lastCommit >= self.commitInterval.get():
+                        self._updateOutputSet(self._getOutputName(), outputSet,
+                                              state=outputSet.STREAM_OPEN)
+                        lastCommit = time.time()
+            elif inputClosed:
+                break
+            else:
+                time.sleep(POLLING_INTERVAL)
+
+        self._updateOutputSet(self._getOutputName(), outputSet,
+                              state=outputSet.STREAM_CLOSED)
+        self._defineSourceRelation(self.inputSet, outputSet)
+
+    # --------------------------- UTILS functions -----------------------------
+    def _isMovies(self):
+        return self.inputSet.get().getClassName() == 'SetOfAFMmovies'
+
+    def _getOutputName(self):
+        return 'outputMovies' if self._isMovies() else 'outputMicrographs'
+
+    def _loadInputSet(self):
+        """ Fresh copy of the input set, to see the items appended to it
+        while it is being streamed. """
+        inputSet = self.inputSet.get()
+        newSet = inputSet.getClass()(filename=inputSet.getFileName())
+        newSet.loadAllProperties()
+        return newSet
+
+    def _createOutputSet(self):
+        """ Empty open set of the class of the input, with its info. The
+        leveled heights are in nm, so their height scale is 1. """
+        inputSet = self.inputSet.get()
+        outputSet = inputSet.getClass()(filename=self._getPath(
+            'movies.sqlite' if self._isMovies() else 'micrographs.sqlite'))
+        outputSet.copyInfo(inputSet)
+        if self._isMovies():
+            acquisition = outputSet.getAFMAcquisition()
+            if acquisition.getHeightScale() is not None:
+                acquisition.setHeightScale(1.0)
+                acquisition.setHeightOffset(0.0)
+        outputSet.setStreamState(outputSet.STREAM_OPEN)
+        return outputSet
+
+    def _getOutputFile(self, item):
+        return self._getExtraPath('%s_%06d_leveled.mrc'
+                                  % (pwutils.removeBaseExt(item.getFileName()),
+                                     item.getObjId()))
+
+    # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = []
+        if self.lineMethod.get() == 0 and self.planeOrder.get() < 0:
+            errors.append('Nothing to do: there is neither a background '
+                          'polynomial nor a line flattening.')
+        if self.chunkSize.get() < 1:
+            errors.append('The number of frames per chunk should be positive.')
+        return errors
+
+    def _summary(self):
+        summary = []
+        output = getattr(self, self._getOutputName(), None)
+        if output is not None:
+            summary.append('%d %s leveled (background order %d, %s line '
+                           'flattening)' % (output.getSize(),
+                                            'movies' if self._isMovies()
+                                            else 'micrographs',
+                                            self.planeOrder.get(),
+                                            LINE_METHODS[self.lineMethod.get()]))
+        return summary
+
+    def _methods(self):
+        methods = []
+        return methods
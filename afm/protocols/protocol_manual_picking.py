@@ -30,8 +30,11 @@
 Describe your python module here:
 This module will provide the traditional Hello world example
 """
+import os
 
+import pyworkflow.utils as pwutils
 from pyworkflow.constants import BETA
+from pwem.objects import Coordinate
 from xmipp3.protocols.protocol_particle_pick import XmippProtParticlePicking
 
 
@@ -46,6 +49,57 @@ class ProtManualPickingAFM(XmippProtParticlePicking):
     def __init__(self, **args):
         XmippProtParticlePicking.__init__(self, **args)
 
+    # --------------------------- STEPS functions ------------------------------
+    def createOutputStep(self):
+        self._createOutput(self._getExtraPath())
+
+    def registerCoords(self, coordsDir):
+        """ Called from the picking GUI to register a new output. Only
+        the .pos files changed since the last registration are read. """
+        self._createOutput(coordsDir)
+        self._store()
+
+    def readSetOfCoordinates(self, workingDir, coordSet):
+        """ Fill the coordinate set from the session store, after
+        updating it with the .pos files written by the picker. """
+        from afm.objects import bulkAppend
+        from afm.convert import CoordinateStore, readStarValue
+
+        micSet = self.getInputMicrographs()
+        mics = {mic.getObjId(): mic.clone() for mic in micSet}
+        posFiles = {micId: os.path.join(workingDir, pwutils.removeBaseExt(
+            mic.getFileName()) + '.pos') for micId, mic in mics.items()}
+
+        with CoordinateStore(self._getStoreFile()) as store:
+            updated = store.syncPosFiles(posFiles)
+            configFile = os.path.join(workingDir, 'config.xmd')
+            if os.path.exists(configFile):
+                store.setBoxSize(readStarValue(configFile, 'properties',
+                                               'pickingParticleSize'))
+            store.save()
+            self.info("Read %d modified .pos files" % len(updated))
+
+            if store.getBoxSize() is not None:
+                coordSet.setBoxSize(store.getBoxSize())
+
+            def _iterCoords():
+                coord = Coordinate()
+                for micId, positions in store.iterCoordinates():
+                    if micId not in mics:
+                        continue
+                    coord.setMicrograph(mics[micId])
+                    for x, y in positions.tolist():
+                        coord.setObjId(None)
+                        coord.setPosition(x, y)
+                        yield coord
+
+            bulkAppend(coordSet, _iterCoords())
+
+    # --------------------------- UTILS functions ------------------------------
+    def _getStoreFile(self):
+        """ Coordinates of the session, see afm.convert.CoordinateStore. """
+        return self._getExtraPath('coordinates_store.sqlite')
+
     # --------------------------- INFO functions -----------------------------------
     def _validate(self):
         errors = []
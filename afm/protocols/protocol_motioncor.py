@@ -30,18 +30,27 @@
 Describe your python module here:
 This module will provide the traditional Hello world example
 """
+import os
+import shutil
+import struct
+import time
+
+import numpy as np
 
 from pyworkflow.constants import BETA
-from motioncorr.protocols.protocol_motioncorr import ProtMotionCorr
-from xmipp3.protocols.protocol_flexalign import XmippProtFlexAlign
 
-from pwem.objects.data import Micrograph
 import pyworkflow.protocol.params as params
 import pyworkflow.utils as pwutils
 import pyworkflow.protocol.constants as cons
-from pwem.protocols import ProtAlignMovies
 from pwem.protocols import EMProtocol
 
+from afm.objects import AFMMicrograph, SetOfAFMMicrographs, ScanTiming
+
+ENGINE_CPU = 0
+ENGINE_MOTIONCOR = 1
+
+OUTPUT_NAME = 'micSet'
+
 
 class ProtMotionCorAFMmovies(EMProtocol):
     """
@@ -50,6 +59,7 @@ class ProtMotionCorAFMmovies(EMProtocol):
     _label = 'motioncor AFM'
     _outputClassName = 'AFMImages'
     _devStatus = BETA
+    stepsExecutionMode = cons.STEPS_PARALLEL
     '''
     def __init__(self, **args):
         XmippProtFlexAlign.__init__(self, **args)
@@ -78,11 +88,55 @@ class ProtMotionCorAFMmovies(EMProtocol):
                       label='from')
         line.addParam('alignFrameN', params.IntParam, default=0,
                       label='to')
+        group.addParam('useTimeRange', params.BooleanParam, default=False,
+                       label='Select the frames by time?',
+                       help='If Yes, the frames acquired in a time range are '
+                            'aligned instead of a range of frames. The time '
+                            'of each frame is taken from its timestamps, so '
+                            'dropped frames and variable frame rates are '
+                            'taken into account.')
+        line = group.addLine('Time range (s)', condition='useTimeRange',
+                             help='Seconds from the start of the first frame '
+                                  'of the movie. A negative final time means '
+                                  'until the last frame.')
+        line.addParam('alignTime0', params.FloatParam, default=0.,
+                      label='from')
+        line.addParam('alignTimeN', params.FloatParam, default=-1.,
+                      label='to')
 
         group.addParam('binFactor', params.FloatParam, default=1.,
                        label='Binning factor',
                        help='1x or 2x. Bin stack before processing.')
 
+        group.addParam('alignEngine', params.EnumParam, default=ENGINE_CPU,
+                       choices=['CPU', 'MotionCor3'],
+                       display=params.EnumParam.DISPLAY_HLIST,
+                       label='Alignment engine',
+                       help='CPU: frames are aligned in-process with FFT '
+                            'cross-correlation, no GPU or external program '
+                            'is needed.\n'
+                            'MotionCor3: run the external GPU program.')
+        line = group.addLine('Number of patches',
+                             help='Number of patches (rows x columns) for the '
+                                  'local alignment, they overlap 50%. Set 0 '
+                                  'to do only the global alignment.')
+        line.addParam('patchX', params.IntParam, default=5, label='X')
+        line.addParam('patchY', params.IntParam, default=5, label='Y')
+        group.addParam('doScanCorrection', params.BooleanParam, default=False,
+                       condition='alignEngine == %d' % ENGINE_CPU,
+                       label='Correct scan distortions?',
+                       help='Frames are scanned line by line, so the drift '
+                            'during a frame shears and stretches it. If Yes, '
+                            'the drift is modelled as a function of the '
+                            'acquisition time of each line (from the frame '
+                            'time and the scanning frequency) and every row '
+                            'is resampled before the alignment.')
+        group.addParam('tolerance', params.FloatParam, default=0.2,
+                       expertLevel=cons.LEVEL_ADVANCED,
+                       label='Tolerance (px)',
+                       help='Stop refining the shifts when none of them '
+                            'changes more than this.')
+
         form.addParam('doSaveMovie', params.BooleanParam, default=True,
                       label="Save aligned movie?")
 
@@ -92,71 +146,286 @@ class ProtMotionCorAFMmovies(EMProtocol):
                       help="If Yes, the protocol will compute for each "
                            "aligned micrograph the PSD using EMAN2.")
 
-    def _insertAllSteps(self):
-        self._insertFunctionStep(self.movieAlignmentStep)
-        self._insertFunctionStep(self.createOutputStep)
-
-    def movieAlignmentStep(self):
-        import os
-        inputMovies = self.inputMovies.get()
-        print(inputMovies)
-
-        for movie in inputMovies.iterItems():
-            movieFolder = self._getTmpPath('movie_%06d' % movie.getObjId())
-
-            if not os.path.exists(movieFolder):
-                os.mkdir(movieFolder)
-            #outputMicFn = self._getOutputMicName(movie)
-
-            frame0, frameN = self.alignFrame0.get(), self.alignFrameN.get()
-            _, numbOfFrames, _ = inputMovies.getFramesRange()
-            if not numbOfFrames:
-                numbOfFrames = inputMovies.getFirstItem().getDim()[2]
-
-            args =  ' -InTiff %s ' % movie.getFileName()
-            args += ' -Throw %i ' % (frame0 - 1)
-            args += ' -Trunc  %i ' % 0
-            args += ' -Patch %i %i' %(5, 5)
-            args += ' -MaskCent %i %i' % (0, 0)
-            args += ' -MaskSize %i %i' % (1, 1)
-            args += ' -FtBin %f'  % self.binFactor.get()
-            args += ' -Tol %f ' % 0.20
-            args += ' -PixSize %f' % inputMovies.getSamplingRate()
-            args += ' -kV %f' % 0
-            args += ' -Cs %f' % 0
-            args += ' -OutStack %i' % (1 if self.doSaveMovie else 0)
-            args += ' -Gpu %i' % 0
-            args += ' -SumRange %f %f ' % (0.0, 0.0)
-            args += ' -LogDir %s ' % './'
-            args += ' -OutMrc %s ' % self._getExtraPath('mic_aligned_%06d.mrc' % movie.getObjId())
-
-            program = '/home/vilas/software/software/em/motioncor3-1.1.2/bin/MotionCor3_1.1.2_Cuda118_06-11-2024'
-            '''
-            argsDict['-OutMrc'] = f'"{outputMicFn}"'
-
-            args = self._getInputFormat(movie.getFileName())
-            args += ' '.join(['%s %s' % (k, v)
-                              for k, v in argsDict.items()])
-            args += ' ' + self.extraParams2.get()
-            '''
-            print(args)
-            self.runJob(program, args)
+        form.addParam('commitInterval', params.IntParam, default=30,
+                      expertLevel=cons.LEVEL_ADVANCED,
+                      label='Output commit interval (s)',
+                      help='Aligned micrographs are added to the output as '
+                           'the movies finish, grouping the updates to at '
+                           'most one every this number of seconds.')
 
+        form.addParallelSection(threads=4, mpi=0)
 
-    def createOutputStep(self):
+    def _insertAllSteps(self):
+        # One independent step per movie, so they run in parallel (up to
+        # the number of threads) and a continued run only repeats the
+        # movies that did not finish. The steps of the movies that failed
+        # get their number of failures as argument, so they differ from
+        # the finished ones and a continued run tries them again
+        alignSteps = []
+        self._previousFailures = {}
+        timing = self._getScanTiming()
+        self._writeMovieList()
+        for movie in self.inputMovies.get().iterItems():
+            frameTime = getattr(movie, 'getFrameTime', lambda: None)()
+            movieTiming = (timing.replace(frameTime=frameTime) if frameTime
+                           else timing)
+            failures = len(self._readFailures(movie.getObjId()))
+            if failures:
+                self._previousFailures[movie.getObjId()] = failures
+            stepId = self._insertFunctionStep(self.alignMovieStep,
+                                              movie.getObjId(),
+                                              movie.getFileName(),
+                                              movieTiming.encode(),
+                                              self._getFrameRange(movie),
+                                              failures,
+                                              prerequisites=[])
+            alignSteps.append(stepId)
+        if self._previousFailures:
+            retried = sorted(self._previousFailures)
+            self.info('Trying again %d movies that failed: %s'
+                      % (len(retried), ', '.join(map(str, retried))))
+            self._forgetDone(retried)
+        self._insertFunctionStep(self.createOutputStep,
+                                 prerequisites=alignSteps)
+
+    def alignMovieStep(self, movieId, movieFn, timingRecord=None,
+                       frameRange=None, failures=0):
+        """ Align one movie, timingRecord is its encoded ScanTiming. Errors
+        are logged and recorded in a failure file instead of being raised,
+        so the rest of the movies go on and the failed ones are reported in
+        the output. failures is the number of previous failed attempts,
+        only used to run the step again on continue. """
+        failedFn = self._getFailedFile(movieId)
+        outputMic = self._getOutputMicName(movieId)
+        if self._isValidMic(outputMic):
+            pwutils.cleanPath(failedFn)
+            self.info('Movie %d already aligned, skipping it.' % movieId)
+            return
+
+        previousErrors = self._readFailures(movieId)
+        pwutils.cleanPath(failedFn)
+        movieFolder = self._getTmpPath('movie_%06d' % movieId)
+        pwutils.makePath(movieFolder)
+
+        first, last = frameRange or (self.alignFrame0.get(),
+                                     self.alignFrameN.get())
+        try:
+            if first <= 0:
+                raise ValueError('no frames in the time range')
+            if self.alignEngine == ENGINE_CPU:
+                self._alignMovieCpu(movieId, movieFn, movieFolder,
+                                    ScanTiming.decode(timingRecord),
+                                    first, last)
+            else:
+                self._alignMovieMotionCor(movieId, movieFn, movieFolder,
+                                          first, last)
+        except Exception as e:
+            self.error('Movie %d (%s) failed: %s' % (movieId, movieFn, e))
+            # One line per failed attempt
+            errors = previousErrors + [str(e).replace('\n', ' ')]
+            with open(failedFn, 'w') as f:
+                f.writelines('%s\n' % error for error in errors)
+        finally:
+            pwutils.cleanPath(movieFolder)
+
+    def _alignMovieMotionCor(self, movieId, movieFn, movieFolder, first=1,
+                             last=0):
+        from afm.convert import getMrcFile, readHeader
 
-        micSet = self._createSetOfMicrographs()
         inputMovies = self.inputMovies.get()
-        for movie in inputMovies.iterItems():
 
-            outputMic = self._getExtraPath('mic_aligned_%06d.mrc' % movie.getObjId())
+        # Native AFM formats are converted to MRC only here, since
+        # MotionCor can not read them
+        movieFn = getMrcFile(movieFn, movieFolder)
+        if movieFn.endswith('.mrc'):
+            args = ' -InMrc %s ' % movieFn
+        else:
+            args = ' -InTiff %s ' % movieFn
+        # Outputs are written in the tmp folder and moved when complete,
+        # so an interrupted job never leaves a partial micrograph behind
+        tmpMic = os.path.join(movieFolder, 'mic_aligned.mrc')
+        args += ' -Throw %i ' % (first - 1)
+        args += ' -Trunc  %i ' % (max(0, readHeader(movieFn).nFrames - last)
+                                  if last > 0 else 0)
+        args += ' -Patch %i %i' % (self.patchX.get(), self.patchY.get())
+        args += ' -MaskCent %i %i' % (0, 0)
+        args += ' -MaskSize %i %i' % (1, 1)
+        args += ' -FtBin %f'  % self.binFactor.get()
+        args += ' -Tol %f ' % self.tolerance.get()
+        args += ' -PixSize %f' % inputMovies.getSamplingRate()
+        args += ' -kV %f' % 0
+        args += ' -Cs %f' % 0
+        args += ' -OutStack %i' % (1 if self.doSaveMovie else 0)
+        args += ' -Gpu %i' % 0
+        args += ' -SumRange %f %f ' % (0.0, 0.0)
+        args += ' -LogDir %s ' % movieFolder
+        args += ' -OutMrc %s ' % tmpMic
+
+        from afm import Plugin
+        self.runJob(Plugin.getMotionCorProgram(), args)
+
+        tmpMovie = os.path.join(movieFolder, 'mic_aligned_Stk.mrc')
+        if self.doSaveMovie and os.path.exists(tmpMovie):
+            os.replace(tmpMovie, self._getOutputMovieName(movieId))
+        os.replace(tmpMic, self._getOutputMicName(movieId))
+
+    def _alignMovieCpu(self, movieId, movieFn, movieFolder, timing,
+                       first=1, last=0):
+        """ Align the frames of a movie in-process, see
+        afm.processing.DriftAligner. The aligned average (and movie) are
+        written with the same names as MotionCor3 outputs. """
+        import mrcfile
+        import numpy as np
+        from afm.convert.frames import FrameStack
+        from afm.processing import DriftAligner
+        from afm.processing.alignment import getBinnedShape
+
+        patches = (self.patchY.get(), self.patchX.get())
+        # Movies already run in parallel, one FFT thread per movie
+        aligner = DriftAligner(binFactor=self.binFactor.get(),
+                               tolerance=self.tolerance.get(),
+                               patches=patches if min(patches) > 0 else None,
+                               numberOfThreads=1)
+        tmpMic = os.path.join(movieFolder, 'mic_aligned.mrc')
+        tmpMovie = os.path.join(movieFolder, 'mic_aligned_Stk.mrc')
+
+        with FrameStack(movieFn) as stack:
+            frames = stack.range(first, last)
+            if self.doScanCorrection and timing.frameTime:
+                frames = self._correctScanDistortion(frames, movieFolder,
+                                                     timing)
+            outputMovie = None
+            if self.doSaveMovie:
+                n, y, x = frames.shape
+                my, mx = getBinnedShape((y, x), aligner.binFactor)
+                movieMrc = mrcfile.new_mmap(tmpMovie, shape=(n, my, mx),
+                                            mrc_mode=2, overwrite=True)
+                outputMovie = movieMrc.data
+            try:
+                result = aligner.align(frames, outputMovie)
+            finally:
+                frames.close()
+                if outputMovie is not None:
+                    movieMrc.close()
+
+        with mrcfile.new(tmpMic, overwrite=True) as mrc:
+            mrc.set_data(result.average)
+
+        shifts = {'shifts': result.shifts}
+        if result.localShifts is not None:
+            shifts.update(localShifts=result.localShifts,
+                          patchCenters=result.patchCenters)
+        np.savez(self._getShiftsFile(movieId), **shifts)
+
+        if self.doSaveMovie:
+            os.replace(tmpMovie, self._getOutputMovieName(movieId))
+        os.replace(tmpMic, self._getOutputMicName(movieId))
+
+    def _correctScanDistortion(self, frames, movieFolder, timing):
+        """ Correct the line distortions of the frames from the drift
+        measured by a rigid pre-alignment, see
+        afm.processing.ScanDistortionCorrector. The corrected frames are
+        written to a temporary mapped file. """
+        import mrcfile
+        from afm.convert.frames import FrameStack
+        from afm.processing import DriftAligner, ScanDistortionCorrector
+
+        rigid = DriftAligner(binFactor=self.binFactor.get(),
+                             tolerance=self.tolerance.get(), patches=None)
+        shifts = rigid.align(frames).shifts
+        corrector = ScanDistortionCorrector(timing).fitDrift(shifts)
+
+        correctedFn = os.path.join(movieFolder, 'scan_corrected.mrc')
+        with mrcfile.new_mmap(correctedFn, shape=frames.shape, mrc_mode=2,
+                              overwrite=True) as mrc:
+            corrector.correct(frames, mrc.data)
+        return FrameStack(correctedFn)
 
-            micSet.append(Micrograph(outputMic))
-        #micSet.copyInfo(self._getInputMicrographs())
-
-        micSet.setSamplingRate(self.inputMovies.get().getSamplingRate())
-        self._defineOutputs(micSet=micSet)
-        self._defineSourceRelation(self.inputMovies, micSet)
+    def createOutputStep(self):
+        # All the movies are done, publish the last ones and close the set
+        self._checkNewOutput(final=True)
+
+    def _stepsCheck(self):
+        self._checkNewOutput()
+
+    def _checkNewOutput(self, final=False):
+        """ Publish the micrographs of the movies finished since the last
+        check in the output set, which is kept open until all the movies
+        are done so the next protocols can start with the first ones.
+        Commits are grouped to at most one per commit interval. """
+        with self._lock:
+            doneIds = self._readDoneList()
+            newDone = [(movieId, micName)
+                       for movieId, micName in self._getMovieList()
+                       if movieId not in doneIds and self._isFinished(movieId)]
+
+            lastCommit = getattr(self, '_lastCommit', 0)
+            if not final and (not newDone or time.time() - lastCommit
+                              < self.commitInterval.get()):
+                return
+
+            firstTime = not hasattr(self, OUTPUT_NAME)
+            micSet = self._loadOutputSet()
+            # Movies that failed before are published again when retried
+            newIds = {movieId for movieId, _ in newDone}
+            failed = [movieId for movieId in micSet.getFailedMovies()
+                      if movieId not in newIds]
+            newFailed = []
+
+            for movieId, micName in newDone:
+                outputMic = self._getOutputMicName(movieId)
+                header = self._readMicHeader(outputMic)
+                if header is None:
+                    newFailed.append(movieId)
+                    continue
+                mic = AFMMicrograph(outputMic)
+                mic.setObjId(movieId)
+                mic.setMovieId(movieId)
+                mic.setMicName(micName)
+                mic.setSamplingRate(micSet.getSamplingRate())
+                mic.setDimensions(*header[:2])
+                self._setShiftStats(mic)
+                micSet.append(mic)
+
+            # Failed movies are kept in the output so they are not lost silently
+            failed += newFailed
+            if newFailed:
+                self.warning('%d movies failed: %s'
+                             % (len(failed), ', '.join(map(str, failed))))
+            micSet.setFailedMovies(failed)
+
+            streamMode = micSet.STREAM_CLOSED if final else micSet.STREAM_OPEN
+            self._updateOutputSet(OUTPUT_NAME, micSet, streamMode)
+            if firstTime:
+                self._defineSourceRelation(self.inputMovies, micSet)
+            self._writeDoneList([movieId for movieId, _ in newDone])
+            self._lastCommit = time.time()
+
+    def _loadOutputSet(self):
+        """ Open the output set if it exists or create a new one. """
+        setFile = self._getPath('micrographs.sqlite')
+
+        if os.path.exists(setFile) and os.path.getsize(setFile) > 0:
+            micSet = SetOfAFMMicrographs(filename=setFile)
+            micSet.loadAllProperties()
+            micSet.enableAppend()
+        else:
+            micSet = SetOfAFMMicrographs(filename=setFile)
+            micSet.setStreamState(micSet.STREAM_OPEN)
+            micSet.setSamplingRate(self.inputMovies.get().getSamplingRate() *
+                                   self.binFactor.get())
+        return micSet
+
+    def _setShiftStats(self, mic):
+        """ Shift statistics from the shifts saved by the CPU engine. """
+        shiftsFile = self._getShiftsFile(mic.getMovieId())
+        if not os.path.exists(shiftsFile):
+            return
+        shifts = np.load(shiftsFile)['shifts']
+        if len(shifts) > 1:
+            steps = np.linalg.norm(np.diff(shifts, axis=0), axis=1)
+            mic.setShiftStats(float(steps.mean()), float(steps.max()),
+                              float(np.linalg.norm(shifts[-1] - shifts[0])))
 
     '''
     def _insertFinalSteps(self, a= None):
@@ -189,14 +458,142 @@ class ProtMotionCorAFMmovies(EMProtocol):
 
     '''
 
+    # --------------------------- UTILS functions -----------------------------------
+    def _getOutputMicName(self, movieId):
+        return self._getExtraPath('mic_aligned_%06d.mrc' % movieId)
+
+    def _getOutputMovieName(self, movieId):
+        return self._getExtraPath('mic_aligned_%06d_Stk.mrc' % movieId)
+
+    def _writeMovieList(self):
+        """ Save the ids and names of the input movies, so the output
+        can be updated while the steps run without reading the input set
+        from another thread. """
+        with open(self._getExtraPath('movies.txt'), 'w') as f:
+            for movie in self.inputMovies.get().iterItems():
+                micName = movie.getMicName() or pwutils.removeBaseExt(movie.getFileName())
+                f.write('%d %s\n' % (movie.getObjId(), micName))
+
+    def _getMovieList(self):
+        if not hasattr(self, '_movieList'):
+            with open(self._getExtraPath('movies.txt')) as f:
+                rows = (line.rstrip('\n').split(' ', 1) for line in f)
+                self._movieList = [(int(movieId), micName)
+                                   for movieId, micName in rows]
+        return self._movieList
+
+    def _getDoneFile(self):
+        return self._getExtraPath('DONE_all.TXT')
+
+    def _readDoneList(self):
+        """ Ids of the movies already published in the output. """
+        doneFile = self._getDoneFile()
+        if not os.path.exists(doneFile):
+            return set()
+        with open(doneFile) as f:
+            return {int(line) for line in f if line.strip()}
+
+    def _writeDoneList(self, movieIds):
+        with open(self._getDoneFile(), 'a') as f:
+            for movieId in movieIds:
+                f.write('%d\n' % movieId)
+
+    def _isFinished(self, movieId):
+        """ True if the movie is aligned or its last attempt failed. The
+        failures of a movie being tried again only count once it fails
+        again. """
+        if self._isValidMic(self._getOutputMicName(movieId)):
+            return True
+        previous = getattr(self, '_previousFailures', {}).get(movieId, 0)
+        return len(self._readFailures(movieId)) > previous
+
+    def _forgetDone(self, movieIds):
+        """ Remove movies from the list of published ones, so their
+        result is published again. """
+        movieIds = set(movieIds)
+        doneIds = self._readDoneList() - movieIds
+        with open(self._getDoneFile(), 'w') as f:
+            for movieId in sorted(doneIds):
+                f.write('%d\n' % movieId)
+
+    def _getScanTiming(self):
+        """ Scan timing of the input movies, empty if they have no AFM
+        acquisition. """
+        inputMovies = self.inputMovies.get()
+        if not hasattr(inputMovies, 'getAFMAcquisition'):
+            return ScanTiming()
+        return inputMovies.getAFMAcquisition().getTiming()
+
+    def _getFailedFile(self, movieId):
+        return self._getExtraPath('movie_%06d.failed' % movieId)
+
+    def _readFailures(self, movieId):
+        """ Errors of the failed attempts to align a movie, one per line of
+        its failure file. """
+        failedFn = self._getFailedFile(movieId)
+        if not os.path.exists(failedFn):
+            return []
+        with open(failedFn) as f:
+            return [line.rstrip('\n') for line in f if line.strip()]
+
+    def _readMicHeader(self, fileName):
+        """ Header values of a micrograph, or None if it is not valid:
+        its header can not be read or the file does not hold all the data
+        the header declares. """
+        from afm.convert.headers import readMrcHeader, MRC_HEADER_SIZE
+
+        if not os.path.exists(fileName):
+            return None
+        try:
+            header = readMrcHeader(fileName)
+        except (OSError, ValueError, struct.error):
+            return None
+        nx, ny, nz, dataType = header[:4]
+        expected = MRC_HEADER_SIZE + nx * ny * nz * np.dtype(dataType).itemsize
+        return header if os.path.getsize(fileName) >= expected else None
+
+    def _isValidMic(self, fileName):
+        return self._readMicHeader(fileName) is not None
+
+    def _getFrameRange(self, movie):
+        """ (first, last) 1-based frames to align, from the frame or the
+        time range params. (0, 0) if no frame is in the time range. """
+        if not self.useTimeRange:
+            return self.alignFrame0.get(), self.alignFrameN.get()
+        tEnd = self.alignTimeN.get()
+        return movie.getFrameRange(self.alignTime0.get(),
+                                   tEnd if tEnd >= 0 else None) or (0, 0)
+
+    def _getShiftsFile(self, movieId):
+        """ Global and local shifts (in input pixels) of the CPU engine. """
+        return self._getExtraPath('shifts_%06d.npz' % movieId)
+
     # --------------------------- INFO functions -----------------------------------
     def _validate(self):
         errors = []
+        if self.alignEngine == ENGINE_MOTIONCOR:
+            from afm import Plugin
+            program = Plugin.getMotionCorProgram()
+            if not shutil.which(program):
+                errors.append('MotionCor3 was not found at %s, set its path '
+                              'in the MOTIONCOR3_BIN variable of the config '
+                              'or the environment.' % program)
+        if self.useTimeRange:
+            movie = self.inputMovies.get().getFirstItem()
+            if not hasattr(movie, 'getFrameTimestamps') or \
+                    movie.getFrameTimestamps() is None:
+                errors.append('The input movies have no frame times, they '
+                              'can not be selected by time.')
         return errors
 
     def _summary(self):
         """ Summarize what the protocol has done"""
         summary = []
+        micSet = getattr(self, OUTPUT_NAME, None)
+        failed = micSet.getFailedMovies() if micSet is not None else None
+        if failed:
+            summary.append('%d movies failed to align: %s'
+                           % (len(failed), ', '.join(map(str, failed))))
         return summary
 
     def _methods(self):
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+import os
+
+import numpy as np
+
+import pyworkflow.utils as pwutils
+from pyworkflow.constants import BETA
+from pyworkflow.object import Float
+from pyworkflow.protocol.constants import LEVEL_ADVANCED, STEPS_SERIAL
+import pyworkflow.protocol.params as params
+from pwem.protocols import ProtParticlePickingAuto
+from pwem.objects import Coordinate
+
+# Picked coordinates of a micrograph, in pixels of the downsampled
+# micrograph, with their NCC and the rotation of the best template
+COORDS_DTYPE = np.dtype([('x', np.int64), ('y', np.int64),
+                         ('score', np.float32), ('angle', np.float32)])
+
+SCORE_BY_NCC = '_nccScore'
+
+
+class ProtTemplatePickingAFM(ProtParticlePickingAuto):
+    """ Automatic picking by normalized cross-correlation of the
+    micrographs with rotated copies of a set of templates (e.g. 2D class
+    averages). It does not need a previous training and the correlation is
+    normalized locally, so it works on the height maps without any
+    contrast assumption. """
+    _label = 'template picking'
+    _devStatus = BETA
+    # The micrographs of a step are picked in a pool of numberOfThreads
+    # processes, steps running in parallel would multiply the processes
+    stepsExecutionMode = STEPS_SERIAL
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        ProtParticlePickingAuto._defineParams(self, form)
+        form.addParam('inputTemplates', params.PointerParam,
+                      pointerClass='SetOfAverages, SetOfParticles',
+                      label='Templates', important=True,
+                      help='Images of the particles to look for, usually 2D '
+                           'class averages. They are rescaled to the '
+                           'sampling of the (downsampled) micrographs.')
+
+        form.addParam('downFactor', params.FloatParam, default=2.0,
+                      label='Downsampling factor',
+                      help='The micrographs are downsampled by this factor '
+                           'before the picking, which is faster and less '
+                           'sensitive to noise. The downsampled micrographs '
+                           'are kept in the plugin cache, so they are reused '
+                           'by other picking and extraction runs.')
+
+        form.addParam('angularStep', params.FloatParam, default=10.0,
+                      label='Angular step (deg)',
+                      help='Degrees between the in-plane rotations of the '
+                           'templates. Use 0 to not rotate them.')
+
+        form.addParam('threshold', params.FloatParam, default=0.3,
+                      label='Correlation threshold',
+                      help='Minimum normalized cross-correlation (between -1 '
+                           'and 1) of a picked particle.')
+
+        form.addParam('minDistance', params.IntParam, default=-1,
+                      label='Minimum distance (px)',
+                      help='Minimum distance between picked particles, in '
+                           'pixels of the input micrographs. Use -1 for the '
+                           'radius of the templates.')
+
+        form.addParam('maxParticles', params.IntParam, default=-1,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Maximum particles per micrograph',
+                      help='Keep at most this number of particles, the best '
+                           'scored ones, per micrograph. Use -1 to keep all.')
+
+        self._defineStreamingParams(form)
+        # Micrographs of a step are picked in parallel with the threads
+        form.getParam('streamingBatchSize').setDefault(0)
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertInitialSteps(self):
+        return [self._insertFunctionStep(self.prepareTemplatesStep,
+                                         prerequisites=[])]
+
+    # --------------------------- STEPS functions -----------------------------
+    def prepareTemplatesStep(self):
+        """ Rescale the templates to the sampling of the downsampled
+        micrographs and save the bank of rotated templates. """
+        from scipy import ndimage
+        from afm.convert.frames import FrameStack
+        from afm.processing import makeTemplateBank
+
+        templates = []
+        for item in self.inputTemplates.get():
+            index, fileName = item.getLocation()
+            with FrameStack(fileName) as frames:
+                templates.append(np.array(frames[max(index, 1) - 1],
+                                          dtype=np.float32))
+
+        scale = self.inputTemplates.get().getSamplingRate() / self._getPickingSampling()
+        if abs(scale - 1) > 0.0001:
+            templates = [ndimage.zoom(t, scale, order=1) for t in templates]
+
+        bank, angles = makeTemplateBank(np.stack(templates),
+                                        self.angularStep.get())
+        np.savez(self._getBankFile(), bank=bank, angles=angles)
+        self.info("Template bank of %d images of %d px"
+                  % (len(bank), bank.shape[-1]))
+
+    def _pickMicrographList(self, micList, *args):
+        """ Pick a batch of micrographs in a pool of processes, see
+        afm.processing.TemplateMatcher. One .npy file with the coordinates
+        is written per micrograph. """
+        matcher = self._getMatcher()
+        angles = np.load(self._getBankFile())['angles']
+
+        for i, positions, scores, best in matcher.pickMany(
+                [mic.getFileName() for mic in micList],
+                self.numberOfThreads.get()):
+            coords = np.empty(len(positions), dtype=COORDS_DTYPE)
+            coords['x'], coords['y'] = positions[:, 0], positions[:, 1]
+            coords['score'] = scores
+            coords['angle'] = angles[best]
+            np.save(self._getMicCoordsFile(micList[i]), coords)
+            self.info("Picked %d particles from %s"
+                      % (len(coords), micList[i].getMicName()))
+
+    def _pickMicrograph(self, mic, *args):
+        self._pickMicrographList([mic], *args)
+
+    def readCoordsFromMics(self, outputDir, micDoneList, outputCoords):
+        """ Append the picked coordinates of the micrographs, scaled to
+        the pixels of the input micrographs, in bulk. """
+        from afm.objects import bulkAppend
+
+        downFactor = self.downFactor.get()
+        if outputCoords.getBoxSize() is None:
+            outputCoords.setBoxSize(int(round(self._getTemplateSize() * downFactor)))
+
+        def _iterCoords():
+            coord = Coordinate()
+            score = Float()
+            setattr(coord, SCORE_BY_NCC, score)
+            for mic in micDoneList:
+                fileName = self._getMicCoordsFile(mic)
+                if not os.path.exists(fileName):
+                    continue
+                coord.setMicrograph(mic)
+                for x, y, s, _ in np.load(fileName).tolist():
+                    coord.setObjId(None)
+                    coord.setPosition(int(round(x * downFactor)),
+                                      int(round(y * downFactor)))
+                    score.set(s)
+                    yield coord
+
+        bulkAppend(outputCoords, _iterCoords())
+
+    # --------------------------- UTILS functions -----------------------------
+    def _getMatcher(self):
+        from afm import Plugin
+        from afm.processing import TemplateMatcher
+
+        bank = np.load(self._getBankFile())['bank']
+        downFactor = self.downFactor.get()
+        minDistance = (self.minDistance.get() / downFactor
+                       if self.minDistance.get() > 0 else None)
+        maxPeaks = self.maxParticles.get() if self.maxParticles.get() > 0 else None
+        cache = Plugin.getDownsampleCache() if abs(downFactor - 1) > 0.0001 else None
+        return TemplateMatcher(bank, threshold=self.threshold.get(),
+                               minDistance=minDistance, maxPeaks=maxPeaks,
+                               downFactor=downFactor, cache=cache)
+
+    def _getPickingSampling(self):
+        return self.getInputMicrographs().getSamplingRate() * self.downFactor.get()
+
+    def _getTemplateSize(self):
+        """ Box size of the templates in the downsampled micrographs. """
+        with np.load(self._getBankFile()) as data:
+            return data['bank'].shape[-1]
+
+    def _getBankFile(self):
+        return self._getExtraPath('template_bank.npz')
+
+    def _getMicCoordsFile(self, mic):
+        micBase = pwutils.removeBaseExt(mic.getFileName())
+        return self._getExtraPath(micBase + '_coords.npy')
+
+    def getCoordsDir(self):
+        return self._getExtraPath()
+
+    # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = []
+        if self.downFactor.get() < 1:
+            errors.append('The downsampling factor can not be smaller than 1.')
+        if not -1 <= self.threshold.get() <= 1:
+            errors.append('The correlation threshold must be between -1 and 1.')
+        return errors
+
+    def _summary(self):
+        summary = ProtParticlePickingAuto._summary(self)
+        if os.path.exists(self._getBankFile()):
+            summary.append("Templates: %d (with rotations), %d px after "
+                           "downsampling by %0.2f"
+                           % (len(np.load(self._getBankFile())['angles']),
+                              self._getTemplateSize(), self.downFactor.get()))
+        return summary
+
+    def _methods(self):
+        methods = []
+        return methods
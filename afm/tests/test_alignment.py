@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import time
+import unittest
+
+import numpy as np
+from scipy import ndimage
+from pyworkflow.tests import SMALL, WEEKLY
+
+from afm.convert import FrameStack
+from afm.processing import DriftAligner
+
+
+def makeMovie(n, size, seed=0, noise=0.05):
+    """ Frames of a smooth random surface drifting as a random walk.
+
+    Returns:
+        The (n, size, size) float32 frames and the (n, 2) shifts (y, x)
+        relative to the first frame.
+    """
+    rng = np.random.default_rng(seed)
+    surface = np.fft.fft2(ndimage.gaussian_filter(rng.normal(0, 1, (size, size)), 3))
+    shifts = np.cumsum(rng.normal(0, 0.7, (n, 2)), axis=0)
+    shifts -= shifts[0]
+    frames = np.stack([np.fft.ifft2(ndimage.fourier_shift(surface, s)).real
+                       for s in shifts])
+    frames += rng.normal(0, noise, frames.shape)
+    return frames.astype(np.float32), shifts
+
+
+class TestDriftAligner(unittest.TestCase):
+    _labels = [SMALL]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.frames, cls.shifts = makeMovie(12, 64)
+
+    def testRigid(self):
+        aligner = DriftAligner(patches=None, blockSize=5)
+        output = np.zeros_like(self.frames)
+        result = aligner.align(FrameStack(frames=self.frames), output)
+        np.testing.assert_allclose(result.shifts, self.shifts, atol=0.2)
+        self.assertIsNone(result.localShifts)
+
+    def testOutputMovie(self):
+        """ Without noise, the aligned frames are all like the first one
+        (the frames are aligned with their mean removed). """
+        frames, _ = makeMovie(12, 64, noise=0)
+        frames -= frames.mean(axis=(1, 2), keepdims=True)
+        output = np.zeros_like(frames)
+        DriftAligner(patches=None).align(FrameStack(frames=frames), output)
+        inner = (slice(None), slice(8, -8), slice(8, -8))
+        error = np.abs(output[inner] - frames[0][inner[1:]]).mean()
+        drift = np.abs(frames[inner] - frames[0][inner[1:]]).mean()
+        self.assertLess(error, drift / 10)
+
+    def testBinned(self):
+        result = DriftAligner(binFactor=2, patches=None).align(
+            FrameStack(frames=self.frames))
+        self.assertEqual(result.average.shape, (32, 32))
+        np.testing.assert_allclose(result.shifts, self.shifts, atol=0.4)
+
+    def testPatches(self):
+        result = DriftAligner(patches=(3, 3)).align(
+            FrameStack(frames=self.frames))
+        np.testing.assert_allclose(result.shifts, self.shifts, atol=0.2)
+        self.assertEqual(result.localShifts.shape, (12, 9, 2))
+        self.assertEqual(result.patchCenters.shape, (9, 2))
+        # A rigid drift leaves nothing for the local alignment
+        self.assertLess(np.abs(result.localShifts).max(), 0.5)
+
+
+class TestDriftAlignerBenchmark(unittest.TestCase):
+    """ Throughput of the alignment of a 64 frames 256 x 256 movie, in
+    frames per second, rigid and with the default 5 x 5 patches. """
+    _labels = [WEEKLY]
+
+    def testBenchmark(self):
+        frames, shifts = makeMovie(64, 256)
+        stack = FrameStack(frames=frames)
+
+        for patches in (None, (5, 5)):
+            start = time.perf_counter()
+            result = DriftAligner(patches=patches).align(stack)
+            fps = len(frames) / (time.perf_counter() - start)
+            print("%d x %d frames, patches %s: %.1f frames/s"
+                  % (256, 256, patches, fps))
+            np.testing.assert_allclose(result.shifts, shifts, atol=0.2)
+            self.assertGreater(fps, 2)
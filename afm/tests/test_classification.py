@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from scipy import ndimage
+from pyworkflow.tests import SMALL
+
+from afm.processing import CL2D, Aligner2D, transformImages
+
+BOX_SIZE = 48
+
+
+def makeShapes():
+    """ Smooth particles that no rotation makes alike: a bar, a pacman and
+    an off-center pair of blobs, the last only used as an unseen class. """
+    y, x = np.mgrid[:BOX_SIZE, :BOX_SIZE] - BOX_SIZE // 2
+    shapes = [(np.abs(x) < 12) & (np.abs(y) < 4),
+              (x ** 2 + y ** 2 < 100) & ~((x > 0) & (y > 0)),
+              ((x - 6) ** 2 + y ** 2 < 30) | ((x + 6) ** 2 + (y - 6) ** 2 < 20)]
+    return [ndimage.gaussian_filter(s.astype(np.float32), 1) for s in shapes]
+
+
+def makeParticles(n, classes, seed=0, noise=0.3):
+    """ Randomly rotated and shifted noisy copies of the shapes.
+
+    Returns:
+        (labels, particles), the particles prepared by Aligner2D.
+    """
+    rng = np.random.default_rng(seed)
+    shapes = makeShapes()
+    labels = rng.choice(classes, n)
+    particles = transformImages(np.stack([shapes[k] for k in labels]),
+                                rng.uniform(0, 360, n),
+                                rng.uniform(-3, 3, (n, 2)))
+    particles += rng.normal(0, noise, particles.shape).astype(np.float32)
+    return labels, Aligner2D(BOX_SIZE).prepare(particles)
+
+
+def classMapping(labels, assignments):
+    """ Class of each label, the one most of its particles went to. """
+    return {k: np.bincount(assignments[labels == k]).argmax()
+            for k in np.unique(labels)}
+
+
+class TestCL2D(unittest.TestCase):
+    _labels = [SMALL]
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.labels, particles = makeParticles(240, [0, 1])
+        self.stackFn = os.path.join(self.tmpDir, 'particles.npy')
+        np.save(self.stackFn, particles)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _run(self, **kwargs):
+        return CL2D(2, numberOfInitialClasses=2, numberOfIterations=3,
+                    batchSize=120, **kwargs).run(self.stackFn)
+
+    def testSeparation(self):
+        """ Two rotated and shifted classes are separated perfectly. """
+        result = self._run()
+        mapping = classMapping(self.labels, result.assignments)
+        self.assertEqual(sorted(mapping.values()), [0, 1])
+        np.testing.assert_array_equal(
+            result.assignments, [mapping[k] for k in self.labels])
+        self.assertEqual(sorted(result.counts.tolist()),
+                         sorted(np.bincount(self.labels).tolist()))
+        self.assertEqual(result.references.shape, (2, BOX_SIZE, BOX_SIZE))
+        self.assertGreater(result.scores.mean(), 0.5)
+
+    def testWorkers(self):
+        """ The pool of processes gives the same result as the serial run. """
+        serial = self._run()
+        parallel = self._run(numberOfWorkers=2)
+        np.testing.assert_array_equal(serial.assignments, parallel.assignments)
+        np.testing.assert_allclose(serial.references, parallel.references,
+                                   atol=1e-5)
+
+    def testSplit(self):
+        """ Classes grow from the initial ones by splitting. """
+        result = CL2D(4, numberOfInitialClasses=2, numberOfIterations=2,
+                      batchSize=120).run(self.stackFn)
+        self.assertEqual(len(result.references), 4)
+        self.assertEqual(result.counts.sum(), len(self.labels))
+
+    def testAlign(self):
+        """ The angle and shift found for each particle bring it back onto
+        its class reference. """
+        shapes = makeShapes()
+        truth = np.stack(shapes[:1] * 5 + shapes[1:2] * 5)
+        rng = np.random.default_rng(1)
+        particles = transformImages(truth, rng.uniform(0, 360, 10),
+                                    rng.uniform(-2, 2, (10, 2)))
+        aligner = Aligner2D(BOX_SIZE)
+        assignments, angles, shifts, scores, aligned = aligner.align(
+            aligner.prepare(particles), aligner.prepare(np.stack(shapes[:2])))
+        self.assertEqual(assignments.tolist(), [0] * 5 + [1] * 5)
+        self.assertTrue(np.all(scores > 0.95), scores)
+        restored = transformImages(particles, angles, shifts)
+        for image, expected in zip(restored, truth):
+            self.assertGreater(np.corrcoef(image.ravel(), expected.ravel())[0, 1],
+                               0.95)
+
+    def testFewParticles(self):
+        """ A first streaming batch may have less particles than classes,
+        but not none. """
+        stackFn = os.path.join(self.tmpDir, 'few.npy')
+        np.save(stackFn, makeParticles(1, [0])[1])
+        result = CL2D(2, numberOfIterations=1).run(stackFn)
+        self.assertEqual(result.counts.sum(), 1)
+
+        np.save(stackFn, np.zeros((0, BOX_SIZE, BOX_SIZE), dtype=np.float32))
+        with self.assertRaises(ValueError):
+            CL2D(2).run(stackFn)
+
+
+class TestCL2DUpdate(unittest.TestCase):
+    _labels = [SMALL]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp()
+        labels, particles = makeParticles(240, [0, 1])
+        stackFn = os.path.join(cls.tmpDir, 'particles.npy')
+        np.save(stackFn, particles)
+        cls.previous = CL2D(2, numberOfInitialClasses=2, numberOfIterations=3,
+                            batchSize=120).run(stackFn)
+        cls.mapping = classMapping(labels, cls.previous.assignments)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpDir)
+
+    def _update(self, classes, seed, **kwargs):
+        labels, particles = makeParticles(60, classes, seed=seed)
+        stackFn = os.path.join(self.tmpDir, 'new_%d.npy' % seed)
+        np.save(stackFn, particles)
+        cl2d = CL2D(2, numberOfIterations=2, batchSize=60)
+        self.messages = []
+        cl2d.log = self.messages.append
+        result, drift = cl2d.update(stackFn, self.previous, **kwargs)
+        return labels, result, drift
+
+    def testSameClasses(self):
+        """ New particles of known shapes go to their classes, on top of
+        the statistics of the classified ones. """
+        labels, result, drift = self._update([0, 1], seed=1, maxDrift=0.05)
+        np.testing.assert_array_equal(
+            result.assignments, [self.mapping[k] for k in labels])
+        np.testing.assert_array_equal(
+            result.counts,
+            self.previous.counts + np.bincount(result.assignments, minlength=2))
+        self.assertLess(abs(drift), 0.05)
+        self.assertEqual(len(self.messages), 2)
+        for new, old in zip(result.references, self.previous.references):
+            self.assertGreater(np.corrcoef(new.ravel(), old.ravel())[0, 1], 0.95)
+
+    def testDrift(self):
+        """ An unseen shape lowers the scores, the update reports the drift
+        and stops after the first pass. """
+        labels, result, drift = self._update([2], seed=2, maxDrift=0.05)
+        self.assertGreater(drift, 0.05)
+        self.assertEqual(len(self.messages), 1)
+        self.assertEqual(result.counts.sum(), self.previous.counts.sum() + 60)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from pwem.objects import SetOfCoordinates, Coordinate
+from pyworkflow.tests import SMALL
+
+from afm.convert import (readPosFile, readCoordinates, splitByMicrograph,
+                         scaleCoordinates, dropDuplicates, lookupCoordinates,
+                         COORD_DTYPE)
+
+POS_FILE = """# XMIPP_STAR_1 *
+#
+data_header
+loop_
+ _pickingMicrographState
+Manual
+
+data_particles
+loop_
+ _xcoor
+ _ycoor
+ _enabled
+    10     20      1
+    30     40     -1
+    50.7   60      1
+
+data_particles_auto
+loop_
+ _xcoor
+ _ycoor
+ _cost
+ _enabled
+    70     80   0.9  -1
+    90    100   0.8   1
+"""
+
+
+def makeCoords(rows):
+    """ Structured array (COORD_DTYPE) from (micId, x, y, objId) rows. """
+    return np.array([tuple(r) for r in rows], dtype=COORD_DTYPE)
+
+
+class TestCoordinateArrays(unittest.TestCase):
+    _labels = [SMALL]
+
+    def testReadCoordinates(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            coordSet = SetOfCoordinates(filename=os.path.join(tmpDir,
+                                                              'coords.sqlite'))
+            rows = [(2, 10, 20), (1, 30, 40), (2, 50, 60), (3, 70, 80)]
+            for micId, x, y in rows:
+                coord = Coordinate()
+                coord.setMicId(micId)
+                coord.setPosition(x, y)
+                coordSet.append(coord)
+            coordSet.write()
+
+            coords = readCoordinates(coordSet, chunkSize=3)
+            self.assertEqual(coords.tolist(), [(1, 30, 40, 2), (2, 10, 20, 1),
+                                               (2, 50, 60, 3), (3, 70, 80, 4)])
+            self.assertEqual(readCoordinates(coordSet, micIds=[3, 1]).tolist(),
+                             [(1, 30, 40, 2), (3, 70, 80, 4)])
+            self.assertEqual(len(readCoordinates(coordSet, micIds=[])), 0)
+            coordSet.close()
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def testSplitByMicrograph(self):
+        coords = makeCoords([(1, 0, 0, 1), (1, 5, 5, 2), (4, 1, 1, 3)])
+        groups = splitByMicrograph(coords)
+        self.assertEqual(sorted(groups), [1, 4])
+        self.assertEqual(groups[1]['objId'].tolist(), [1, 2])
+        self.assertEqual(splitByMicrograph(coords[:0]), {})
+
+    def testScaleCoordinates(self):
+        coords = makeCoords([(1, 10, 21, 1), (1, 11, 20, 2)])
+        scaleCoordinates(coords, 0.5)
+        self.assertEqual(coords[['x', 'y']].tolist(), [(5, 10), (5, 10)])
+        scaleCoordinates(coords, 1.00001)
+        self.assertEqual(coords[['x', 'y']].tolist(), [(5, 10), (5, 10)])
+
+    def testDropDuplicates(self):
+        coords = makeCoords([(2, 5, 5, 7), (1, 5, 5, 3), (1, 5, 5, 1),
+                             (1, 6, 5, 2), (2, 5, 5, 4)])
+        unique, duplicates = dropDuplicates(coords)
+        self.assertEqual(duplicates, 2)
+        self.assertEqual(unique.tolist(), [(1, 5, 5, 1), (1, 6, 5, 2),
+                                           (2, 5, 5, 4)])
+        # Positions that only collide once scaled and truncated
+        coords = makeCoords([(1, 10, 20, 1), (1, 11, 21, 2)])
+        self.assertEqual(dropDuplicates(coords)[1], 0)
+        self.assertEqual(dropDuplicates(scaleCoordinates(coords, 0.5))[1], 1)
+
+    def testLookupCoordinates(self):
+        coords = makeCoords([(1, 0, 0, 9), (1, 0, 0, 2), (1, 0, 0, 5)])
+        self.assertEqual(lookupCoordinates(coords, [5, 9, 3, 2, 10]).tolist(),
+                         [2, 0, -1, 1, -1])
+        self.assertEqual(lookupCoordinates(coords[:0], [1]).tolist(), [-1])
+
+
+class TestReadPosFile(unittest.TestCase):
+    _labels = [SMALL]
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.posFn = os.path.join(self.tmpDir, 'mic.pos')
+        with open(self.posFn, 'w') as f:
+            f.write(POS_FILE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testDisabled(self):
+        """ The particles rejected in the picker are not read. """
+        np.testing.assert_array_equal(readPosFile(self.posFn),
+                                      [[10, 20], [50, 60], [90, 100]])
+        np.testing.assert_array_equal(readPosFile(self.posFn, ('particles',)),
+                                      [[10, 20], [50, 60]])
+
+    def testWithoutEnabled(self):
+        with open(self.posFn, 'w') as f:
+            f.write("data_particles\nloop_\n _xcoor\n _ycoor\n 1 2\n 3 4\n")
+        np.testing.assert_array_equal(readPosFile(self.posFn), [[1, 2], [3, 4]])
+        self.assertEqual(readPosFile(self.posFn, ('particles_auto',)).shape,
+                         (0, 2))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import unittest
+
+import numpy as np
+from pyworkflow.tests import SMALL
+
+from afm.constants import SCAN_DOWN, SCAN_UP
+from afm.convert import FrameStack
+from afm.objects import AFMAcquisition
+from afm.processing import ScanDistortionCorrector
+
+
+class TestScanDistortionCorrector(unittest.TestCase):
+    _labels = [SMALL]
+
+    def _getCorrector(self, scanDirection=SCAN_DOWN, lineTime=0.01,
+                      velocity=(0.5, -2.)):
+        """ Corrector of a constant drift of velocity (dy, dx) pixels/s. """
+        acquisition = AFMAcquisition(lineTime=lineTime, frameTime=1.,
+                                     scanDirection=scanDirection)
+        corrector = ScanDistortionCorrector(acquisition.getTiming())
+        return corrector.fitDrift(np.outer(np.arange(6), velocity))
+
+    def testRowShifts(self):
+        rowShifts = self._getCorrector().getRowShifts(2, 11)
+        expected = np.outer((np.arange(11) - 5) * 0.01, (0.5, -2.))
+        np.testing.assert_allclose(rowShifts, expected, atol=1e-9)
+
+    def testScanUp(self):
+        """ The rows scanned from the bottom have the opposite shifts. """
+        down = self._getCorrector(SCAN_DOWN).getRowShifts(3, 11)
+        up = self._getCorrector(SCAN_UP).getRowShifts(3, 11)
+        np.testing.assert_allclose(up, down[::-1], atol=1e-9)
+        np.testing.assert_allclose(up, -down, atol=1e-9)
+
+    def testLineTimeFromFrameTime(self):
+        """ Without the line time (or if the lines do not fit in a frame)
+        the frame time is split between the lines. """
+        for lineTime in (None, 0.5):
+            rowShifts = self._getCorrector(lineTime=lineTime).getRowShifts(1, 10)
+            np.testing.assert_allclose(np.diff(rowShifts, axis=0),
+                                       np.tile((0.05, -0.2), (9, 1)), atol=1e-9)
+
+    def testNoFrameTime(self):
+        timing = AFMAcquisition(lineTime=0.01).getTiming()
+        self.assertRaises(ValueError, ScanDistortionCorrector, timing)
+
+    def testCorrect(self):
+        frames = np.random.default_rng(0).normal(size=(6, 16, 12))
+        frames = frames.astype(np.float32)
+        output = np.zeros_like(frames)
+        corrector = self._getCorrector(velocity=(0., 0.))
+        corrector.correct(FrameStack(frames=frames), output, blockSize=4)
+        np.testing.assert_allclose(output, frames, atol=1e-6)
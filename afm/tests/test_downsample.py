@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import tempfile
+import unittest
+
+import mrcfile
+import numpy as np
+from pyworkflow.tests import SMALL
+
+from afm.processing import DownsampleCache, fourierBin
+from afm.processing.downsample import hashFile
+
+
+class TestDownsampleCache(unittest.TestCase):
+    _labels = [SMALL]
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.tmpDir, 'cache')
+        self.indexDir = os.path.join(self.cacheDir, 'index')
+        rng = np.random.default_rng(0)
+        self.images = [rng.normal(0, 1, (64, 64)).astype(np.float32)
+                       for _ in range(4)]
+        self.micFns = [self._writeMic('mic_%d.mrc' % i, image)
+                       for i, image in enumerate(self.images)]
+        self.micBytes = os.path.getsize(self.micFns[0])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _writeMic(self, name, image):
+        fn = os.path.join(self.tmpDir, name)
+        with mrcfile.new(fn, overwrite=True) as mrc:
+            mrc.set_data(image)
+        return fn
+
+    def _cached(self):
+        return sorted(fn for fn in os.listdir(self.cacheDir)
+                      if fn.endswith('.mrc') and not fn.startswith('.'))
+
+    def testKeys(self):
+        cache = DownsampleCache(self.cacheDir, 1e9)
+        key = cache.getKey(self.micFns[0])
+        self.assertEqual(key, hashFile(self.micFns[0]))
+        # Same content in another file, same key
+        copyFn = os.path.join(self.tmpDir, 'copy.mrc')
+        shutil.copy(self.micFns[0], copyFn)
+        self.assertEqual(cache.getKey(copyFn), key)
+        self.assertNotEqual(cache.getKey(self.micFns[1]), key)
+        self.assertEqual(cache.getPath(copyFn, 2),
+                         cache.getPath(self.micFns[0], 2.0))
+        self.assertNotEqual(cache.getPath(copyFn, 2),
+                            cache.getPath(copyFn, 3))
+        # Changed files are hashed again, with a single entry per path
+        self._writeMic('copy.mrc', self.images[1])
+        self.assertEqual(cache.getKey(copyFn), cache.getKey(self.micFns[1]))
+        self.assertEqual(len(os.listdir(self.indexDir)), 3)
+
+    def testGet(self):
+        cache = DownsampleCache(self.cacheDir, 1e9)
+        cachedFn = cache.get(self.micFns[0], 2)
+        np.testing.assert_allclose(cache.load(self.micFns[0], 2),
+                                   fourierBin(self.images[0], 2), atol=1e-5)
+        mtime = os.path.getmtime(cachedFn)
+        self.assertEqual(cache.get(self.micFns[0], 2), cachedFn)
+        self.assertGreaterEqual(os.path.getmtime(cachedFn), mtime)
+        # Only complete files, no temporary ones left
+        self.assertEqual(sorted(os.listdir(self.cacheDir)),
+                         sorted(['index', os.path.basename(cachedFn)]))
+
+    def testAtomicWrite(self):
+        cache = DownsampleCache(self.cacheDir, 1e9)
+        targetFn = os.path.join(self.cacheDir, 'target.mrc')
+
+        def _fail(fn):
+            with open(fn, 'w') as f:
+                f.write('partial')
+            raise IOError('disk full')
+
+        self.assertRaises(IOError, cache._writeAtomic, targetFn, _fail)
+        self.assertEqual(os.listdir(self.cacheDir), ['index'])
+
+    def testEvict(self):
+        """ The least recently used micrographs are removed with their
+        index entries, and the index counts in the budget. """
+        cache = DownsampleCache(self.cacheDir, 2.5 * self.micBytes / 4)
+        cachedFns = []
+        for i, micFn in enumerate(self.micFns[:3]):
+            cachedFns.append(cache.get(micFn, 2))
+            os.utime(cachedFns[-1], (i, i))
+        self.assertEqual(self._cached(), sorted(os.path.basename(fn)
+                                                for fn in cachedFns[1:]))
+        self.assertEqual(len(os.listdir(self.indexDir)), 2)
+
+        cache.get(self.micFns[0], 2)  # used again
+        self.assertEqual(self._cached(), sorted(os.path.basename(fn)
+                                                for fn in (cachedFns[0],
+                                                           cachedFns[2])))
+        self.assertEqual(sorted(cache.getKey(fn) for fn in
+                                (self.micFns[0], self.micFns[2])),
+                         sorted(open(os.path.join(self.indexDir, fn)).read().split()[1]
+                                for fn in os.listdir(self.indexDir)))
+
+        # The new micrograph is kept even if it does not fit
+        cache.maxBytes = 1
+        keptFn = cache.get(self.micFns[3], 2)
+        self.assertEqual(self._cached(), [os.path.basename(keptFn)])
+        self.assertEqual(len(os.listdir(self.indexDir)), 1)
+
+    def testTemporaryFiles(self):
+        """ Files being written by another process are not evicted. """
+        cache = DownsampleCache(self.cacheDir, 1)
+        tmpFn = os.path.join(self.cacheDir, '.tmp1234.mrc')
+        with open(tmpFn, 'wb') as f:
+            f.write(b'x' * 1000)
+        cache.get(self.micFns[0], 2)
+        cache.get(self.micFns[1], 2)
+        self.assertTrue(os.path.exists(tmpFn))
+        self.assertEqual(len(self._cached()), 1)
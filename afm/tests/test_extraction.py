@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import mrcfile
+import numpy as np
+from pyworkflow.tests import SMALL, WEEKLY
+
+from afm.processing import ParticleExtractor, StackNormalizer, extractBoxes
+from afm.processing.normalization import NEW_XMIPP, RAMP
+
+
+def writeMicrographs(folder, n, size, seed=0):
+    """ Random float32 micrographs written as .mrc files. """
+    rng = np.random.default_rng(seed)
+    fileNames = []
+    for i in range(n):
+        fn = os.path.join(folder, 'mic_%02d.mrc' % i)
+        with mrcfile.new(fn) as mrc:
+            mrc.set_data(rng.normal(0, 1, (size, size)).astype(np.float32))
+        fileNames.append(fn)
+    return fileNames
+
+
+def extractBox(image, x, y, boxSize):
+    """ Reference box cut pixel by pixel, out of the image pixels take the
+    value of the closest pixel of the image. """
+    ny, nx = image.shape
+    box = np.empty((boxSize, boxSize), dtype=np.float32)
+    for i in range(boxSize):
+        for j in range(boxSize):
+            row = min(max(y - boxSize // 2 + i, 0), ny - 1)
+            col = min(max(x - boxSize // 2 + j, 0), nx - 1)
+            box[i, j] = image[row, col]
+    return box
+
+
+class TestExtraction(unittest.TestCase):
+    _labels = [SMALL]
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        # Every pixel tells its position, 40 rows and 50 columns
+        self.image = np.add.outer(1000. * np.arange(40),
+                                  np.arange(50)).astype(np.float32)
+        self.micFn = os.path.join(self.tmpDir, 'mic.mrc')
+        with mrcfile.new(self.micFn) as mrc:
+            mrc.set_data(self.image)
+        # Inside, touching the borders, partly outside and far outside
+        self.positions = np.array([[25, 20], [4, 4], [45, 35], [2, 20],
+                                   [25, 38], [-30, 100]])
+        self.inside = np.array([True, True, True, False, False, False])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _reference(self, positions, boxSize):
+        return np.array([extractBox(self.image, x, y, boxSize)
+                         for x, y in positions])
+
+    def testValidMask(self):
+        for boxSize in (8, 9):
+            stack, valid = extractBoxes(self.image, self.positions, boxSize)
+            np.testing.assert_array_equal(valid, self.inside)
+            np.testing.assert_array_equal(
+                stack, self._reference(self.positions[self.inside], boxSize))
+            self.assertEqual(stack.dtype, np.float32)
+
+    def testBorders(self):
+        for boxSize in (8, 9):
+            stack, valid = extractBoxes(self.image, self.positions, boxSize,
+                                        doBorders=True)
+            self.assertTrue(valid.all())
+            np.testing.assert_array_equal(
+                stack, self._reference(self.positions, boxSize))
+        # Only boxes out of the image
+        stack, valid = extractBoxes(self.image, self.positions[3:], 8,
+                                    doBorders=True)
+        np.testing.assert_array_equal(stack,
+                                      self._reference(self.positions[3:], 8))
+
+    def testEmpty(self):
+        stack, valid = extractBoxes(self.image, np.empty((0, 2)), 8)
+        self.assertEqual((stack.shape, valid.shape), ((0, 8, 8), (0,)))
+        stack, valid = extractBoxes(self.image, [[0, 0]], 8)
+        self.assertEqual((stack.shape, valid.tolist()), ((0, 8, 8), [False]))
+
+    def testExtract(self):
+        extractor = ParticleExtractor(8, doBorders=True, doInvert=True)
+        stack, valid, scores = extractor.extract(self.micFn, self.positions)
+        self.assertTrue(valid.all())
+        self.assertIsNone(scores)
+        np.testing.assert_array_equal(stack, -self._reference(self.positions, 8))
+
+        extractor = ParticleExtractor(8, doInvert=True, patchSize=16,
+                                      normalizeArgs=(RAMP, 3))
+        stack, valid, scores = extractor.extract(self.micFn, self.positions)
+        np.testing.assert_array_equal(valid, self.inside)
+        expected = -self._reference(self.positions[self.inside], 8)
+        np.testing.assert_allclose(stack, StackNormalizer(8, RAMP, 3)(expected),
+                                   atol=1e-4)
+        self.assertEqual(scores.shape, (3, 2))
+
+    def testDust(self):
+        image = np.random.default_rng(0).normal(0, 1, (40, 50))
+        image[20, 25] = 100.
+        with mrcfile.new(self.micFn, overwrite=True) as mrc:
+            mrc.set_data(image.astype(np.float32))
+        extractor = ParticleExtractor(8, dustThreshold=3.5)
+        stack, valid, _ = extractor.extract(self.micFn, [[25, 20], [10, 10]])
+        # Only the dust pixel is replaced, by a value drawn from the box
+        # statistics (its std is about 12 with the dust in it)
+        patch = image[16:24, 21:29].astype(np.float32)
+        changed = np.argwhere(stack[0] != patch)
+        np.testing.assert_array_equal(changed, [[4, 4]])
+        self.assertLess(abs(stack[0, 4, 4]), 60.)
+        np.testing.assert_array_equal(stack[1], image[6:14, 6:14].astype(np.float32))
+
+
+class TestExtractMany(unittest.TestCase):
+    _labels = [SMALL]
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        rng = np.random.default_rng(1)
+        self.jobs = [(fn, rng.integers(-8, 72, (n, 2)))
+                     for fn, n in zip(writeMicrographs(self.tmpDir, 4, 64),
+                                      (30, 0, 12, 25))]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testSameAsSerial(self):
+        """ The pool writes the stacks in a buffer file in tmpDir, which is
+        removed at the end. """
+        extractor = ParticleExtractor(16, doInvert=True)
+        serial = {i: (stack.copy(), valid) for i, stack, valid, _ in
+                  extractor.extractMany(self.jobs)}
+        bufferDir = os.path.join(self.tmpDir, 'tmp')
+        os.makedirs(bufferDir)
+        results = extractor.extractMany(self.jobs, 2, tmpDir=bufferDir)
+        seen = set()
+        for i, stack, valid, scores in results:
+            self.assertEqual(len(glob.glob(os.path.join(bufferDir, '*.npy'))), 1)
+            np.testing.assert_array_equal(stack, serial[i][0])
+            np.testing.assert_array_equal(valid, serial[i][1])
+            self.assertIsNone(scores)
+            seen.add(i)
+        self.assertEqual(seen, {0, 1, 2, 3})
+        self.assertEqual(os.listdir(bufferDir), [])
+
+
+# One program per micrograph and stage, exchanging temporary files, as the
+# xmipp_micrograph_scissor, xmipp_transform_filter and
+# xmipp_transform_normalize pipeline did
+PIPELINE_STAGES = {
+    'scissor': """
+import sys, mrcfile, numpy as np
+micFn, posFn, outFn, box = sys.argv[1:5]
+box = int(box)
+with mrcfile.mmap(micFn, mode='r') as mrc:
+    image = mrc.data
+    boxes = [np.array(image[y - box // 2:y - box // 2 + box,
+                            x - box // 2:x - box // 2 + box])
+             for x, y in np.load(posFn)]
+np.save(outFn, np.array(boxes, dtype=np.float32))
+""",
+    'filter': """
+import sys, numpy as np
+inFn, outFn, threshold = sys.argv[1:4]
+stack = np.load(inFn)
+for img in stack:
+    mean, std = img.mean(), img.std()
+    dust = np.abs(img - mean) > float(threshold) * std
+    img[dust] = np.random.normal(mean, std, dust.sum())
+    img *= -1
+np.save(outFn, stack)
+""",
+    'normalize': """
+import sys, mrcfile, numpy as np
+inFn, outFn = sys.argv[1:3]
+stack = np.load(inFn)
+box = stack.shape[-1]
+y, x = np.mgrid[0:box, 0:box] - box // 2
+mask = x ** 2 + y ** 2 > (box // 2) ** 2
+for img in stack:
+    background = img[mask]
+    img -= background.mean()
+    img /= background.std()
+with mrcfile.new(outFn, overwrite=True) as mrc:
+    mrc.set_data(stack)
+""",
+}
+
+
+class TestExtractionBenchmark(unittest.TestCase):
+    """ Extraction of 100k particles of 64 px from 50 micrographs of
+    1024 x 1024 with dust removal, invert and normalization, writing one
+    .mrcs per micrograph, compared with a pipeline of one program per
+    micrograph and stage exchanging temporary files. """
+    _labels = [WEEKLY]
+    NUMBER_OF_MICS = 50
+    PARTICLES_PER_MIC = 2000
+    BOX_SIZE = 64
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        cls.jobs = []
+        for fn in writeMicrographs(cls.tmpDir, cls.NUMBER_OF_MICS, 1024):
+            positions = rng.integers(cls.BOX_SIZE, 1024 - cls.BOX_SIZE,
+                                     (cls.PARTICLES_PER_MIC, 2))
+            cls.jobs.append((fn, positions))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpDir)
+
+    def _runPipeline(self, fileName, positions, outFn):
+        base = os.path.splitext(outFn)[0]
+        np.save(base + '_pos.npy', positions)
+        commands = [
+            ('scissor', fileName, base + '_pos.npy', base + '_cut.npy',
+             str(self.BOX_SIZE)),
+            ('filter', base + '_cut.npy', base + '_filtered.npy', '3.5'),
+            ('normalize', base + '_filtered.npy', outFn)]
+        for stage, *args in commands:
+            subprocess.run([sys.executable, '-c', PIPELINE_STAGES[stage]] + args,
+                           check=True)
+
+    def testBenchmark(self):
+        outDir = os.path.join(self.tmpDir, 'out')
+        os.makedirs(outDir)
+        extractor = ParticleExtractor(self.BOX_SIZE, dustThreshold=3.5,
+                                      doInvert=True,
+                                      normalizeArgs=(NEW_XMIPP, -1))
+        start = time.perf_counter()
+        n = 0
+        for i, stack, valid, scores in extractor.extractMany(self.jobs):
+            with mrcfile.new(os.path.join(outDir, 'mic_%02d.mrcs' % i)) as mrc:
+                mrc.set_data(stack)
+            n += len(stack)
+        inProcess = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i, (fileName, positions) in enumerate(self.jobs):
+            self._runPipeline(fileName, positions,
+                              os.path.join(outDir, 'pipe_%02d.mrcs' % i))
+        pipeline = time.perf_counter() - start
+
+        print("%d particles of %d px: in-process %.1f s (%.0f particles/s), "
+              "pipeline %.1f s (%.0f particles/s), %.1fx"
+              % (n, self.BOX_SIZE, inProcess, n / inProcess, pipeline,
+                 n / pipeline, pipeline / inProcess))
+        self.assertEqual(n, self.NUMBER_OF_MICS * self.PARTICLES_PER_MIC)
+        self.assertLess(inProcess, pipeline)
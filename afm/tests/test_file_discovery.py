@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import glob
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pyworkflow.tests import SMALL, WEEKLY
+
+from afm.utils import iterFiles, FileManifest, splitPattern
+
+
+def _touch(path, content=b''):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+class TestIterFiles(unittest.TestCase):
+    _labels = [SMALL]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for day in ('day1', 'day2', os.path.join('day2', 'late')):
+            for i in range(3):
+                _touch(os.path.join(self.root, day, 'movie_%d.asd' % i), b'x' * i)
+            _touch(os.path.join(self.root, day, 'notes.txt'))
+        _touch(os.path.join(self.root, 'day1', '.hidden.asd'))
+        _touch(os.path.join(self.root, '.trash', 'movie_9.asd'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _paths(self, pattern, **kwargs):
+        return [e.path for e in iterFiles(pattern, **kwargs)]
+
+    def testSplitPattern(self):
+        self.assertEqual(splitPattern('/data/day*/*.asd'),
+                         ('/data', ('day*', '*.asd')))
+        self.assertEqual(splitPattern('movie.asd'), ('.', ('movie.asd',)))
+
+    def testSameAsGlob(self):
+        for parts in (('*', '*.asd'), ('**', '*.asd'), ('day2', '**', 'movie_[01].asd'),
+                      ('day1', 'movie_1.asd'), ('**', '.*.asd')):
+            pattern = os.path.join(self.root, *parts)
+            self.assertEqual(self._paths(pattern, numberOfThreads=2),
+                             sorted(glob.glob(pattern, recursive=True)), pattern)
+
+    def testEntries(self):
+        entries = list(iterFiles(os.path.join(self.root, 'day1', '*.asd')))
+        self.assertEqual([(os.path.basename(e.path), e.size) for e in entries],
+                         [('movie_0.asd', 0), ('movie_1.asd', 1), ('movie_2.asd', 2)])
+        fn = entries[0].path
+        self.assertEqual(entries[0].mtime, os.stat(fn).st_mtime)
+
+    def testExclude(self):
+        pattern = os.path.join(self.root, '**', '*.asd')
+        allPaths = self._paths(pattern)
+        self.assertEqual(self._paths(pattern, exclude=set(allPaths[1:])),
+                         allPaths[:1])
+        self.assertEqual(self._paths(allPaths[0], exclude={allPaths[0]}), [])
+
+    def testManifest(self):
+        pattern = os.path.join(self.root, '**', '*.asd')
+        manifestFn = os.path.join(self.root, 'manifest.json')
+        manifest = FileManifest(manifestFn)
+        self.assertEqual(len(list(manifest.iterChanged(iterFiles(pattern)))), 9)
+        manifest.save()
+
+        manifest = FileManifest(manifestFn)
+        self.assertEqual(len(manifest), 9)
+        self.assertEqual(list(manifest.iterChanged(iterFiles(pattern))), [])
+
+        changedFn = os.path.join(self.root, 'day1', 'movie_0.asd')
+        _touch(changedFn, b'more data')
+        newFn = os.path.join(self.root, 'day3', 'movie_0.asd')
+        _touch(newFn)
+        self.assertEqual([e.path for e in manifest.iterChanged(iterFiles(pattern))],
+                         [changedFn, newFn])
+        self.assertEqual(self._paths(pattern, exclude=manifest), [])
+
+        # A discarded file (e.g. an unreadable movie) is found again
+        manifest.discard(newFn)
+        self.assertEqual(self._paths(pattern, exclude=manifest), [newFn])
+        self.assertNotIn(newFn, list(manifest))
+
+
+class TestIterFilesBenchmark(unittest.TestCase):
+    """ Re-scan of a synthetic session of 100k movies in 100 per-day
+    folders after a new day of movies arrived, as the streaming import
+    does on every poll. The baseline is a recursive glob followed by a stat
+    of every file, compared with the known ones; iterFiles with the
+    manifest as exclude list does not stat the known files. """
+    _labels = [WEEKLY]
+    NUMBER_OF_FOLDERS = 100
+    FILES_PER_FOLDER = 1000
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        for day in range(cls.NUMBER_OF_FOLDERS):
+            cls._addFolder(day)
+        cls.pattern = os.path.join(cls.root, '**', '*.asd')
+
+    @classmethod
+    def _addFolder(cls, day):
+        folder = os.path.join(cls.root, 'day%03d' % day, 'movies')
+        os.makedirs(folder)
+        for i in range(cls.FILES_PER_FOLDER):
+            open(os.path.join(folder, 'movie_%04d.asd' % i), 'w').close()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def _time(self, func):
+        start = time.perf_counter()
+        result = func()
+        return result, time.perf_counter() - start
+
+    def _globChanged(self, known):
+        """ Files that are new or changed, found with glob and os.stat. """
+        changed = []
+        for fn in sorted(glob.glob(self.pattern, recursive=True)):
+            st = os.stat(fn)
+            if known.get(fn) != (st.st_size, st.st_mtime):
+                changed.append(fn)
+        return changed
+
+    def testBenchmark(self):
+        nFiles = self.NUMBER_OF_FOLDERS * self.FILES_PER_FOLDER
+
+        entries, scanTime = self._time(lambda: list(iterFiles(self.pattern)))
+        self.assertEqual(len(entries), nFiles)
+        manifest = FileManifest()
+        for entry in entries:
+            manifest.add(entry)
+        known = {e.path: (e.size, e.mtime) for e in entries}
+
+        # A new day of movies arrives
+        self._addFolder(self.NUMBER_OF_FOLDERS)
+        globbed, globTime = self._time(lambda: self._globChanged(known))
+        new, newTime = self._time(
+            lambda: list(iterFiles(self.pattern, exclude=manifest)))
+        self.assertEqual(len(globbed), self.FILES_PER_FOLDER)
+        self.assertEqual([e.path for e in new], globbed)
+
+        print("%d files, %d new: glob + stat %.2f s, iterFiles excluding "
+              "the manifest %.2f s (%.1fx), first scan %.2f s"
+              % (nFiles, len(new), globTime, newTime, globTime / newTime,
+                 scanTime))
+        # Skipping the known files must save most of the stat calls
+        self.assertLess(2 * newTime, globTime)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Regression budget of the time taken to import the plugin and its
+protocols, which Scipion does at startup and for protocol discovery even
+when no AFM protocol is used. Modules are imported in a fresh interpreter
+with python -X importtime, after the modules of pyworkflow, pwem and the
+plugins the AFM protocols derive from, which are loaded anyway (stubbed
+if they are not installed). The median of several runs is compared with
+the budget.
+"""
+import ast
+import glob
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from pyworkflow.tests import SMALL
+
+import afm
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(afm.__file__)))
+AFM_DIR = os.path.join(PACKAGE_DIR, 'afm')
+
+# Loaded before measuring, they are not part of the budget
+PRELOADED = ['pyworkflow.protocol', 'pwem', 'pwem.objects', 'pwem.protocols']
+XMIPP_PRELOADED = ['xmipp3.protocols.protocol_particle_pick',
+                   'xmipp3.protocols.protocol_particle_pick_automatic']
+
+# Modules that must only be imported when a protocol runs
+HEAVY_MODULES = ('afm.convert', 'afm.processing', 'mrcfile', 'scipy',
+                 'tifffile', 'skimage', 'sklearn', 'tomo', 'motioncorr',
+                 'xmipp3.protocols.protocol_flexalign',
+                 'concurrent.futures.process')
+
+# Medians of the import time, about half of them here (pwem preloaded,
+# xmipp3 stubbed). afm.protocols took 36-42 ms before the heavy imports
+# were deferred
+PLUGIN_BUDGET_MS = 10
+PROTOCOLS_BUDGET_MS = 20
+
+# Runs of each measure, the median is compared with the budget
+NUMBER_OF_RUNS = 3
+
+# Stand-ins of the xmipp3 protocols the AFM pickers derive from, when
+# xmipp3 is not installed, so the import of afm.protocols can be measured
+XMIPP_STUBS = """
+import types
+import pwem.protocols
+for name, className, base in [
+        ('xmipp3.protocols.protocol_particle_pick', 'XmippProtParticlePicking',
+         pwem.protocols.ProtParticlePicking),
+        ('xmipp3.protocols.protocol_particle_pick_automatic',
+         'XmippParticlePickingAutomatic', pwem.protocols.ProtParticlePickingAuto)]:
+    for parent in ('xmipp3', 'xmipp3.protocols'):
+        sys.modules.setdefault(parent, types.ModuleType(parent))
+    module = sys.modules[name] = types.ModuleType(name)
+    setattr(module, className, type(className, (base,), {}))
+"""
+
+# __import__ and not importlib.import_module, which -X importtime does
+# not report
+SCRIPT = """
+import json, sys
+%(stubs)s
+for name in %(preloaded)r:
+    __import__(name)
+before = set(sys.modules)
+for name in %(modules)r:
+    __import__(name)
+print(json.dumps(sorted(set(sys.modules) - before)))
+"""
+
+
+def isHeavy(moduleName):
+    return any(moduleName == m or moduleName.startswith(m + '.')
+               for m in HEAVY_MODULES)
+
+
+def measureImport(modules, preloaded=PRELOADED, stubs=''):
+    """ Import modules in a new interpreter with -X importtime, after
+    running the stubs code.
+
+    Returns:
+        A tuple ({module: cumulative import time in ms}, newModules), with
+        the names of all the modules loaded by the import.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [PACKAGE_DIR] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         SCRIPT % {'preloaded': preloaded, 'modules': modules,
+                   'stubs': stubs}],
+        cwd=PACKAGE_DIR, env=env, capture_output=True, text=True)
+    if process.returncode:
+        raise RuntimeError(process.stderr[-2000:])
+
+    times = {}
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative) / 1000.
+    newModules = json.loads(process.stdout.strip().splitlines()[-1])
+    return times, newModules
+
+
+def measureMedianImport(modules, preloaded=PRELOADED, stubs='',
+                        runs=NUMBER_OF_RUNS):
+    """ Median over several runs of measureImport, so a single slow run
+    on a loaded machine does not fail the budget.
+
+    Returns:
+        A tuple ({module: median import time in ms}, newModules), with the
+        modules loaded by the first run.
+    """
+    results = [measureImport(modules, preloaded, stubs) for _ in range(runs)]
+    times = {module: sorted(r[0][module] for r in results)[runs // 2]
+             for module in modules}
+    return times, results[0][1]
+
+
+def getTopLevelImports(fileName):
+    """ Names of the modules imported at the top level of a module (not
+    inside functions or classes), relative imports made absolute. """
+    folder = os.path.relpath(os.path.dirname(fileName), AFM_DIR)
+    package = 'afm' if folder == '.' else 'afm.' + folder.replace(os.sep, '.')
+    with open(fileName) as f:
+        tree = ast.parse(f.read())
+
+    names = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ''
+            if node.level:
+                parts = package.split('.')
+                prefix = '.'.join(parts[:len(parts) - node.level + 1])
+                base = prefix + ('.' + base if base else '')
+            names.append(base)
+    return names
+
+
+class TestImportTime(unittest.TestCase):
+    _labels = [SMALL]
+
+    def _checkImport(self, modules, preloaded, budget, stubs=''):
+        times, newModules = measureMedianImport(modules, preloaded, stubs)
+        heavy = [m for m in newModules if isHeavy(m)]
+        self.assertEqual(heavy, [], "Heavy modules imported by %s" % modules)
+        for module in modules:
+            self.assertLess(times[module], budget,
+                            "Import of %s takes %.1f ms (median of %d runs), "
+                            "over its budget of %d ms"
+                            % (module, times[module], NUMBER_OF_RUNS, budget))
+
+    def testPlugin(self):
+        self._checkImport(['afm', 'afm.objects', 'afm.utils'], PRELOADED,
+                          PLUGIN_BUDGET_MS)
+
+    def testProtocols(self):
+        # The AFM pickers derive from xmipp3 protocols, stubbed if missing
+        stubs = XMIPP_STUBS if importlib.util.find_spec('xmipp3') is None else ''
+        self._checkImport(['afm.protocols'], PRELOADED + XMIPP_PRELOADED,
+                          PROTOCOLS_BUDGET_MS, stubs)
+
+    def testTopLevelImports(self):
+        """ The modules loaded at discovery do not import heavy modules at
+        their top level, even those that can not be imported here. """
+        fileNames = [os.path.join(AFM_DIR, name) for name in
+                     ('__init__.py', 'constants.py', 'objects.py', 'utils.py')]
+        fileNames += glob.glob(os.path.join(AFM_DIR, 'protocols', '*.py'))
+        for fileName in fileNames:
+            heavy = [m for m in getTopLevelImports(fileName) if isHeavy(m)]
+            self.assertEqual(heavy, [], fileName)
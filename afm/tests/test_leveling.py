@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import tempfile
+import unittest
+
+import mrcfile
+import numpy as np
+from pyworkflow.tests import SMALL
+
+from afm.processing import StackLeveler
+from afm.processing.leveling import LINE_MEDIAN, LINE_POLYNOMIAL
+
+NOISE = 0.05
+
+
+def makeStack(n, shape=(64, 96), seed=0):
+    """ Height maps with a flat, noisy background under a tilt, a bow and
+    an offset per scan line, and a few particles 3 nm high.
+
+    Returns:
+        (stack, surfaces, background): the distorted stack, the surfaces
+        without distortion and the mask of their background pixels.
+    """
+    rng = np.random.default_rng(seed)
+    ny, nx = shape
+    y, x = np.mgrid[:ny, :nx].astype(np.float32)
+    surfaces = rng.normal(0, NOISE, (n, ny, nx)).astype(np.float32)
+    for surface in surfaces:
+        for cy, cx in rng.uniform([8, 8], [ny - 8, nx - 8], (4, 2)):
+            surface += 3 * np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / 8.)
+    background = surfaces < 4 * NOISE
+
+    slopes = rng.uniform(-0.2, 0.2, (n, 2, 1, 1))
+    bows = rng.uniform(-5e-3, 5e-3, (n, 1, 1))
+    lines = rng.normal(0, 1, (n, ny, 1))
+    stack = (surfaces + 10 + slopes[:, 0] * x + slopes[:, 1] * y
+             + bows * (x - nx / 2) ** 2 + lines)
+    return stack.astype(np.float32), surfaces, background
+
+
+class TestStackLeveler(unittest.TestCase):
+    _labels = [SMALL]
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _checkLeveled(self, leveled, surfaces, background, maxStd=1.5 * NOISE):
+        for image, surface, mask in zip(leveled, surfaces, background):
+            error = image - surface
+            self.assertLess(np.std(image[mask]), maxStd)
+            # The particles keep their height over the background
+            self.assertLess(np.abs(error - np.median(error)).max(), 0.3)
+
+    def testLevel(self):
+        """ Tilt, bow and line offsets are removed down to the noise. """
+        stack, surfaces, background = makeStack(4)
+        for lineMethod in (LINE_MEDIAN, LINE_POLYNOMIAL):
+            leveler = StackLeveler(planeOrder=2, lineMethod=lineMethod,
+                                   lineOrder=0)
+            leveled, masks = leveler.level(stack)
+            self.assertEqual(leveled.dtype, np.float32)
+            self._checkLeveled(leveled, surfaces, background)
+            # The particles are left out of the last fit
+            self.assertFalse(np.any(masks & (surfaces > 1)))
+
+            image, mask = leveler.level(stack[0])
+            np.testing.assert_allclose(image, leveled[0], atol=1e-4)
+
+    def testNoMask(self):
+        """ Without excluding the particles, they bias the line offsets. """
+        stack, surfaces, background = makeStack(2)
+        masked, _ = StackLeveler(planeOrder=2).level(stack)
+        leveled, masks = StackLeveler(planeOrder=2, iterations=1).level(stack)
+        self.assertIsNone(masks)
+        self.assertGreater(np.std(leveled[background]),
+                           np.std(masked[background]))
+
+    def _writeMrc(self, name, data):
+        fileName = os.path.join(self.tmpDir, name)
+        with mrcfile.new(fileName, overwrite=True) as mrc:
+            mrc.set_data(data)
+        return fileName
+
+    def testLevelFiles(self):
+        """ Files are leveled in chunks, in the pool or serially, as the
+        whole stack at once. An empty file is yielded without output. """
+        stacks = [makeStack(n, seed=n)[0] for n in (5, 1, 3)]
+        stacks.insert(1, np.zeros((0, 64, 96), dtype=np.float32))
+        leveler = StackLeveler(planeOrder=2, chunkSize=2)
+
+        for workers in (1, 2):
+            jobs = [(self._writeMrc('movie_%d.mrc' % i, stack),
+                     os.path.join(self.tmpDir, 'leveled_%d_%d.mrc' % (i, workers)))
+                    for i, stack in enumerate(stacks)]
+            indexes = list(leveler.levelFiles(jobs, workers, voxelSize=20.))
+            self.assertEqual(sorted(indexes), [0, 1, 2, 3])
+            self.assertEqual(indexes[0], 1)
+            self.assertFalse(os.path.exists(jobs[1][1]))
+
+            for (_, outputFn), stack in zip(jobs, stacks):
+                if not len(stack):
+                    continue
+                with mrcfile.open(outputFn) as mrc:
+                    data = mrc.data.reshape(stack.shape)
+                    self.assertAlmostEqual(float(mrc.voxel_size.x), 20.)
+                np.testing.assert_allclose(data, leveler.level(stack)[0],
+                                           atol=1e-4)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import time
+import unittest
+
+import numpy as np
+from pyworkflow.tests import SMALL, WEEKLY
+
+from afm.processing import StackNormalizer, removeDust, getBackgroundMask
+from afm.processing.normalization import OLD_XMIPP, NEW_XMIPP, RAMP
+
+
+def normalizeImage(image, method, mask):
+    """ Reference normalization of one image, fitting the ramp with
+    lstsq as the Xmipp programs do one image at a time. """
+    image = image.astype(np.float64)
+    if method == OLD_XMIPP:
+        return (image - image.mean()) / image.std()
+    if method == RAMP:
+        y, x = np.nonzero(mask)
+        design = np.stack([x, y, np.ones_like(x)], axis=1)
+        coefs = np.linalg.lstsq(design, image[mask], rcond=None)[0]
+        yy, xx = np.mgrid[0:image.shape[0], 0:image.shape[1]]
+        image = image - (coefs[0] * xx + coefs[1] * yy + coefs[2])
+    background = image[mask]
+    return (image - background.mean()) / background.std()
+
+
+def makeParticles(n, box, seed=0):
+    """ Gaussian blobs on tilted, noisy backgrounds. """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:box, 0:box].astype(np.float32) - box // 2
+    blob = np.exp(-(x ** 2 + y ** 2) / (2 * (box / 8.) ** 2))
+    slopes = rng.normal(0, 0.1, (n, 2, 1, 1)).astype(np.float32)
+    particles = (5 * blob + slopes[:, 0] * x + slopes[:, 1] * y
+                 + rng.normal(3, 1, (n, 1, 1)) + rng.normal(0, 0.5, (n, box, box)))
+    return particles.astype(np.float32)
+
+
+class TestNormalization(unittest.TestCase):
+    _labels = [SMALL]
+
+    def testBackgroundMask(self):
+        mask = getBackgroundMask(16, 0)
+        np.testing.assert_array_equal(mask, getBackgroundMask(16))
+        self.assertTrue(mask[0, 0])
+        self.assertFalse(mask[8, 8])
+        self.assertFalse(mask[8, 0])  # on the circle of radius 8
+        self.assertGreater(getBackgroundMask(16, 4).sum(), mask.sum())
+
+    def testSameAsPerImage(self):
+        particles = makeParticles(20, 32)
+        for method in (OLD_XMIPP, NEW_XMIPP, RAMP):
+            for backRadius in (0, 10):
+                normalizer = StackNormalizer(32, method, backRadius)
+                result = normalizer(particles.copy())
+                expected = np.stack([normalizeImage(p, method, normalizer.mask)
+                                     for p in particles])
+                np.testing.assert_allclose(result, expected, atol=2e-4,
+                                           err_msg=method)
+
+    def testRampBackground(self):
+        normalizer = StackNormalizer(32, RAMP)
+        result = normalizer(makeParticles(10, 32))
+        background = result[:, normalizer.mask]
+        np.testing.assert_allclose(background.mean(axis=1), 0, atol=1e-4)
+        np.testing.assert_allclose(background.std(axis=1), 1, atol=1e-4)
+
+    def testNoBackground(self):
+        with self.assertRaises(ValueError):
+            StackNormalizer(8, NEW_XMIPP, backRadius=20)
+        with self.assertRaises(ValueError):
+            StackNormalizer(8, 'Unknown')
+
+    def testRemoveDust(self):
+        particles = makeParticles(6, 32)
+        particles[2, 5, 7] = 1000
+        particles[4, 20, 1] = -1000
+        original = particles.copy()
+        removeDust(particles, 5, seed=0)
+        self.assertLess(np.abs(particles[2, 5, 7] - 3), 10)
+        self.assertLess(np.abs(particles[4, 20, 1] - 3), 10)
+        changed = np.argwhere(particles != original)
+        np.testing.assert_array_equal(changed, [[2, 5, 7], [4, 20, 1]])
+
+
+class TestNormalizationBenchmark(unittest.TestCase):
+    """ Dust removal and Ramp normalization of 2000 particles of 64 px,
+    batched against one image at a time. """
+    _labels = [WEEKLY]
+
+    def testBenchmark(self):
+        particles = makeParticles(2000, 64)
+        normalizer = StackNormalizer(64, RAMP)
+
+        start = time.perf_counter()
+        for particle in particles.copy():
+            particle = removeDust(particle[None], 3.5)[0]
+            normalizeImage(particle, RAMP, normalizer.mask)
+        loopTime = time.perf_counter() - start
+
+        start = time.perf_counter()
+        normalizer(removeDust(particles.copy(), 3.5))
+        batchTime = time.perf_counter() - start
+
+        print("%d particles of %d px: batched %.3f s, per image %.3f s "
+              "(%.0fx)" % (len(particles), 64, batchTime, loopTime,
+                           loopTime / batchTime))
+        self.assertLess(batchTime, loopTime)
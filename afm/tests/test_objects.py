@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import pwem.objects as emobj
+from pyworkflow.tests import SMALL, WEEKLY
+
+import afm.objects as afmobj
+from afm.objects import (SetOfAFMmovies, AFMmovie, AFMAcquisition, ScanTiming,
+                         bulkAppend)
+
+
+def _getClassesDict():
+    classesDict = dict(vars(emobj))
+    classesDict.update(vars(afmobj))
+    return classesDict
+
+
+class TestScanTiming(unittest.TestCase):
+    _labels = [SMALL]
+
+    def testHeightScale(self):
+        # .asd files store inverted heights, their scale is negative
+        timing = ScanTiming(heightScale=-0.05, heightOffset=100.)
+        self.assertEqual((timing.heightScale, timing.heightOffset), (-0.05, 100.))
+        self.assertEqual(ScanTiming(heightOffset=None).heightOffset, 0.)
+        for value in (0, 0., float('nan'), float('inf')):
+            self.assertRaises(ValueError, ScanTiming, heightScale=value)
+        self.assertRaises(ValueError, ScanTiming, heightOffset=float('nan'))
+        self.assertRaises(ValueError, ScanTiming, pixelSize=-1.)
+
+    def testEncode(self):
+        timing = ScanTiming(0.001, 0.5, 2.0, heightScale=-0.05, heightOffset=100.)
+        self.assertEqual(ScanTiming.decode(timing.encode()), timing)
+        # Records written before the height offset was stored
+        self.assertEqual(ScanTiming.decode('[0.001,0.5,2.0,"down",-0.05]'),
+                         timing.replace(heightOffset=0.))
+
+
+class TestFrameTimestamps(unittest.TestCase):
+    _labels = [SMALL]
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _movie(self, nFrames, frameTime, timestamps=None):
+        movie = AFMmovie(os.path.join(self.tmpDir, 'movie.mrc'))
+        movie.setDimensions(16, 12, nFrames)
+        movie.setFrameTime(frameTime)
+        if timestamps is not None:
+            timestampsFn = os.path.join(self.tmpDir, 'movie.npy')
+            np.save(timestampsFn, np.asarray(timestamps, dtype=np.float64))
+            movie.setTimestampsFile(timestampsFn)
+        return movie
+
+    def testEvenlySpaced(self):
+        movie = self._movie(10, 0.5)
+        np.testing.assert_allclose(movie.getFrameTimestamps(), np.arange(10) * 0.5)
+        self.assertEqual(movie.getScanTime(), 5.0)
+        self.assertEqual(movie.getFrameRange(), (1, 10))
+        self.assertEqual(movie.getFrameRange(1.0, 2.0), (3, 5))
+        self.assertEqual(movie.getFrameRange(0.9, 2.1), (3, 5))
+        self.assertEqual(movie.getFrameRange(tStart=4.5), (10, 10))
+        self.assertEqual(movie.getFrameRange(tEnd=0.2), (1, 1))
+        self.assertIsNone(movie.getFrameRange(4.6))
+        self.assertIsNone(movie.getFrameRange(1.1, 1.4))
+
+    def testDroppedFrames(self):
+        # Frames 3, 4, 6, 7 and 10 of an .asd acquisition at 0.1 s per frame
+        movie = self._movie(5, 0.1, [0, .1, .3, .4, .7])
+        np.testing.assert_allclose(movie.getFrameTimestamps(), [0, .1, .3, .4, .7])
+        self.assertAlmostEqual(movie.getScanTime(), 0.8)
+        # The time of the dropped frames selects no frame of its own
+        self.assertEqual(movie.getFrameRange(0.15, 0.35), (3, 3))
+        self.assertIsNone(movie.getFrameRange(0.5, 0.6))
+        self.assertEqual(movie.getFrameRange(0.3, 0.7), (3, 5))
+        self.assertEqual(movie.getFrameRange(tStart=0.31), (4, 5))
+
+    def testUnknownTiming(self):
+        movie = AFMmovie(os.path.join(self.tmpDir, 'movie.mrc'))
+        movie.setDimensions(16, 12, 4)
+        self.assertIsNone(movie.getFrameTimestamps())
+        self.assertIsNone(movie.getScanTime())
+        self.assertRaises(ValueError, movie.getFrameRange, 0, 1)
+
+
+class TestBulkAppend(unittest.TestCase):
+    _labels = [SMALL]
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.setFn = os.path.join(self.tmpDir, 'movies.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _createSet(self):
+        movieSet = SetOfAFMmovies(filename=self.setFn)
+        movieSet.setSamplingRate(2.5)
+        acquisition = emobj.Acquisition()
+        acquisition.setVoltage(300.)
+        movieSet.setAcquisition(acquisition)
+        movieSet.setAFMAcquisition(AFMAcquisition(frameTime=0.5))
+        return movieSet
+
+    def _openSet(self):
+        movieSet = SetOfAFMmovies(filename=self.setFn,
+                                  classesDict=_getClassesDict())
+        movieSet.loadAllProperties()
+        return movieSet
+
+    @staticmethod
+    def _fillMovie(movie, fileName):
+        movie.setDimensions(64, 32, int(fileName[-6:-4]))
+        movie.setFrameTime(0.5)
+
+    def testAppendFiles(self):
+        movieSet = self._createSet()
+        fileNames = ['movie_%02d.mrc' % i for i in range(1, 8)]
+        self.assertEqual(movieSet.appendFiles(fileNames, self._fillMovie,
+                                              batchSize=3), 7)
+        movieSet.write()
+        movieSet.close()
+
+        movieSet = self._openSet()
+        self.assertEqual(movieSet.getSize(), 7)
+        self.assertEqual(movieSet.getDim(), (64, 32, 1))
+        movies = [m.clone() for m in movieSet]
+        self.assertEqual([m.getObjId() for m in movies], list(range(1, 8)))
+        self.assertEqual([m.getFileName() for m in movies], fileNames)
+        self.assertEqual([m.getNumberOfFrames() for m in movies], list(range(1, 8)))
+        for movie in movies:
+            self.assertEqual(movie.getSamplingRate(), 2.5)
+            self.assertEqual(movie.getAcquisition().getVoltage(), 300.)
+
+        # The sampling rate must be in the rows, not only in the objects
+        conn = sqlite3.connect(self.setFn)
+        column = conn.execute("SELECT column_name FROM Classes "
+                              "WHERE label_property='_samplingRate'").fetchone()[0]
+        self.assertEqual({r[0] for r in conn.execute("SELECT %s FROM Objects"
+                                                     % column)}, {2.5})
+        conn.close()
+
+    def testSameAsAppend(self):
+        """ The rows written by bulkAppend can not be told from the rows
+        written by append, before and after reopening the set. """
+        movieSet = self._createSet()
+        movie = AFMmovie(location='movie_01.mrc')
+        self._fillMovie(movie, 'movie_01.mrc')
+        movieSet.append(movie)
+        movieSet.appendFiles(['movie_02.mrc'], self._fillMovie)
+        movieSet.write()
+        movieSet.close()
+
+        movieSet = self._openSet()
+        movieSet.enableAppend()
+        movieSet.appendFiles(['movie_03.mrc', 'movie_04.mrc'], self._fillMovie)
+        movie = AFMmovie(location='movie_05.mrc')
+        self._fillMovie(movie, 'movie_05.mrc')
+        movieSet.append(movie)
+        movieSet.write()
+        movieSet.close()
+
+        conn = sqlite3.connect(self.setFn)
+        rows = conn.execute("SELECT * FROM Objects ORDER BY id").fetchall()
+        conn.close()
+        self.assertEqual([r[0] for r in rows], [1, 2, 3, 4, 5])
+        # Every column but id and file name (and the frame count taken
+        # from it) is the same for all the movies
+        different = [i for i in range(len(rows[0]))
+                     if len({r[i] for r in rows}) > 1]
+        self.assertEqual(len(different), 3, rows)
+        self.assertEqual(self._openSet().getSize(), 5)
+
+    def testHeightOffset(self):
+        movieSet = self._createSet()
+        acquisition = movieSet.getAFMAcquisition()
+        acquisition.setHeightScale(-0.05)
+        acquisition.setHeightOffset(100.)
+        movieSet.appendFiles(['movie_01.mrc'], self._fillMovie)
+        movieSet.write()
+        movieSet.close()
+
+        acquisition = self._openSet().getAFMAcquisition()
+        self.assertEqual(acquisition.getHeightScale(), -0.05)
+        self.assertEqual(acquisition.getHeightOffset(), 100.)
+
+    def testItemIds(self):
+        movieSet = self._createSet()
+        movies = []
+        for objId in (None, 10, None):
+            movie = AFMmovie(location='movie.mrc')
+            movie.setObjId(objId)
+            movies.append(movie)
+        self.assertEqual(bulkAppend(movieSet, movies), 3)
+        self.assertEqual([m.getObjId() for m in movies], [1, 10, 11])
+        self.assertEqual(movieSet.getSize(), 3)
+
+
+class TestBulkAppendBenchmark(unittest.TestCase):
+    """ Import of 50k movies into a set: appendFiles against the previous
+    append() + update() per movie, which is timed on a subset. """
+    _labels = [WEEKLY]
+    NUMBER_OF_MOVIES = 50000
+    LOOP_MOVIES = 2000
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _createSet(self, name):
+        movieSet = SetOfAFMmovies(filename=os.path.join(self.tmpDir, name))
+        movieSet.setSamplingRate(2.5)
+        return movieSet
+
+    @staticmethod
+    def _fillMovie(movie, fileName):
+        movie.setDimensions(256, 256, 100)
+        movie.setDataType('int16')
+        movie.setFrameTime(0.1)
+
+    def testBenchmark(self):
+        fileNames = ['movie_%06d.asd' % i for i in range(self.NUMBER_OF_MOVIES)]
+
+        start = time.perf_counter()
+        movieSet = self._createSet('loop.sqlite')
+        for fileName in fileNames[:self.LOOP_MOVIES]:
+            movie = AFMmovie(location=fileName)
+            self._fillMovie(movie, fileName)
+            movieSet.append(movie)
+            movieSet.update(movie)
+        movieSet.write()
+        movieSet.close()
+        loopTime = time.perf_counter() - start
+
+        start = time.perf_counter()
+        movieSet = self._createSet('bulk.sqlite')
+        movieSet.appendFiles(fileNames, self._fillMovie)
+        movieSet.write()
+        movieSet.close()
+        bulkTime = time.perf_counter() - start
+
+        loopEstimate = loopTime * self.NUMBER_OF_MOVIES / self.LOOP_MOVIES
+        print("%d movies: appendFiles %.1f s, append + update %.1f s "
+              "(estimated from %d movies in %.1f s)"
+              % (self.NUMBER_OF_MOVIES, bulkTime, loopEstimate,
+                 self.LOOP_MOVIES, loopTime))
+
+        movieSet = SetOfAFMmovies(filename=os.path.join(self.tmpDir, 'bulk.sqlite'),
+                                  classesDict=_getClassesDict())
+        self.assertEqual(movieSet.getSize(), self.NUMBER_OF_MOVIES)
+        movieSet.close()
+        # Seconds, not minutes
+        self.assertLess(bulkTime, 30)
+        self.assertLess(bulkTime, loopEstimate)
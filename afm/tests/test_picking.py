@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mrcfile
+import numpy as np
+from scipy import ndimage
+from pyworkflow.tests import SMALL, WEEKLY
+
+from afm.processing import (TemplateMatcher, BlobDetector, makeTemplateBank,
+                            suppressNonMaxima)
+
+
+def makeTemplate(boxSize=24):
+    """ Smooth asymmetric (L-shaped) particle, so its rotations differ. """
+    template = np.zeros((boxSize, boxSize), dtype=np.float32)
+    template[6:18, 8:12] = 1
+    template[14:18, 8:17] = 1
+    return ndimage.gaussian_filter(template, 1)
+
+
+def plant(image, template, x, y):
+    """ Add a template to an image with its top left corner at (x, y). """
+    b = template.shape[0]
+    image[y:y + b, x:x + b] += template
+
+
+class TestTemplateMatcher(unittest.TestCase):
+    _labels = [SMALL]
+
+    def setUp(self):
+        self.template = makeTemplate()
+        self.bank, self.angles = makeTemplateBank(self.template, 10.)
+        rng = np.random.default_rng(0)
+        self.image = rng.normal(0, 0.05, (128, 160)).astype(np.float32)
+        plant(self.image, ndimage.rotate(
+            self.template, 40, reshape=False, order=1, mode='nearest'), 40, 60)
+        plant(self.image, self.template, 110, 20)
+
+    def testBank(self):
+        self.assertEqual(self.bank.shape, (36, 24, 24))
+        np.testing.assert_allclose(self.angles[:3], [0, 10, 20])
+        mask = self.bank[0] != 0
+        for t in self.bank:
+            self.assertAlmostEqual(float(t[mask].mean()), 0, places=5)
+            self.assertAlmostEqual(float(np.linalg.norm(t)), 1, places=5)
+        bank, angles = makeTemplateBank(np.stack([self.template] * 2), 0)
+        self.assertEqual((bank.shape, angles.tolist()), ((2, 24, 24), [0, 0]))
+
+    def testCorrelate(self):
+        """ Same NCC as computed box by box. """
+        matcher = TemplateMatcher(self.bank, batchSize=5)
+        ncc, best = matcher.correlate(self.image)
+        self.assertEqual(ncc.shape, (128 - 23, 160 - 23))
+        mask = matcher.mask
+        for y, x in [(60, 40), (20, 110), (0, 0), (104, 136), (33, 77)]:
+            box = self.image[y:y + 24, x:x + 24][mask].astype(np.float64)
+            box -= box.mean()
+            values = self.bank[:, mask] @ box / np.linalg.norm(box)
+            self.assertAlmostEqual(float(ncc[y, x]), values.max(), places=3)
+            self.assertEqual(best[y, x], values.argmax())
+
+    def testPick(self):
+        """ The planted particles are found at their position and angle. """
+        matcher = TemplateMatcher(self.bank, threshold=0.5)
+        positions, scores, templates = matcher.pickImage(self.image)
+        self.assertEqual(positions.tolist(), [[122, 32], [52, 72]])
+        self.assertTrue(np.all(scores > 0.9))
+        self.assertEqual(self.angles[templates].tolist(), [0, 40])
+        self.assertEqual(len(matcher.pickImage(self.image * 0)[0]), 0)
+
+    def testPickMany(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fileNames = []
+            for i, image in enumerate([self.image, self.image[:, ::-1]]):
+                fileNames.append(os.path.join(tmpDir, 'mic_%d.mrc' % i))
+                with mrcfile.new(fileNames[-1]) as mrc:
+                    mrc.set_data(np.ascontiguousarray(image))
+            matcher = TemplateMatcher(self.bank, threshold=0.5)
+            serial = {r[0]: r[1:] for r in matcher.pickMany(fileNames)}
+            for i, *result in matcher.pickMany(fileNames, 2):
+                for a, b in zip(result, serial[i]):
+                    np.testing.assert_array_equal(a, b)
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+class TestSuppressNonMaxima(unittest.TestCase):
+    _labels = [SMALL]
+
+    @staticmethod
+    def _greedy(positions, scores, minDistance):
+        keep = []
+        for i in np.argsort(-scores, kind='stable'):
+            if all(np.hypot(*(positions[i] - positions[j])) > minDistance
+                   for j in keep):
+                keep.append(i)
+        return keep
+
+    def testSameAsGreedy(self):
+        rng = np.random.default_rng(3)
+        positions = rng.integers(0, 100, (300, 2))
+        scores = rng.random(300)
+        for minDistance in (3, 10, 25):
+            self.assertEqual(
+                suppressNonMaxima(positions, scores, minDistance).tolist(),
+                self._greedy(positions, scores, minDistance))
+        keep = suppressNonMaxima(positions, scores, 10, maxPeaks=5)
+        self.assertEqual(keep.tolist(), self._greedy(positions, scores, 10)[:5])
+        self.assertEqual(suppressNonMaxima(positions, scores, 0, 4).tolist(),
+                         np.argsort(-scores)[:4].tolist())
+
+
+def makeBlobImage(shape=(256, 256), seed=0):
+    """ Flat-topped particles on a tilted, noisy support.
+
+    Returns:
+        The height map and a list of (mask, height) of the particles: discs
+        of radius 5 and 8 at height 2, a disc of radius 5 at height 4, a
+        small disc of radius 2 and a 40 x 3 line.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:shape[0], 0:shape[1]]
+    image = 0.01 * x + 0.02 * y + rng.normal(0, 0.05, shape)
+    particles = []
+    for cx, cy, r, h in ((40, 40, 5, 2.), (120, 40, 8, 2.), (200, 40, 5, 4.),
+                         (200, 150, 2, 2.)):
+        particles.append(((x - cx) ** 2 + (y - cy) ** 2 <= r ** 2, h))
+    particles.append(((x >= 60) & (x < 100) & (y >= 149) & (y < 152), 2.))
+    for mask, h in particles:
+        image[mask] += h
+    return image.astype(np.float32), particles
+
+
+class TestBlobDetector(unittest.TestCase):
+    _labels = [SMALL]
+
+    def setUp(self):
+        self.image, self.particles = makeBlobImage()
+        self.areas = [int(mask.sum()) for mask, _ in self.particles]
+
+    def _pick(self, **kwargs):
+        positions, blobs = BlobDetector(threshold=1., **kwargs).pickImage(self.image)
+        return sorted(zip(blobs['area'].tolist(), positions.tolist()))
+
+    def testDetect(self):
+        blobs = BlobDetector(threshold=1.).detect(self.image)
+        blobs = blobs[np.argsort(blobs['y'] * 1000 + blobs['x'])]
+        self.assertEqual(blobs['area'].tolist(), [self.areas[i]
+                                                  for i in (0, 1, 2, 4, 3)])
+        np.testing.assert_allclose(blobs['x'], [40, 120, 200, 79.5, 200], atol=1e-4)
+        np.testing.assert_allclose(blobs['y'], [40, 40, 40, 150, 150], atol=1e-4)
+        np.testing.assert_allclose(blobs['meanHeight'], [2, 2, 4, 2, 2], atol=0.1)
+        np.testing.assert_allclose(blobs['volume'], blobs['meanHeight'] *
+                                   blobs['area'], rtol=1e-5)
+        self.assertTrue(np.all(blobs['maxHeight'] >= blobs['meanHeight']))
+        self.assertTrue(np.all(blobs['eccentricity'][[0, 1, 2, 4]] < 0.2))
+        self.assertGreater(blobs['eccentricity'][3], 0.99)
+
+        # Without leveling the tilt of the support goes over the threshold
+        self.assertGreater(len(BlobDetector(threshold=1., doLevel=False,
+                                            ).detect(self.image)), 5)
+        self.assertEqual(len(BlobDetector(threshold=10.).detect(self.image)), 0)
+
+    def testFilters(self):
+        disc5, disc8, high, small, line = self.areas
+        self.assertEqual([a for a, _ in self._pick(minArea=20, maxArea=150)],
+                         sorted([disc5, high, line]))
+        self.assertEqual(self._pick(minArea=20, maxEccentricity=0.5),
+                         sorted([(disc5, [40, 40]), (high, [200, 40]),
+                                 (disc8, [120, 40])]))
+        self.assertEqual(self._pick(minHeight=3.), [(high, [200, 40])])
+        self.assertEqual(len(self._pick(maxHeight=3.)), 4)
+
+    def testAutomaticThreshold(self):
+        """ The threshold in sigmas of the background noise finds all the
+        particles and nothing else. """
+        positions, blobs = BlobDetector(sigmas=6., minArea=5).pickImage(self.image)
+        self.assertEqual(sorted(blobs['area'].tolist()), sorted(self.areas))
+
+
+class TestBlobDetectorBenchmark(unittest.TestCase):
+    """ Detection on a 2048 x 2048 height map with 2000 particles, against
+    the statistics computed component by component. The leveling, which
+    is the same for both, is timed apart. """
+    _labels = [WEEKLY]
+
+    def testBenchmark(self):
+        rng = np.random.default_rng(0)
+        image = rng.normal(0, 0.05, (2048, 2048)).astype(np.float32)
+        # A crowded micrograph, 2000 discs of radius 4 on a 45 px grid
+        centers = np.stack(np.meshgrid(np.arange(25, 2048, 45),
+                                       np.arange(25, 2048, 45)), -1).reshape(-1, 2)
+        disc = ((np.arange(9)[:, None] - 4) ** 2 +
+                (np.arange(9)[None] - 4) ** 2) <= 16
+        for cx, cy in centers[rng.permutation(len(centers))[:2000]]:
+            image[cy - 4:cy + 5, cx - 4:cx + 5] += 2. * disc
+
+        start = time.perf_counter()
+        BlobDetector(threshold=1.).detect(image)
+        levelTime = time.perf_counter() - start
+
+        start = time.perf_counter()
+        blobs = BlobDetector(threshold=1., doLevel=False).detect(image)
+        detectTime = time.perf_counter() - start
+        levelTime -= detectTime
+
+        start = time.perf_counter()
+        labels, n = ndimage.label(image > 1.)
+        loopAreas = []
+        for i, region in enumerate(ndimage.find_objects(labels), 1):
+            mask = labels[region] == i
+            rows, cols = np.nonzero(mask)
+            heights = image[region][mask]
+            loopAreas.append(mask.sum())
+            np.cov(cols, rows), heights.max(), heights.sum(), cols.mean()
+        loopTime = time.perf_counter() - start
+
+        print("2048 x 2048, %d blobs: detect %.3f s (plus %.3f s of "
+              "leveling), per component %.3f s"
+              % (len(blobs), detectTime, levelTime, loopTime))
+        self.assertEqual(sorted(blobs['area'].tolist()), sorted(loopAreas))
+        self.assertLess(detectTime, loopTime)
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Tests of the native readers on synthetic files written by the small
+encoders below, which follow the layout of each format.
+"""
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+from pyworkflow.tests import SMALL
+
+from afm.convert import (readHeader, getReader, getMrcFile, FrameStack,
+                         AsdReader, SpmReader, JpkReader)
+
+ASD_FRAME_HEADER_SIZE = 32
+
+
+def writeAsd(fileName, frames, frameNumbers=None, frameAcqTime=100.,
+             secondChannel=False, **values):
+    """ Write int16 frames as an .asd (version 1) file. Each frame header
+    starts with the frame number, the second channel (if any) is a copy
+    of the first one with the sign changed. """
+    n, yDim, xDim = frames.shape
+    fields = [name for name, _ in AsdReader.HEADER_FIELDS]
+    header = dict.fromkeys(fields, 0)
+    header.update(fileVersion=1,
+                  fileHeaderSize=struct.calcsize(AsdReader.HEADER_FORMAT),
+                  frameHeaderSize=ASD_FRAME_HEADER_SIZE, dataType1ch=0x5148,
+                  dataType2ch=0x4552 if secondChannel else 0,
+                  numberFramesRecorded=n, numberFramesCurrent=n,
+                  xPixel=xDim, yPixel=yDim, xScanRange=2 * xDim,
+                  yScanRange=2 * yDim, averaged=False, averageNumber=1,
+                  frameAcqTime=frameAcqTime, sensorSens=1., phaseSens=1.,
+                  adRange=0x00000002, adResolution=12, xPiezoConst=1.,
+                  yPiezoConst=1., zPiezoConst=20., zDriveGain=2.)
+    header.update(values)
+    frameNumbers = range(n) if frameNumbers is None else frameNumbers
+
+    with open(fileName, 'wb') as f:
+        f.write(struct.pack(AsdReader.HEADER_FORMAT, *[header[k] for k in fields]))
+        for number, frame in zip(frameNumbers, frames):
+            for channel in ([frame, -frame] if secondChannel else [frame]):
+                f.write(struct.pack('<i', number).ljust(ASD_FRAME_HEADER_SIZE, b'\0'))
+                f.write(channel.astype('<i2').tobytes())
+
+
+def writeSpm(fileName, frames, channels=('Height', 'Amplitude'),
+             hardScale=0.0003, sens=20.0, scanSize=100, scanRate=2.0,
+             headerSize=8192):
+    """ Write a Nanoscope file with one 'Ciao image list' per channel, all
+    of them with the same int16 frame of frames (one per channel). """
+    _, yDim, xDim = frames.shape
+    frameBytes = yDim * xDim * 2
+    lines = ['\\*File list', '\\Version: 0x09200000',
+             '\\*Scanner list', '\\Scan Size: %d nm' % scanSize,
+             '\\*Ciao scan list', '\\Scan Rate: %f' % scanRate,
+             '\\@Sens. Zsens: V %f nm/V' % sens]
+    for i, (channel, frame) in enumerate(zip(channels, frames)):
+        lines += ['\\*Ciao image list',
+                  '\\Data offset: %d' % (headerSize + i * frameBytes),
+                  '\\Data length: %d' % frameBytes,
+                  '\\Bytes/pixel: 2',
+                  '\\Samps/line: %d' % xDim,
+                  '\\Number of lines: %d' % yDim,
+                  '\\@2:Image Data: S [%s] "%s"' % (channel, channel),
+                  '\\@2:Z scale: V [Sens. Zsens] (%g V/LSB) 19.6 V' % hardScale]
+    lines.append('\\*File list end')
+    text = '\r\n'.join(lines).encode('latin-1')
+    assert len(text) < headerSize
+
+    with open(fileName, 'wb') as f:
+        f.write(text.ljust(headerSize, b'\x1a'))
+        for frame in frames[:len(channels)]:
+            f.write(frame.astype('<i2').tobytes())
+
+
+def writeTiff(fileName, pages):
+    """ Write a little endian classic TIFF. Each page is (data, tags),
+    data being a 2D array and tags a list of extra (tag, type, value)
+    entries, the standard image tags are added here. """
+    formats = {2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 12: ('d', 8)}
+    out = bytearray(b'II' + struct.pack('<HI', 42, 0))
+    nextOffsetPos = 4
+
+    for data, extraTags in pages:
+        dataOffset = len(out)
+        out += data.tobytes()
+        sampleFormat = {'u': 1, 'i': 2, 'f': 3}[data.dtype.kind]
+        tags = [(256, 4, data.shape[1]), (257, 4, data.shape[0]),
+                (258, 3, data.dtype.itemsize * 8), (259, 3, 1),
+                (273, 4, dataOffset), (277, 3, 1), (278, 4, data.shape[0]),
+                (279, 4, data.nbytes), (339, 3, sampleFormat)]
+        tags = sorted(tags + list(extraTags))
+
+        if len(out) % 2:
+            out += b'\0'
+        ifdOffset = len(out)
+        struct.pack_into('<I', out, nextOffsetPos, ifdOffset)
+        extraOffset = ifdOffset + 2 + 12 * len(tags) + 4
+        entries, extra = b'', b''
+        for tag, fieldType, value in tags:
+            fmt, size = formats[fieldType]
+            if fieldType == 2:
+                raw, count = value.encode('latin-1') + b'\0', len(value) + 1
+            else:
+                raw, count = struct.pack('<' + fmt, value), 1
+            if len(raw) <= 4:
+                field = raw.ljust(4, b'\0')
+            else:
+                field = struct.pack('<I', extraOffset + len(extra))
+                extra += raw
+            entries += struct.pack('<HHI', tag, fieldType, count) + field
+        out += struct.pack('<H', len(tags)) + entries
+        nextOffsetPos = len(out)
+        out += struct.pack('<I', 0) + extra
+
+    with open(fileName, 'wb') as f:
+        f.write(out)
+
+
+def writeJpk(fileName, frames, channels=('height', 'error'),
+             multiply=1e-10, offset=-2e-9, uLength=1e-7):
+    """ Write a JPK image: a thumbnail page followed by one int16 page per
+    channel, with the JPK channel and scaling tags. """
+    pages = [(np.zeros((4, 4), dtype=np.uint8), [])]
+    for channel, frame in zip(channels, frames):
+        pages.append((frame.astype('<i2'), [
+            (JpkReader.TAG_GRID_ULENGTH, 12, uLength),
+            (JpkReader.TAG_CHANNEL, 2, channel),
+            (JpkReader.TAG_SCALING_MULTIPLY, 12, multiply),
+            (JpkReader.TAG_SCALING_OFFSET, 12, offset)]))
+    writeTiff(fileName, pages)
+
+
+class TestReaders(unittest.TestCase):
+    _labels = [SMALL]
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.frames = rng.integers(-2000, 2000, (5, 12, 16)).astype(np.int16)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _path(self, name):
+        return os.path.join(self.tmpDir, name)
+
+    def testAsd(self):
+        fn = self._path('movie.asd')
+        writeAsd(fn, self.frames)
+        reader = getReader(fn)
+        self.assertIsInstance(reader, AsdReader)
+        self.assertEqual((reader.xDim, reader.yDim, reader.getNumberOfFrames()),
+                         (16, 12, 5))
+        self.assertEqual(reader.pixelSize, 2.0)
+        self.assertAlmostEqual(reader.frameTime, 0.1)
+        np.testing.assert_array_equal(reader.frames(), self.frames)
+
+        # 12 bits over [-2.5, 2.5] V, inverted, and 40 nm/V
+        step = 5.0 / 4096
+        self.assertAlmostEqual(reader.heightScale, -step * 40, places=6)
+        self.assertAlmostEqual(reader.heightOffset, 2.5 * 40, places=6)
+        np.testing.assert_allclose(reader.getFrame(2),
+                                   (2.5 - self.frames[2] * step) * 40, rtol=1e-5)
+        self.assertIsNone(reader.getFrameTimes())
+
+        header = readHeader(fn)
+        self.assertIsNone(header.error)
+        self.assertEqual((header.xDim, header.yDim, header.nFrames, header.dataType),
+                         (16, 12, 5, 'int16'))
+        self.assertAlmostEqual(header.heightScale, reader.heightScale)
+        self.assertAlmostEqual(header.heightOffset, reader.heightOffset)
+
+    def testAsdChannelsAndGaps(self):
+        fn = self._path('gaps.asd')
+        writeAsd(fn, self.frames, frameNumbers=[3, 4, 6, 7, 10], secondChannel=True)
+        reader = AsdReader(fn)
+        np.testing.assert_array_equal(reader.frames(), self.frames)
+        np.testing.assert_array_equal(reader.getFrameNumbers(), [3, 4, 6, 7, 10])
+        np.testing.assert_allclose(reader.getFrameTimes(), [0, .1, .3, .4, .7],
+                                   rtol=1e-6)
+        np.testing.assert_allclose(readHeader(fn).frameTimes, [0, .1, .3, .4, .7],
+                                   rtol=1e-6)
+
+        # Consecutive numbers are evenly spaced wherever they start, and
+        # numbers that do not increase are not trusted
+        for numbers in ([5, 6, 7, 8, 9], [3, 4, 4, 6, 7], [9, 2, 5, 6, 8]):
+            writeAsd(fn, self.frames, frameNumbers=numbers)
+            self.assertIsNone(AsdReader(fn).getFrameTimes(), numbers)
+            self.assertIsNone(readHeader(fn).frameTimes, numbers)
+
+    def testAsdTruncated(self):
+        fn = self._path('truncated.asd')
+        writeAsd(fn, self.frames)
+        with open(fn, 'r+b') as f:
+            f.truncate(os.path.getsize(fn) - 10)
+        self.assertEqual(AsdReader(fn).getNumberOfFrames(), 4)
+
+        with open(fn, 'r+b') as f:
+            f.truncate(20)
+        header = readHeader(fn)
+        self.assertIsNone(header.xDim)
+        self.assertIn('truncated', header.error)
+
+    def testSpm(self):
+        fn = self._path('image.spm')
+        writeSpm(fn, self.frames[:2])
+        reader = getReader(fn)
+        self.assertIsInstance(reader, SpmReader)
+        self.assertEqual((reader.xDim, reader.yDim, reader.getNumberOfFrames()),
+                         (16, 12, 1))
+        np.testing.assert_array_equal(reader.frames()[0], self.frames[0])
+        self.assertAlmostEqual(reader.heightScale, 0.0003 * 20)
+        self.assertAlmostEqual(reader.pixelSize, 100 / 16.)
+        self.assertAlmostEqual(reader.frameTime, 12 / 2.0)
+        np.testing.assert_allclose(reader.getFrame(0), self.frames[0] * 0.006,
+                                   rtol=1e-5)
+
+    def testSpmHeights(self):
+        """ All the height channels are frames, the rest are ignored. """
+        fn = self._path('heights.spm')
+        writeSpm(fn, self.frames[:3], channels=('Height', 'Phase', 'Height'))
+        reader = SpmReader(fn)
+        np.testing.assert_array_equal(np.stack(reader.frames()),
+                                      self.frames[[0, 2]])
+
+    def testJpk(self):
+        fn = self._path('image.jpk')
+        writeJpk(fn, self.frames[:2])
+        reader = getReader(fn)
+        self.assertIsInstance(reader, JpkReader)
+        self.assertEqual((reader.xDim, reader.yDim, reader.getNumberOfFrames()),
+                         (16, 12, 1))
+        np.testing.assert_array_equal(reader.frames()[0], self.frames[0])
+        self.assertAlmostEqual(reader.heightScale, 0.1)
+        self.assertAlmostEqual(reader.heightOffset, -2.0)
+        self.assertAlmostEqual(reader.pixelSize, 100 / 16.)
+        np.testing.assert_allclose(reader.getFrame(0), self.frames[0] * 0.1 - 2,
+                                   rtol=1e-5, atol=1e-5)
+
+    def testTiffStack(self):
+        fn = self._path('movie.tif')
+        writeTiff(fn, [(frame, []) for frame in self.frames])
+        header = readHeader(fn)
+        self.assertEqual((header.xDim, header.yDim, header.nFrames, header.dataType),
+                         (16, 12, 5, 'int16'))
+        with FrameStack(fn) as stack:
+            np.testing.assert_array_equal(np.stack(list(stack)), self.frames)
+
+    def testLazyMrc(self):
+        """ The native files are converted to MRC (in nm) only once, and
+        again if the source changes. """
+        fn = self._path('movie.asd')
+        writeAsd(fn, self.frames)
+        outputDir = self._path('mrc')
+        os.makedirs(outputDir)
+        mrcFn = getMrcFile(fn, outputDir)
+        self.assertEqual(mrcFn, os.path.join(outputDir, 'movie.mrc'))
+
+        with FrameStack(fn) as native, FrameStack(mrcFn) as converted:
+            self.assertEqual(converted.shape, (5, 12, 16))
+            for (_, a), (_, b) in zip(native.iterBlocks(scaled=True),
+                                      converted.iterBlocks()):
+                np.testing.assert_allclose(a, b, rtol=1e-6)
+
+        mtime = os.path.getmtime(mrcFn)
+        self.assertEqual(getMrcFile(fn, outputDir), mrcFn)
+        self.assertEqual(os.path.getmtime(mrcFn), mtime)
+        mrcFile = self._path('other.mrc')
+        self.assertEqual(getMrcFile(mrcFile, outputDir), mrcFile)
+
+        os.utime(fn, (mtime + 10, mtime + 10))
+        getMrcFile(fn, outputDir)
+        self.assertGreater(os.path.getmtime(mrcFn), mtime)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import unittest
+
+import numpy as np
+from pyworkflow.tests import SMALL
+
+from afm.processing import noisyZoneScores
+from afm.processing.scoring import (summedAreaTables, localVariance,
+                                    giniCoefficients)
+
+
+def patchValues(image, x, y, patchSize):
+    """ Pixels of the patch centered at (x, y), clipped to the image. """
+    half = patchSize // 2
+    return image[max(y - half, 0):max(y - half + patchSize, 0),
+                 max(x - half, 0):max(x - half + patchSize, 0)].ravel()
+
+
+def variance(values):
+    """ Variance of the values, 0 for an empty patch. """
+    return values.astype(np.float64).var() if len(values) else 0.
+
+
+def gini(values):
+    """ Gini coefficient of all the values, shifted to be non-negative. """
+    values = np.sort(values.astype(np.float64))
+    values -= values[0]
+    n = len(values)
+    if not values.sum():
+        return 0.
+    return (2 * (values * np.arange(1, n + 1)).sum() / (n * values.sum())
+            - (n + 1.) / n)
+
+
+class TestScoring(unittest.TestCase):
+    _labels = [SMALL]
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.image = rng.gamma(2., 1., (60, 80)).astype(np.float32)
+        self.image[10:30, 40:70] *= 4  # a noisier zone
+        # Inside, on the borders and partly outside
+        self.positions = np.array([[40, 30], [0, 0], [79, 59], [55, 20],
+                                   [-5, 30], [20, 62]])
+
+    def testLocalVariance(self):
+        """ Same as the variance of the pixels of each patch. """
+        sat, sat2 = summedAreaTables(self.image)
+        for patchSize in (1, 8, 15, 200):
+            expected = [variance(patchValues(self.image, x, y, patchSize))
+                        for x, y in self.positions]
+            np.testing.assert_allclose(
+                localVariance(sat, sat2, self.positions, patchSize),
+                expected, rtol=1e-6, atol=1e-9)
+
+    def testGini(self):
+        """ The sampled estimate is close to the coefficient of the whole
+        patch, and 0 for a flat patch. """
+        estimates = giniCoefficients(self.image, self.positions[:4], 20,
+                                     samples=4096)
+        expected = [gini(patchValues(self.image, x, y, 20))
+                    for x, y in self.positions[:4]]
+        np.testing.assert_allclose(estimates, expected, atol=0.03)
+
+        flat = np.ones((20, 20), dtype=np.float32)
+        self.assertEqual(giniCoefficients(flat, [[10, 10]], 8).tolist(), [0])
+
+    def testNoisyZoneScores(self):
+        scores = noisyZoneScores(self.image, self.positions[:4], 16)
+        self.assertEqual(scores.shape, (4, 2))
+        micVariance = self.image.astype(np.float64).var()
+        expected = [variance(patchValues(self.image, x, y, 16)) / micVariance
+                    for x, y in self.positions[:4]]
+        np.testing.assert_allclose(scores[:, 0], expected, rtol=1e-6)
+        # The patch in the noisy zone has the highest variance score
+        self.assertEqual(np.argmax(scores[:, 0]), 3)
+        # A patch as large as the micrograph has a score of 1
+        whole = noisyZoneScores(self.image, [[40, 30]], 200)
+        self.assertAlmostEqual(whole[0, 0], 1., places=6)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Helper functions shared by the AFM protocols.
+"""
+import json
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase, translate
+
+GLOB_MAGIC = '*?['
+RECURSIVE = '**'
+
+FileEntry = namedtuple('FileEntry', ['path', 'size', 'mtime'])
+
+
+def hasMagic(part):
+    """ Return True if the path component contains any glob wildcard. """
+    return any(c in part for c in GLOB_MAGIC)
+
+
+def splitPattern(pattern):
+    """ Split a glob pattern into the folder where the search starts
+    (the longest prefix without wildcards) and the list of path
+    components that still need to be matched.
+    """
+    parts = os.path.normpath(str(pattern)).split(os.sep)
+    for i, part in enumerate(parts):
+        if hasMagic(part):
+            break
+    else:
+        # No wildcards at all, the pattern is a single file name
+        i = len(parts) - 1
+
+    basePath = os.sep.join(parts[:i])
+    if not basePath:
+        basePath = os.sep if pattern.startswith(os.sep) else '.'
+
+    return basePath, tuple(parts[i:])
+
+
+def _matchPart(name, part):
+    """ Match a file name against one pattern component. As glob does,
+    hidden entries are only matched by components starting with a dot.
+    """
+    if name.startswith('.') and not part.startswith('.'):
+        return False
+    return fnmatchcase(name, part)
+
+
+def _compileParts(parts):
+    """ Single match function for a set of pattern components, with the
+    same rule for hidden entries as _matchPart. """
+    visible = re.compile('|'.join(translate(p) for p in parts) or '(?!)').match
+    hidden = re.compile('|'.join(translate(p) for p in parts
+                                 if p.startswith('.')) or '(?!)').match
+    return lambda name: (hidden if name.startswith('.') else visible)(name)
+
+
+def _scanDir(dirPath, filePatterns, exclude=()):
+    """ List a folder with os.scandir, returning the entries sorted by name
+    as (name, path, isDir, size, mtime) tuples. Only the subfolders and the
+    files matching one of filePatterns are returned, and only those files
+    are stat'ed, through the DirEntry so the call runs in the pool thread
+    (and is free on Windows, where the listing already has it). Files
+    whose path is in exclude are neither stat'ed nor returned. Unreadable
+    folders are skipped.
+    """
+    match = _compileParts(filePatterns)
+    entries = []
+    try:
+        with os.scandir(dirPath) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        entries.append((entry.name, entry.path, True, None, None))
+                    elif match(entry.name) and entry.path not in exclude:
+                        st = entry.stat()
+                        entries.append((entry.name, entry.path, False,
+                                        st.st_size, st.st_mtime))
+                except OSError:
+                    continue  # removed while listing
+    except OSError:
+        return []
+    entries.sort()
+    return entries
+
+
+def _expandRecursive(patterns):
+    """ A '**' component also matches zero folders, so every pattern
+    starting with it is also active without that component.
+    """
+    expanded = set()
+    pending = list(patterns)
+    while pending:
+        p = pending.pop()
+        if p in expanded:
+            continue
+        expanded.add(p)
+        if p and p[0] == RECURSIVE:
+            pending.append(p[1:])
+    return expanded
+
+
+def iterFiles(pattern, numberOfThreads=4, exclude=None):
+    """ Iterate over the files matching a glob pattern.
+
+    The folders are listed with os.scandir in a pool of threads: every
+    time a folder is listed, the listing of its matching subfolders is
+    submitted to the pool, so sibling folders (e.g. one per acquisition day)
+    are scanned in parallel while the results are consumed. Patterns can
+    contain '**' to match any number of nested folders.
+
+    Args:
+        pattern: glob pattern of the files to search
+        numberOfThreads: number of threads used to list folders
+        exclude: optional container of paths (e.g. a FileManifest) that are
+            skipped without being stat'ed
+
+    Returns:
+        A generator of FileEntry(path, size, mtime), sorted by path
+        components, so the first matches are available before the whole
+        tree has been walked.
+    """
+    basePath, parts = splitPattern(pattern)
+    exclude = () if exclude is None else exclude
+
+    if not parts or not any(hasMagic(p) for p in parts):
+        # Plain file name, no need to walk anything
+        fileName = os.path.join(basePath, *parts)
+        if fileName not in exclude and os.path.isfile(fileName):
+            st = os.stat(fileName)
+            yield FileEntry(fileName, st.st_size, st.st_mtime)
+        return
+
+    with ThreadPoolExecutor(max_workers=max(1, numberOfThreads)) as executor:
+
+        def _submit(dirPath, patterns):
+            patterns = _expandRecursive(patterns)
+            filePatterns = {p[0] for p in patterns if len(p) == 1}
+            return patterns, executor.submit(_scanDir, dirPath, filePatterns,
+                                             exclude)
+
+        def _walk(patterns, future):
+            children = []
+
+            for name, entryPath, isDir, size, mtime in future.result():
+                if not isDir:
+                    children.append((FileEntry(entryPath, size, mtime), None))
+                    continue
+                childPatterns = set()
+                for p in patterns:
+                    if not p:
+                        continue
+                    if p[0] == RECURSIVE:
+                        if not name.startswith('.'):
+                            childPatterns.add(p)
+                    elif len(p) > 1 and _matchPart(name, p[0]):
+                        childPatterns.add(p[1:])
+                if childPatterns:
+                    children.append((None, _submit(entryPath, childPatterns)))
+
+            for entry, child in children:
+                if child is None:
+                    yield entry
+                else:
+                    yield from _walk(*child)
+
+        yield from _walk(*_submit(basePath, {parts}))
+
+
+class FileManifest:
+    """ Persisted record of the (path, size, mtime) of already processed
+    files. It is used to process only the files that are new or that
+    changed since the last time the folder was scanned.
+    """
+    def __init__(self, fileName=None):
+        self._fileName = fileName
+        self._entries = {}
+
+        if fileName and os.path.exists(fileName):
+            self.load()
+
+    def load(self):
+        with open(self._fileName) as f:
+            self._entries = {path: tuple(value)
+                             for path, value in json.load(f).items()}
+
+    def save(self):
+        tmpFile = self._fileName + '.tmp'
+        with open(tmpFile, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(tmpFile, self._fileName)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def isChanged(self, entry):
+        """ Return True if the file is new or its size or mtime changed. """
+        return self._entries.get(entry.path) != (entry.size, entry.mtime)
+
+    def add(self, entry):
+        self._entries[entry.path] = (entry.size, entry.mtime)
+
+    def discard(self, path):
+        """ Forget a file, so it is processed again in the next scan. """
+        self._entries.pop(path, None)
+
+    def iterChanged(self, entries):
+        """ Filter an iterable of FileEntry returning only the new or
+        modified ones, and register them in the manifest.
+        """
+        for entry in entries:
+            if self.isChanged(entry):
+                self.add(entry)
+                yield entry